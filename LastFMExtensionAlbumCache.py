@@ -0,0 +1,122 @@
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+# Copyright (C) 2012 - Carrasco Agustin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from collections import OrderedDict
+
+import threading
+
+from LastFMExtensionLibrary import normalize, make_key
+
+# maximum amount of albums kept on the cache
+MAX_ALBUMS = 200
+
+
+class AlbumTracklists(object):
+    '''
+    In-memory cache of album tracklists. The tracklist of each album is
+    downloaded only once and kept as a map from the normalized title of each
+    track to it's position on the album, so the track number of every track
+    of an album costs a single request and a dictionary lookup.
+    Albums are identified by their normalized artist and title; the least
+    recently used albums are dropped when there are more than MAX_ALBUMS.
+    '''
+
+    # unique instance of the cache
+    instance = None
+
+    def __init__(self, size=MAX_ALBUMS):
+        super(AlbumTracklists, self).__init__()
+
+        self._size = size
+        self._lock = threading.Lock()
+        self._albums = OrderedDict()
+        self._fetching = {}
+
+    def track_number(self, album, title):
+        '''
+        Returns the track number (starting from 1) of the track with the
+        given title on the given pylast album, or None if the album doesn't
+        contain it.
+        '''
+        return self.get_positions(album).get(normalize(title))
+
+    def get_positions(self, album):
+        '''
+        Returns the normalized title -> track number map of an album,
+        downloading it's tracklist if it isn't on the cache. Concurrent calls
+        for the same album wait for a single download.
+        '''
+        key = make_key(album.get_artist().get_name(), album.get_title())
+
+        with self._lock:
+            if key in self._albums:
+                positions = self._albums.pop(key)
+                self._albums[key] = positions
+
+                return positions
+
+            # someone else is already downloading it
+            fetching = self._fetching.get(key)
+
+            if not fetching:
+                fetching = self._fetching[key] = threading.Lock()
+
+        with fetching:
+            with self._lock:
+                if key in self._albums:
+                    return self._albums[key]
+
+            try:
+                positions = self._index(album.get_tracks())
+            finally:
+                with self._lock:
+                    self._fetching.pop(key, None)
+
+            with self._lock:
+                self._albums[key] = positions
+
+                while len(self._albums) > self._size:
+                    self._albums.popitem(last=False)
+
+        return positions
+
+    def clear(self):
+        '''
+        Forgets all the cached tracklists.
+        '''
+        with self._lock:
+            self._albums.clear()
+
+    def _index(self, tracks):
+        positions = {}
+
+        for number, track in enumerate(tracks, 1):
+            # keep the first appearance of repeated titles
+            positions.setdefault(normalize(track.get_title()), number)
+
+        return positions
+
+    @classmethod
+    def get_instance(cls):
+        '''
+        Returns the shared cache, creating it if it's needed.
+        '''
+        if not cls.instance:
+            cls.instance = AlbumTracklists()
+
+        return cls.instance
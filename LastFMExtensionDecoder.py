@@ -0,0 +1,128 @@
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+# Copyright (C) 2012 - Carrasco Agustin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+'''
+Streaming decode of the audio files to fingerprint. It's used by matcher.py,
+outside of Rhythmbox, so it MUST NOT import gi.
+'''
+
+import audioop
+
+# NumPy is optional; without it the preprocessing falls back to audioop
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# seconds of audio decoded for a fingerprint. The extractor only looks at the
+# beginning of the song (it reports it's done well before this), so there is
+# no need to decode long mixes or whole albums
+WINDOW = 150
+
+# size in bytes of the PCM blocks handed to the extractor
+CHUNK_SIZE = 64 * 1024
+
+# audioread always decodes to 16 bits signed samples
+SAMPLE_WIDTH = 2
+
+
+def open_audio(path):
+    '''
+    Opens an audio file for decoding. The returned object has the samplerate,
+    channels and duration attributes, iterates over blocks of PCM data and
+    MUST be closed (it can be used as a context manager).
+    '''
+    import audioread
+
+    return audioread.audio_open(path)
+
+
+def window_blocks(audio, seconds=WINDOW, chunk_size=CHUNK_SIZE):
+    '''
+    Generator of the PCM blocks of the first seconds of an opened audio file.
+    The decoded data is re-chunked on a small buffer into blocks of at most
+    chunk_size bytes (always whole frames), and the decoding stops as soon as
+    the window is read or the consumer stops asking for blocks, so the whole
+    signal is never kept on memory.
+    '''
+    frame = SAMPLE_WIDTH * audio.channels
+    chunk_size -= chunk_size % frame
+    remaining = int(seconds * audio.samplerate) * frame
+    buf = bytearray()
+
+    for block in audio:
+        buf.extend(block)
+
+        while len(buf) >= chunk_size and remaining > 0:
+            size = min(chunk_size, remaining)
+            remaining -= size
+
+            yield str(buf[:size])
+            del buf[:size]
+
+        if remaining <= 0:
+            return
+
+    # the file is shorter than the window
+    if buf:
+        yield str(buf[:remaining])
+
+
+def preprocessed_blocks(audio, seconds=WINDOW):
+    '''
+    Same as window_blocks, but the blocks are downmixed to mono before
+    handing them to the extractor, which averages the channels itself
+    anyway. The samplerate is left untouched: the extractor does it's own
+    (filtered) resampling, and decimating here would alias and change the
+    fingerprints.
+    Both NumPy and audioop floor the mean of the channels, so they produce
+    the same samples; without NumPy, layouts of more than two channels are
+    left untouched.
+    Returns a (blocks, samplerate, channels) tuple, with the format of the
+    generated blocks.
+    '''
+    blocks = window_blocks(audio, seconds)
+
+    if audio.channels == 1:
+        return blocks, audio.samplerate, 1
+
+    if numpy is not None:
+        return _numpy_downmix(blocks, audio.channels), audio.samplerate, 1
+
+    if audio.channels == 2:
+        return _audioop_downmix(blocks), audio.samplerate, 1
+
+    # audioop can't downmix more than two channels
+    return blocks, audio.samplerate, audio.channels
+
+
+def _numpy_downmix(blocks, channels):
+    # each output sample is the (floored) mean of the samples of a frame; the
+    # array is a read-only view over the block, without copying it
+    for block in blocks:
+        samples = numpy.frombuffer(block, dtype='<i2')
+        samples = samples[:len(samples) - len(samples) % channels]
+
+        sums = samples.reshape(-1, channels).sum(axis=1, dtype='<i4')
+
+        yield (sums // channels).astype('<i2').tostring()
+
+
+def _audioop_downmix(blocks):
+    for block in blocks:
+        yield audioop.tomono(block, SAMPLE_WIDTH, 0.5, 0.5)
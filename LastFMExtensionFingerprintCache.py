@@ -0,0 +1,211 @@
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+# Copyright (C) 2012 - Carrasco Agustin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+import os
+import hashlib
+import threading
+
+from LastFMExtensionJournal import Journal
+
+# bytes read from the beginning and the end of a file when hashing it
+HASH_CHUNK = 1 << 20
+
+
+def file_identity(path):
+    '''
+    Returns a string that identifies the current version of a file, built from
+    it's inode, size and modification time. It's cheap to compute, but it
+    changes if the file is copied or touched.
+    '''
+    stat = os.stat(path)
+
+    return '%d:%d:%d' % (stat.st_ino, stat.st_size, int(stat.st_mtime))
+
+
+def content_hash(path):
+    '''
+    Returns a sha1 that identifies the content of a file, computed over it's
+    size and it's first and last HASH_CHUNK bytes, so the cost of hashing a
+    file doesn't depend on it's length.
+    '''
+    size = os.path.getsize(path)
+    sha1 = hashlib.sha1(str(size))
+
+    with open(path, 'rb') as audio_file:
+        sha1.update(audio_file.read(HASH_CHUNK))
+
+        if size > 2 * HASH_CHUNK:
+            audio_file.seek(-HASH_CHUNK, os.SEEK_END)
+
+        sha1.update(audio_file.read(HASH_CHUNK))
+
+    return sha1.hexdigest()
+
+
+class FingerprintCache(object):
+    '''
+    Persistent cache of fingerprint results. Results are addressed by the
+    content of the file (see content_hash), and the identity of each file seen (see
+    file_identity) points to the hash of it's content, so an unchanged file
+    is found without reading it, and a copy of an already fingerprinted file
+    only costs hashing it.
+    Each result is the fpid of the file and the list of it's matches, as
+    (artist, title, rank) tuples. The sketches of the fingerprints (used to
+    find duplicates) are cached the same way.
+    '''
+
+    def __init__(self, name):
+        '''
+        Initialises the cache, loading the results saved on previous runs.
+
+        Parameters:
+            name -- file name of the journal that backs the cache.
+        '''
+        super(FingerprintCache, self).__init__()
+
+        self._journal = Journal(name)
+        self._lock = threading.Lock()
+
+        # file identity -> content hash, content hash -> (fpid, matches) and
+        # content hash -> sketch
+        self._hashes = {}
+        self._results = {}
+        self._sketches = {}
+
+        records = self._journal.load()
+
+        for record in records:
+            self._hashes[record['identity']] = record['hash']
+
+            if 'fpid' in record:
+                self._results[record['hash']] = (record['fpid'],
+                    [tuple(match) for match in record['matches']])
+
+            if 'sketch' in record:
+                self._sketches[record['hash']] = record['sketch']
+
+        # drop the outdated records if they are too many
+        if len(records) > 2 * len(self._hashes):
+            self._journal.rewrite(self._records())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._results)
+
+    def lookup(self, path):
+        '''
+        Returns the cached (fpid, matches) result for a file, or None if the
+        file (or a copy of it) wasn't fingerprinted before.
+        '''
+        return self._lookup(path, self._results)
+
+    def lookup_sketch(self, path):
+        '''
+        Returns the cached sketch of a file, or None if the sketch of the file
+        (or a copy of it) wasn't extracted before.
+        '''
+        return self._lookup(path, self._sketches)
+
+    def store(self, path, fpid, matches):
+        '''
+        Saves the result of fingerprinting a file.
+
+        Parameters:
+            path -- the fingerprinted file.
+            fpid -- the fingerprint id returned by Last.fm.
+            matches -- list of (artist, title, rank) tuples.
+        '''
+        matches = [tuple(match) for match in matches]
+
+        self._store(path, self._results, (fpid, matches),
+            {'fpid': fpid, 'matches': matches})
+
+    def store_sketch(self, path, sketch):
+        '''
+        Saves the sketch of the fingerprint of a file.
+        '''
+        self._store(path, self._sketches, sketch, {'sketch': sketch})
+
+    def clear(self):
+        '''
+        Forgets all the cached results.
+        '''
+        with self._lock:
+            self._hashes = {}
+            self._results = {}
+            self._sketches = {}
+
+        self._journal.clear()
+
+    def _lookup(self, path, values):
+        identity = file_identity(path)
+
+        with self._lock:
+            digest = self._hashes.get(identity)
+
+            if digest is not None:
+                return values.get(digest)
+
+        digest = content_hash(path)
+
+        with self._lock:
+            self._hashes[identity] = digest
+            value = values.get(digest)
+
+        # remember the identity of the copy, so it isn't hashed again
+        if value:
+            self._journal.append({'identity': identity, 'hash': digest})
+
+        return value
+
+    def _store(self, path, values, value, record):
+        identity = file_identity(path)
+
+        with self._lock:
+            digest = self._hashes.get(identity)
+
+        if digest is None:
+            digest = content_hash(path)
+
+        with self._lock:
+            self._hashes[identity] = digest
+            values[digest] = value
+
+        record.update(identity=identity, hash=digest)
+        self._journal.append(record)
+
+    def _records(self):
+        stored = set()
+
+        for identity, digest in self._hashes.iteritems():
+            if digest not in self._results and digest not in self._sketches:
+                continue
+
+            record = {'identity': identity, 'hash': digest}
+
+            if digest not in stored:
+                if digest in self._results:
+                    fpid, matches = self._results[digest]
+                    record.update(fpid=fpid, matches=matches)
+
+                if digest in self._sketches:
+                    record['sketch'] = self._sketches[digest]
+
+                stored.add(digest)
+
+            yield record
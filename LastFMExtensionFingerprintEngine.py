@@ -0,0 +1,459 @@
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+# Copyright (C) 2012 - Carrasco Agustin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from gi.repository import GObject
+from subprocess import Popen, PIPE
+from Queue import Queue
+
+import os
+import json
+import threading
+import multiprocessing
+import LastFMExtensionKeys
+
+from LastFMExtensionUtils import idle_add
+from LastFMExtensionRemote import RemoteError
+
+# errors reported by the matcher worker (see matcher.py)
+EXTRACTION_ERROR = 'extraction'
+QUERY_ERROR = 'query'
+UNKNOWN_ERROR = 'unknown'
+
+# the worker process died or couldn't be started
+WORKER_ERROR = 'worker'
+
+# seconds to wait for a fingerprint server to answer a request
+REMOTE_TIMEOUT = 300
+
+# states of the jobs of the pool
+QUEUED = 'queued'
+RUNNING = 'running'
+MATCHED = 'matched'
+FAILED = 'failed'
+
+
+class FingerprintError(Exception):
+    '''
+    Error raised when a file couldn't be fingerprinted. The kind of error is
+    saved on the 'kind' attribute (one of the *_ERROR constants).
+    '''
+
+    def __init__(self, kind, message):
+        super(FingerprintError, self).__init__(message)
+
+        self.kind = kind
+
+
+class FingerprintWorker(object):
+    '''
+    Client for a persistent matcher.py process, running on worker mode. The
+    process imports lastfp only once and then fingerprints the files it's
+    asked for over a pipe, so the interpreter startup isn't paid for each
+    song. The process is started on the first request and restarted if it
+    dies.
+    '''
+
+    def __init__(self, matcher_path):
+        '''
+        Initialises the worker. The process isn't started until it's needed.
+
+        Parameters:
+            matcher_path -- path of the matcher.py script.
+        '''
+        super(FingerprintWorker, self).__init__()
+
+        self._matcher_path = matcher_path
+        self._lock = threading.Lock()
+        self._process = None
+        self._next_id = 0
+
+    def fingerprint(self, path, artist, album, title, duration=None):
+        '''
+        Fingerprints a file and returns it's fpid. Raises a FingerprintError
+        if the file couldn't be fingerprinted.
+        The duration of the song (in seconds) is only used by the
+        RemoteWorker, to upload just the beginning of the file.
+        '''
+        return self._request({'path': path, 'artist': artist, 'album': album,
+            'title': title})['fpid']
+
+    def sketch(self, path, duration=None):
+        '''
+        Extracts the fingerprint of a file, without querying Last.fm, and
+        returns it's sketch (see LastFMExtensionSketch). Raises a
+        FingerprintError if the fingerprint couldn't be extracted.
+        '''
+        return self._request({'path': path, 'sketch': True})['sketch']
+
+    def stop(self):
+        '''
+        Stops the worker process.
+        '''
+        with self._lock:
+            if self._process:
+                try:
+                    self._process.stdin.close()
+                    self._process.wait()
+                except (IOError, OSError):
+                    pass
+
+                self._process = None
+
+    def _request(self, request):
+        with self._lock:
+            request['id'] = self._next_id
+            self._next_id += 1
+
+            try:
+                process = self._get_process()
+                process.stdin.write(json.dumps(request) + '\n')
+                process.stdin.flush()
+
+                line = process.stdout.readline()
+            except (IOError, OSError) as e:
+                self._kill()
+                raise FingerprintError(WORKER_ERROR, str(e))
+
+            if not line:
+                self._kill()
+                raise FingerprintError(WORKER_ERROR,
+                    'The fingerprint worker died unexpectedly.')
+
+        response = json.loads(line)
+
+        if 'error' in response:
+            raise FingerprintError(response['error'], response['message'])
+
+        return response
+
+    def _get_process(self):
+        if not self._process or self._process.poll() is not None:
+            # the plugin directory goes first, keeping the user's paths (where
+            # numpy or lastfp may be installed)
+            environ = os.environ.copy()
+            environ['PYTHONPATH'] = os.pathsep.join(filter(None, [
+                os.path.dirname(LastFMExtensionKeys.__file__),
+                environ.get('PYTHONPATH')]))
+
+            self._process = Popen([self._matcher_path, '--worker'],
+                stdin=PIPE, stdout=PIPE, env=environ)
+
+        return self._process
+
+    def _kill(self):
+        if self._process:
+            try:
+                self._process.kill()
+            except OSError:
+                pass
+
+            self._process = None
+
+
+class RemoteWorker(object):
+    '''
+    Worker that sends the songs to the fingerprint servers of a RemotePool
+    (see LastFMExtensionRemote) and falls back to a local FingerprintWorker
+    when none of them is available or the request is lost on the way.
+    '''
+
+    def __init__(self, remote, local):
+        '''
+        Parameters:
+            remote -- the RemotePool with the servers.
+            local -- the FingerprintWorker used as fallback.
+        '''
+        super(RemoteWorker, self).__init__()
+
+        self._remote = remote
+        self._local = local
+
+    def fingerprint(self, path, artist, album, title, duration=None):
+        '''
+        See FingerprintWorker.fingerprint.
+        '''
+        return self._request({'path': path, 'artist': artist, 'album': album,
+            'title': title}, duration)['fpid']
+
+    def sketch(self, path, duration=None):
+        '''
+        See FingerprintWorker.sketch.
+        '''
+        return self._request({'path': path, 'sketch': True},
+            duration)['sketch']
+
+    def _request(self, request, duration):
+        try:
+            response = self._remote.submit(dict(request,
+                duration=duration)).wait(REMOTE_TIMEOUT)
+        except (RemoteError, IOError, OSError) as e:
+            print e
+            return self._local._request(request)
+
+        if 'error' in response:
+            raise FingerprintError(response['error'], response['message'])
+
+        return response
+
+
+class ResultStore(object):
+    '''
+    Thread-safe store where the pool leaves the results of the jobs, indexed
+    by the key they were submitted with. The result of a job is either the
+    value returned by it or the Exception it raised.
+    '''
+
+    def __init__(self):
+        super(ResultStore, self).__init__()
+
+        self._lock = threading.Lock()
+        self._results = {}
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._results
+
+    def __len__(self):
+        with self._lock:
+            return len(self._results)
+
+    def put(self, key, result):
+        with self._lock:
+            self._results[key] = result
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._results.get(key, default)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._results.pop(key, default)
+
+    def keys(self):
+        with self._lock:
+            return self._results.keys()
+
+
+class FingerprintPool(GObject.Object):
+    '''
+    Pool of matcher workers, so several files are fingerprinted at the same
+    time using all the cores. Each job runs on a thread that owns it's own
+    FingerprintWorker; the results are left on a shared ResultStore as they
+    complete (in whatever order they finish) and the 'result' signal is
+    emitted on the Gtk main loop with the key of the finished job.
+    When the remote attribute has a RemotePool, the jobs are sent to it's
+    fingerprint servers, and the local workers are only used as fallback.
+    The pool tracks the state of each job (QUEUED, RUNNING and then MATCHED
+    or FAILED): a key that is already queued or running isn't submitted
+    again, queued jobs can be cancelled, and the 'progress' signal is emitted
+    each time a job changes it's state.
+    '''
+    # signals
+    __gsignals__ = {
+        'result': (GObject.SIGNAL_RUN_LAST, None, (object,)),
+        'progress': (GObject.SIGNAL_RUN_LAST, None, ())
+        }
+
+    def __init__(self, matcher_path, size=None):
+        '''
+        Initialises the pool. The workers aren't started until there are jobs
+        for them.
+
+        Parameters:
+            matcher_path -- path of the matcher.py script.
+            size -- number of workers. By default, one per core.
+        '''
+        super(FingerprintPool, self).__init__()
+
+        self._matcher_path = matcher_path
+        self._jobs = Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._idle = 0
+        self._size = size or multiprocessing.cpu_count()
+
+        # key -> (state, ticket) of the queued and running jobs, and amount
+        # of jobs finished since the pool was last idle
+        self._states = {}
+        self._finished = {MATCHED: 0, FAILED: 0}
+
+        self.results = ResultStore()
+        self.remote = None
+
+    @property
+    def size(self):
+        return self._size
+
+    @size.setter
+    def size(self, size):
+        '''
+        Changes the number of workers. Extra workers are stopped after
+        finishing the job they are running.
+        '''
+        with self._lock:
+            self._size = size
+
+            self._start_threads()
+
+    @property
+    def pending(self):
+        ''' Amount of jobs waiting for a worker. '''
+        return self.progress()[QUEUED]
+
+    def state(self, key):
+        '''
+        Returns the state of the job with the given key, or None if it isn't
+        queued nor running.
+        '''
+        with self._lock:
+            return self._states.get(key, (None,))[0]
+
+    def progress(self):
+        '''
+        Returns a dictionary with the amount of jobs on each state. The
+        finished jobs are counted since the last time the pool was idle.
+        '''
+        with self._lock:
+            progress = dict(self._finished, **{QUEUED: 0, RUNNING: 0})
+
+            for state, _ in self._states.itervalues():
+                progress[state] += 1
+
+        return progress
+
+    def submit(self, key, job, *args):
+        '''
+        Queues a job. The job is a function that receives a FingerprintWorker
+        and the given arguments; it's result is saved on the store under the
+        given key. Returns False (and ignores the job) if there is a job with
+        the same key queued or running.
+        '''
+        with self._lock:
+            if key in self._states:
+                return False
+
+            # a new run starts
+            if not self._states:
+                self._finished = {MATCHED: 0, FAILED: 0}
+
+            ticket = object()
+            self._states[key] = (QUEUED, ticket)
+            self._jobs.put((key, ticket, job, args))
+
+            self._start_threads()
+
+        idle_add(self.emit, 'progress')
+
+        return True
+
+    def cancel(self, key):
+        '''
+        Cancels a queued job. Returns False if the job isn't queued (it's
+        already running or done).
+        '''
+        with self._lock:
+            if self._states.get(key, (None,))[0] != QUEUED:
+                return False
+
+            del self._states[key]
+
+        idle_add(self.emit, 'progress')
+
+        return True
+
+    def stop(self):
+        '''
+        Stops all the workers once the jobs already submitted are done.
+        '''
+        with self._lock:
+            for _ in self._threads:
+                self._jobs.put(None)
+
+    def _start_threads(self):
+        # start workers until there is one for each waiting job
+        while self._jobs.qsize() > self._idle and \
+              len(self._threads) < self._size:
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+            self._threads.append(thread)
+            self._idle += 1
+
+    def _run(self):
+        worker = FingerprintWorker(self._matcher_path)
+        current = threading.current_thread()
+
+        while True:
+            item = self._jobs.get()
+
+            with self._lock:
+                self._idle -= 1
+
+            if item is None:
+                break
+
+            key, ticket, job, args = item
+
+            with self._lock:
+                # the job was cancelled (and maybe queued again)
+                if self._states.get(key, (None, None))[1] is not ticket:
+                    self._idle += 1
+                    continue
+
+                self._states[key] = (RUNNING, ticket)
+
+            idle_add(self.emit, 'progress')
+            remote = self.remote
+
+            try:
+                if remote:
+                    result = job(RemoteWorker(remote, worker), *args)
+                else:
+                    result = job(worker, *args)
+            except Exception as e:
+                result = e
+
+            self.results.put(key, result)
+
+            with self._lock:
+                del self._states[key]
+                self._finished[FAILED if isinstance(result, Exception)
+                    else MATCHED] += 1
+
+            idle_add(self.emit, 'result', key)
+            idle_add(self.emit, 'progress')
+
+            with self._lock:
+                # the pool was shrinked; the thread leaves the list right
+                # away, so the other threads see the new count and only the
+                # extra ones stop
+                if len(self._threads) > self._size:
+                    self._threads.remove(current)
+
+                    # the remaining threads may not be enough for the queue
+                    self._start_threads()
+                    break
+
+                self._idle += 1
+
+        worker.stop()
+
+        with self._lock:
+            if current in self._threads:
+                self._threads.remove(current)
@@ -0,0 +1,317 @@
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+# Copyright (C) 2012 - Carrasco Agustin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+import re
+import threading
+import unicodedata
+
+from LastFMExtensionLibrary import normalize
+
+# minimum similarities needed to consider two names the same
+ARTIST_THRESHOLD = 0.7
+TITLE_THRESHOLD = 0.85
+MATCH_THRESHOLD = 0.9
+
+# how many artists to consider as candidates for a fuzzy artist name
+MAX_ARTIST_CANDIDATES = 3
+
+# regular expressions applied over already normalized names
+FEATURING = re.compile(r'\b(feat|ft|featuring)\b.*$', re.UNICODE)
+VERSION = re.compile(r'\b((\d{4} )?(digital(ly)? )?re ?master(ed)?( \d{4})?'
+    r'( version| edition)?|(album|single|radio) (version|edit)|mono|stereo)'
+    r'\b.*$', re.UNICODE)
+THE_PREFIX = re.compile(r'^the ', re.UNICODE)
+# numbers are digits, roman numerals of two or more letters, or a single
+# letter numeral after words like part or vol (a lone 'i' is just a word)
+NUMBERS = re.compile(r'\b(?:(\d+)|(?=[ivx]{2})(x{0,3}(?:ix|iv|v?i{0,3}))|'
+    r'(?:parts?|pt|vol|volume|no) ([ivx]))\b', re.UNICODE)
+
+
+def strip_accents(text):
+    '''
+    Removes the diacritics from an unicode string.
+    '''
+    return u''.join(char for char in unicodedata.normalize('NFKD', text)
+        if not unicodedata.combining(char))
+
+
+def canonical_artist(artist):
+    '''
+    Returns a canonical version of an artist name, without diacritics,
+    featured artists and leading 'The'.
+    '''
+    artist = strip_accents(normalize(artist))
+    artist = FEATURING.sub(u'', artist).strip()
+
+    return THE_PREFIX.sub(u'', artist) or artist
+
+
+def canonical_title(title):
+    '''
+    Returns a canonical version of a track title, without diacritics, featured
+    artists and remaster/version suffixes.
+    '''
+    title = strip_accents(normalize(title))
+    stripped = VERSION.sub(u'', FEATURING.sub(u'', title)).strip()
+
+    return stripped or title
+
+
+def numbers(title):
+    '''
+    Returns a tuple with the numbers (digits or roman numerals) on a
+    canonical title. Titles with different numbers are different tracks
+    (movements, parts, sequels), no matter how similar the rest is.
+    '''
+    return tuple(next(group for group in match.groups() if group)
+        for match in NUMBERS.finditer(title))
+
+
+def trigrams(text):
+    '''
+    Returns the set of trigrams of a text, padded so the beginning and the end
+    of the words have more weight.
+    '''
+    text = u'  %s ' % text
+
+    return frozenset(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def similarity(grams1, grams2):
+    '''
+    Dice coefficient between two trigram sets.
+    '''
+    if not grams1 or not grams2:
+        return 0.
+
+    return 2. * len(grams1 & grams2) / (len(grams1) + len(grams2))
+
+
+def pair_similarity(pair1, pair2):
+    '''
+    Compares two (artist, title) pairs with the same rules used by the
+    FuzzyMatcher. Returns the similarity of the pairs, or 0 if they aren't
+    similar enough to be considered the same track.
+    '''
+    artist_score = similarity(trigrams(canonical_artist(pair1[0])),
+        trigrams(canonical_artist(pair2[0])))
+    title1 = canonical_title(pair1[1])
+    title2 = canonical_title(pair2[1])
+
+    if artist_score < ARTIST_THRESHOLD or numbers(title1) != numbers(title2):
+        return 0.
+
+    title_score = similarity(trigrams(title1), trigrams(title2))
+
+    if title_score < TITLE_THRESHOLD:
+        return 0.
+
+    score = (artist_score + 2 * title_score) / 3
+
+    return score if score >= MATCH_THRESHOLD else 0.
+
+
+class FuzzyMatcher(object):
+    '''
+    Approximate matcher between the names used on the library and the ones
+    returned by Last.fm.
+    To keep bulk reconciliations fast, the names are blocked by artist: the
+    artist of a query is resolved once (exactly or through a trigram inverted
+    index over the artist names) and then the title is only compared against
+    the titles of the matched artists. Titles are only matched approximately
+    when they have the same numbers.
+    The matcher can be updated incrementally with add and remove, so it
+    doesn't need to be rebuilt when the library changes.
+    '''
+
+    def __init__(self, keys):
+        '''
+        Builds the matcher indexes.
+
+        Parameters:
+            keys -- iterable of normalized (artist, title) keys, as stored on
+                    the LibraryIndex.
+        '''
+        super(FuzzyMatcher, self).__init__()
+
+        self._lock = threading.Lock()
+
+        # canonical artist -> {canonical title: [(trigrams, numbers, key)]}
+        self._titles = {}
+
+        # canonical artist -> trigrams and trigram -> canonical artists
+        self._artist_grams = {}
+        self._postings = {}
+
+        for key in keys:
+            self._add(key)
+
+    def add(self, key):
+        '''
+        Adds a normalized (artist, title) key to the matcher.
+        '''
+        with self._lock:
+            self._add(key)
+
+    def remove(self, key):
+        '''
+        Removes a normalized (artist, title) key from the matcher.
+        '''
+        with self._lock:
+            self._remove(key)
+
+    def _add(self, key):
+        artist = canonical_artist(key[0])
+        title = canonical_title(key[1])
+
+        if artist not in self._titles:
+            self._titles[artist] = {}
+            grams = trigrams(artist)
+            self._artist_grams[artist] = grams
+
+            for gram in grams:
+                self._postings.setdefault(gram, set()).add(artist)
+
+        self._titles[artist].setdefault(title, []).append(
+            (trigrams(title), numbers(title), key))
+
+    def _remove(self, key):
+        artist = canonical_artist(key[0])
+        title = canonical_title(key[1])
+        titles = self._titles.get(artist, {})
+        entries = [entry for entry in titles.get(title, ())
+            if entry[2] != key]
+
+        if entries:
+            titles[title] = entries
+        elif title in titles:
+            del titles[title]
+
+        if artist in self._titles and not titles:
+            del self._titles[artist]
+
+            for gram in self._artist_grams.pop(artist):
+                self._postings[gram].discard(artist)
+
+                if not self._postings[gram]:
+                    del self._postings[gram]
+
+    def match(self, artist, title):
+        '''
+        Returns a (key, score) tuple with the library key that better matches
+        the given artist and title, or None if there isn't a good enough match.
+        '''
+        return self.match_many([(artist, title)]).get((artist, title))
+
+    def match_many(self, pairs):
+        '''
+        Matches a batch of (artist, title) pairs. The queries are grouped by
+        artist, so each distinct artist is only resolved once.
+        Returns a dictionary from each matched pair to a (key, score) tuple;
+        pairs without a good enough match are left out.
+        '''
+        by_artist = {}
+
+        for pair in pairs:
+            by_artist.setdefault(canonical_artist(pair[0]), []).append(pair)
+
+        matches = {}
+
+        for artist, artist_pairs in by_artist.iteritems():
+            # the lock is only held for each artist, so the updates from the
+            # library aren't blocked for the whole batch
+            with self._lock:
+                candidates = self._match_artist(artist)
+
+                if not candidates:
+                    continue
+
+                for pair in artist_pairs:
+                    match = self._match_title(candidates,
+                        canonical_title(pair[1]))
+
+                    if match:
+                        matches[pair] = match
+
+        return matches
+
+    def _match_artist(self, artist):
+        # exact match of the canonical name
+        if artist in self._titles:
+            return [(artist, 1.)]
+
+        # count the shared trigrams with every artist using the postings
+        grams = trigrams(artist)
+        shared = {}
+
+        for gram in grams:
+            for candidate in self._postings.get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+
+        candidates = []
+
+        for candidate, count in shared.iteritems():
+            score = 2. * count / (len(grams) +
+                len(self._artist_grams[candidate]))
+
+            if score >= ARTIST_THRESHOLD:
+                candidates.append((candidate, score))
+
+        candidates.sort(key=lambda candidate: candidate[1], reverse=True)
+
+        return candidates[:MAX_ARTIST_CANDIDATES]
+
+    def _match_title(self, candidates, title):
+        best = None
+        grams = None
+
+        for artist, artist_score in candidates:
+            titles = self._titles[artist]
+
+            # exact match of the canonical title
+            if title in titles:
+                title_score = 1.
+                key = titles[title][0][2]
+
+            else:
+                if grams is None:
+                    grams = trigrams(title)
+                    title_numbers = numbers(title)
+
+                title_score = 0.
+                key = None
+
+                for entries in titles.itervalues():
+                    if entries[0][1] != title_numbers:
+                        continue
+
+                    score = similarity(grams, entries[0][0])
+
+                    if score > title_score:
+                        title_score = score
+                        key = entries[0][2]
+
+            if title_score < TITLE_THRESHOLD:
+                continue
+
+            score = (artist_score + 2 * title_score) / 3
+
+            if score >= MATCH_THRESHOLD and (not best or score > best[1]):
+                best = (key, score)
+
+        return best
@@ -0,0 +1,181 @@
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+# Copyright (C) 2012 - Carrasco Agustin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from gi.repository import RB
+
+import os
+import json
+import threading
+
+# directory (relative to the user data dir) where the journals are stored
+JOURNALS_DIR = 'plugins/lastfm_extension'
+
+
+class Journal(object):
+    '''
+    Small append-only journal persisted on the user data directory. Each
+    record is a json object written on it's own line, so if Rhythmbox dies
+    while writing, only the last (partial) record is lost.
+    '''
+
+    def __init__(self, name):
+        '''
+        Initialises the journal. The file isn't touched until something is
+        appended to it.
+
+        Parameters:
+            name -- file name of the journal, inside the plugin data dir.
+        '''
+        super(Journal, self).__init__()
+
+        self._path = RB.find_user_data_file(os.path.join(JOURNALS_DIR, name))
+        self._lock = threading.Lock()
+
+    @property
+    def exists(self):
+        ''' Indicates if there is something saved on the journal. '''
+        return os.path.exists(self._path)
+
+    def load(self):
+        '''
+        Reads all the records saved on the journal, in the order they were
+        appended. Corrupt lines (usually a partially written last record) are
+        silently skipped.
+        '''
+        records = []
+
+        with self._lock:
+            if not os.path.exists(self._path):
+                return records
+
+            with open(self._path) as journal_file:
+                for line in journal_file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        pass
+
+        return records
+
+    def append(self, *records):
+        '''
+        Appends the given records at the end of the journal, flushing them to
+        the disk right away.
+        '''
+        if not records:
+            return
+
+        lines = ''.join(json.dumps(record) + '\n' for record in records)
+
+        with self._lock:
+            self._ensure_dir()
+
+            with open(self._path, 'a') as journal_file:
+                journal_file.write(lines)
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+    def rewrite(self, records):
+        '''
+        Replaces the whole content of the journal with the given records. The
+        new content is written to a temporary file first and then moved over
+        the old one, so the journal is never left half written.
+        '''
+        tmp_path = self._path + '.tmp'
+
+        with self._lock:
+            self._ensure_dir()
+
+            with open(tmp_path, 'w') as journal_file:
+                for record in records:
+                    journal_file.write(json.dumps(record) + '\n')
+
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+            os.rename(tmp_path, self._path)
+
+    def clear(self):
+        '''
+        Removes the journal from the disk.
+        '''
+        with self._lock:
+            if os.path.exists(self._path):
+                os.remove(self._path)
+
+    def _ensure_dir(self):
+        journal_dir = os.path.dirname(self._path)
+
+        if not os.path.exists(journal_dir):
+            os.makedirs(journal_dir)
+
+
+class Checkpoint(object):
+    '''
+    Persistent checkpoint for long running batch jobs. It records the keys of
+    the items already processed and the last position reached, so an
+    interrupted job can skip the work it already did when it's restarted.
+    '''
+
+    def __init__(self, name=None):
+        '''
+        Initialises the checkpoint, loading the progress saved on a previous
+        run (if any).
+
+        Parameters:
+            name -- file name of the journal that backs the checkpoint. If it
+                    isn't given, the checkpoint is only kept in memory.
+        '''
+        super(Checkpoint, self).__init__()
+
+        self._journal = Journal(name) if name else None
+        self.done = set()
+        self.position = 0
+
+        if self._journal:
+            for record in self._journal.load():
+                self.done.update(record['keys'])
+                self.position = max(self.position, record['position'])
+
+    @property
+    def resumable(self):
+        ''' Indicates if there is a previous run to resume. '''
+        return len(self.done) > 0
+
+    def mark(self, position, *keys):
+        '''
+        Marks the given keys as processed and saves the position reached.
+        '''
+        keys = [key for key in keys if key not in self.done]
+
+        self.done.update(keys)
+        self.position = max(self.position, position)
+
+        if self._journal:
+            self._journal.append({'keys': keys, 'position': self.position})
+
+    def clear(self):
+        '''
+        Forgets all the saved progress. Should be called once the job is
+        completely done.
+        '''
+        self.done = set()
+        self.position = 0
+
+        if self._journal:
+            self._journal.clear()
@@ -0,0 +1,375 @@
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+# Copyright (C) 2012 - Carrasco Agustin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from gi.repository import RB
+from collections import namedtuple
+
+import re
+import threading
+
+# compact representation of an entry stored on the index
+IndexedEntry = namedtuple('IndexedEntry', ['entry_id', 'location'])
+
+# entry properties that affect the index
+INDEXED_PROPS = (RB.RhythmDBPropType.ARTIST, RB.RhythmDBPropType.TITLE,
+    RB.RhythmDBPropType.LOCATION)
+
+# regular expressions used to normalize names
+PUNCTUATION = re.compile(r'[^\w\s]', re.UNICODE)
+SPACES = re.compile(r'\s+', re.UNICODE)
+
+
+def normalize(text):
+    '''
+    Normalizes a name (artist, title, etc) so it can be compared with the
+    names returned by Last.fm. The name is case-folded, the punctuation is
+    removed and the whitespaces are collapsed.
+    '''
+    if not text:
+        return u''
+
+    if not isinstance(text, unicode):
+        text = unicode(text, 'utf-8', 'replace')
+
+    text = PUNCTUATION.sub(u' ', text.lower())
+
+    return SPACES.sub(u' ', text).strip()
+
+
+def make_key(artist, title):
+    '''
+    Returns the key used by the index for the given artist and title.
+    '''
+    return normalize(artist), normalize(title)
+
+
+class LibraryIndex(object):
+    '''
+    In-memory index of the library, that allows to find the entries that
+    correspond to an (artist, title) pair returned by Last.fm without going
+    through the whole library.
+    The index is built once from the library query model and it's kept up to
+    date listening to the changes on the database. Entries are kept as compact
+    tuples (see IndexedEntry) instead of live RhythmDB entries.
+    '''
+
+    # unique instance of the index
+    instance = None
+
+    def __init__(self, db, query_model, entry_type):
+        '''
+        Initialises the index. The index isn't built until it's first used.
+
+        Parameters:
+            db -- the Rhythmbox database.
+            query_model -- query model with all the entries to index.
+            entry_type -- the type of the entries to index.
+        '''
+        super(LibraryIndex, self).__init__()
+
+        self._db = db
+        self._query_model = query_model
+        self._entry_type = entry_type
+        self._lock = threading.RLock()
+        self._matcher_lock = threading.Lock()
+        self._signal_ids = []
+
+        self._by_key = {}
+        self._by_id = {}
+        self._artists = {}
+        self._matcher = None
+        self._pending = None
+
+        self.built = False
+
+    def build(self):
+        '''
+        Builds the index from the query model and starts listening to the
+        database changes. This method MUST be called from the Gtk main loop.
+        '''
+        with self._lock:
+            self._by_key = {}
+            self._by_id = {}
+            self._artists = {}
+            self._matcher = None
+            self._pending = None
+
+            for row in self._query_model:
+                self._add(row[0])
+
+            self.built = True
+
+        if not self._signal_ids:
+            self._signal_ids = [
+                self._db.connect('entry-added', self._entry_added),
+                self._db.connect('entry-changed', self._entry_changed),
+                self._db.connect('entry-deleted', self._entry_deleted)]
+
+    def destroy(self):
+        '''
+        Stops listening to the database changes and frees the index.
+        '''
+        for signal_id in self._signal_ids:
+            self._db.disconnect(signal_id)
+
+        with self._lock:
+            self._signal_ids = []
+            self._by_key = {}
+            self._by_id = {}
+            self._artists = {}
+            self._matcher = None
+            self._pending = None
+            self.built = False
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def lookup(self, artist, title):
+        '''
+        Returns a list with the IndexedEntry instances that correspond to the
+        given artist and title. The list is empty if there isn't any.
+        '''
+        return self.lookup_key(make_key(artist, title))
+
+    def lookup_key(self, key):
+        '''
+        Same as lookup, but receives an already normalized key.
+        '''
+        with self._lock:
+            return list(self._by_key.get(key, ()))
+
+    def resolve_many(self, pairs):
+        '''
+        Resolves a batch of (artist, title) pairs returned by Last.fm to the
+        entries on the library. The pairs that don't have an exact match are
+        matched approximately (see LastFMExtensionFuzzyMatcher), so most of
+        them can be resolved without asking Last.fm for corrections.
+        Returns a dictionary from each resolved pair to a list of IndexedEntry.
+        '''
+        resolved = {}
+        missing = []
+
+        with self._lock:
+            for pair in pairs:
+                items = self._by_key.get(make_key(*pair))
+
+                if items:
+                    resolved[pair] = list(items)
+                else:
+                    missing.append(pair)
+
+        if missing:
+            # both building and using the matcher are done outside the lock,
+            # so the db signals aren't blocked while reconciling big batches
+            matcher = self._get_matcher()
+            matches = matcher.match_many(missing)
+
+            with self._lock:
+                for pair, (key, score) in matches.iteritems():
+                    if key in self._by_key:
+                        resolved[pair] = list(self._by_key[key])
+
+        return resolved
+
+    def resolve(self, artist, title):
+        '''
+        Same as resolve_many, but for a single pair. Returns a list of
+        IndexedEntry, empty if the pair couldn't be resolved.
+        '''
+        return self.resolve_many([(artist, title)]).get((artist, title), [])
+
+    def keys(self):
+        '''
+        Returns a list with all the normalized keys on the index.
+        '''
+        with self._lock:
+            return self._by_key.keys()
+
+    def items(self):
+        '''
+        Returns a list of (key, IndexedEntry) pairs for all the entries on the
+        index.
+        '''
+        with self._lock:
+            return [(key, item) for key, item in self._by_id.itervalues()]
+
+    def key_for(self, entry):
+        '''
+        Returns the normalized key of an entry, if it's indexed.
+        '''
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+
+        with self._lock:
+            if entry_id in self._by_id:
+                return self._by_id[entry_id][0]
+
+        return None
+
+    def artist_counts(self):
+        '''
+        Returns a dictionary with the number of indexed entries for each
+        (normalized) artist.
+        '''
+        with self._lock:
+            return dict(self._artists)
+
+    def get_entry(self, item):
+        '''
+        Returns the live RhythmDB entry for an IndexedEntry, or None if it was
+        removed from the database.
+        '''
+        return self._db.entry_lookup_by_location(item.location)
+
+    def _get_matcher(self):
+        from LastFMExtensionFuzzyMatcher import FuzzyMatcher
+
+        with self._matcher_lock:
+            with self._lock:
+                if self._matcher:
+                    return self._matcher
+
+                # the keys added or removed while the matcher is being built
+                # are recorded, to be replayed once it's ready
+                keys = self._by_key.keys()
+                self._pending = []
+
+            matcher = FuzzyMatcher(keys)
+
+            with self._lock:
+                if self._pending is None:
+                    # the index was rebuilt or destroyed meanwhile
+                    return matcher
+
+                for added, key in self._pending:
+                    if added:
+                        matcher.add(key)
+                    else:
+                        matcher.remove(key)
+
+                self._pending = None
+                self._matcher = matcher
+
+            return matcher
+
+    def _key_added(self, key):
+        # once built, the matcher is kept up to date incrementally
+        if self._matcher:
+            self._matcher.add(key)
+        elif self._pending is not None:
+            self._pending.append((True, key))
+
+    def _key_removed(self, key):
+        if self._matcher:
+            self._matcher.remove(key)
+        elif self._pending is not None:
+            self._pending.append((False, key))
+
+    def _add(self, entry):
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+        key = make_key(entry.get_string(RB.RhythmDBPropType.ARTIST),
+            entry.get_string(RB.RhythmDBPropType.TITLE))
+        item = IndexedEntry(entry_id,
+            entry.get_string(RB.RhythmDBPropType.LOCATION))
+
+        if key not in self._by_key:
+            self._by_key[key] = []
+            self._key_added(key)
+
+        self._by_key[key].append(item)
+        self._by_id[entry_id] = (key, item)
+        self._artists[key[0]] = self._artists.get(key[0], 0) + 1
+
+    def _remove(self, entry):
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+
+        if entry_id not in self._by_id:
+            return
+
+        key, item = self._by_id.pop(entry_id)
+
+        items = self._by_key[key]
+        items.remove(item)
+
+        if not items:
+            del self._by_key[key]
+            self._key_removed(key)
+
+        self._artists[key[0]] -= 1
+
+        if not self._artists[key[0]]:
+            del self._artists[key[0]]
+
+    def _indexable(self, entry):
+        return entry.get_entry_type() == self._entry_type
+
+    def _entry_added(self, db, entry):
+        if self._indexable(entry):
+            with self._lock:
+                self._add(entry)
+
+    def _entry_changed(self, db, entry, changes):
+        # only the changes on the artist, title or location affect the index;
+        # playcounts, ratings, play times and the like are ignored
+        if self._indexable(entry) and self._affects_index(changes):
+            with self._lock:
+                self._remove(entry)
+                self._add(entry)
+
+    def _affects_index(self, changes):
+        try:
+            return any(change.prop in INDEXED_PROPS for change in changes)
+        except (TypeError, AttributeError):
+            # the changes couldn't be read, so re-index just in case
+            return True
+
+    def _entry_deleted(self, db, entry):
+        if self._indexable(entry):
+            with self._lock:
+                self._remove(entry)
+
+    @classmethod
+    def initialise_instance(cls, plugin):
+        '''
+        Initializes the shared index.
+        '''
+        if not cls.instance:
+            library_source = plugin.shell.props.library_source
+
+            cls.instance = LibraryIndex(plugin.shell.props.db,
+                library_source.props.base_query_model,
+                library_source.props.entry_type)
+
+    @classmethod
+    def destroy_instance(cls):
+        '''
+        Destroys the shared index.
+        '''
+        if cls.instance:
+            cls.instance.destroy()
+            cls.instance = None
+
+    @classmethod
+    def get_instance(cls):
+        '''
+        Returns the shared index, building it if it wasn't used before. It
+        MUST be called from the Gtk main loop.
+        '''
+        if cls.instance and not cls.instance.built:
+            cls.instance.build()
+
+        return cls.instance
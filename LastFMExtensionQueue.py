@@ -0,0 +1,335 @@
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+# Copyright (C) 2012 - Carrasco Agustin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from gi.repository import GObject
+from collections import OrderedDict
+
+import time
+import threading
+import pylast
+
+from LastFMExtensionUtils import idle_add, notify
+from LastFMExtensionJournal import Journal
+from LastFMExtensionLibrary import make_key
+from LastFMExtensionSync import LovedMirror
+
+# journal where the queued actions are saved
+QUEUE_FILE = 'actions.queue'
+
+# minimum seconds between two requests
+THROTTLE = 0.5
+
+# seconds to wait before retrying after a network error. The delay doubles
+# with each consecutive failure, up to RETRY_MAX
+RETRY_MIN = 30
+RETRY_MAX = 3600
+
+# Last.fm errors caused by the request itself; retrying it won't help
+REJECTED_ERRORS = (pylast.STATUS_INVALID_PARAMS,)
+
+# Last.fm errors caused by the session or the api key; nothing is accepted
+# until the user connects again. Any other error is retried later
+AUTH_ERRORS = (pylast.STATUS_INVALID_SK, pylast.STATUS_INVALID_API_KEY,
+    pylast.STATUS_INVALID_SIGNATURE, pylast.STATUS_SUSPENDED_API_KEY)
+
+
+def error_code(error):
+    '''
+    Returns the status code of a pylast WSError as an integer (or None).
+    '''
+    try:
+        return int(error.get_id())
+    except (TypeError, ValueError):
+        return None
+
+
+def session_rejected(error):
+    '''
+    Informs the user that Last.fm rejected the session, so the queued
+    requests wait until the user connects again.
+    '''
+    print 'Last.fm rejected the session: %s' % error
+    idle_add(notify, 'Last.fm rejected the session',
+        'Connect again from the plugin preferences to send the pending '
+        'changes')
+
+
+def love(network, artist, title):
+    network.get_track(artist, title).love()
+    LovedMirror.get_instance().add(artist, title)
+
+
+def ban(network, artist, title):
+    network.get_track(artist, title).ban()
+
+
+# functions that execute each kind of action
+ACTIONS = {
+    'love': love,
+    'ban': ban
+    }
+
+
+class ActionQueue(GObject.Object):
+    '''
+    Persistent queue for the mutating calls made to Last.fm (loving or banning
+    tracks). Actions are written to a Journal when they are pushed and a
+    background worker sends them, throttled so Last.fm doesn't reject them.
+    The actions that weren't sent survive restarts and are sent once the
+    network is available again; network and service errors are retried with
+    an exponential backoff, and authentication errors stop the queue until
+    the user connects again. Only the actions Last.fm rejects as invalid are
+    dropped.
+    Actions over the same track are merged: a newer action replaces the one
+    that is still queued, so only the last one is sent.
+    '''
+    # signals
+    __gsignals__ = {
+        'progress': (GObject.SIGNAL_RUN_LAST, None, ()),
+        'failed': (GObject.SIGNAL_RUN_LAST, None, (object,))
+        }
+
+    # unique instance of the queue
+    instance = None
+
+    def __init__(self, name):
+        '''
+        Initialises the queue, loading the actions that weren't sent on a
+        previous run.
+        '''
+        super(ActionQueue, self).__init__()
+
+        self._journal = Journal(name)
+        self._lock = threading.Lock()
+        self._actions = OrderedDict()
+        self._next_id = 0
+        self._network = None
+        self._worker = None
+        self._stop = False
+        self._retry = None
+        self._retry_delay = RETRY_MIN
+
+        # statistics of the current run of the worker
+        self.sent = 0
+        self.rate = 0.
+
+        for record in self._journal.load():
+            if record['op'] == 'push':
+                self._actions[record['id']] = record['action']
+            else:
+                self._actions.pop(record['id'], None)
+
+            self._next_id = max(self._next_id, record['id'] + 1)
+
+    @property
+    def pending(self):
+        ''' Amount of actions waiting to be sent. '''
+        return len(self._actions)
+
+    @property
+    def network(self):
+        return self._network
+
+    @network.setter
+    def network(self, network):
+        self._network = network
+        self._cancel_retry()
+
+        if network:
+            self._start_worker()
+        else:
+            self._stop = True
+
+    def push(self, action, **args):
+        '''
+        Queues a single action. See push_many.
+        '''
+        self.push_many([dict(args, action=action)])
+
+    def push_many(self, actions):
+        '''
+        Queues a list of actions. Each action is a dictionary with the name of
+        the action (one of ACTIONS) on the 'action' key and the arguments of
+        it on the rest of the keys. Actions that are already queued are
+        ignored, and actions over a track that already has a different action
+        queued replace it.
+        '''
+        records = []
+
+        with self._lock:
+            queued = dict((self._action_key(action), action_id)
+                for action_id, action in self._actions.iteritems())
+
+            for action in actions:
+                key = self._action_key(action)
+
+                if key in queued:
+                    if self._actions[queued[key]] == action:
+                        continue
+
+                    # the newer action wins
+                    del self._actions[queued[key]]
+                    records.append({'op': 'done', 'id': queued[key]})
+
+                queued[key] = self._next_id
+                self._actions[self._next_id] = action
+                records.append({'op': 'push', 'id': self._next_id,
+                    'action': action})
+                self._next_id += 1
+
+            # written under the lock, so the worker can't journal an action
+            # as done (or drop the journal) before it's journaled as pushed
+            self._journal.append(*records)
+
+        self.emit('progress')
+
+        if self._network:
+            self._start_worker()
+
+    def stop(self):
+        '''
+        Stops the worker after the action being sent. The pending actions are
+        kept on the journal.
+        '''
+        self._stop = True
+        self._cancel_retry()
+
+    def _action_key(self, action):
+        # actions over the same track share the key, so they can be merged
+        if 'artist' in action and 'title' in action:
+            return make_key(action['artist'], action['title'])
+
+        return tuple(sorted(action.iteritems()))
+
+    def _cancel_retry(self):
+        if self._retry:
+            self._retry.cancel()
+            self._retry = None
+
+    def _schedule_retry(self):
+        print 'Last.fm unreachable, retrying in %d seconds' % self._retry_delay
+
+        self._retry = threading.Timer(self._retry_delay, self._start_worker)
+        self._retry.daemon = True
+        self._retry.start()
+
+        self._retry_delay = min(self._retry_delay * 2, RETRY_MAX)
+
+    def _start_worker(self):
+        with self._lock:
+            self._stop = False
+
+            if self._actions and not self._worker:
+                self._worker = threading.Thread(target=self._run)
+                self._worker.daemon = True
+                self._worker.start()
+
+    def _run(self):
+        started = time.time()
+        failed = False
+        self.sent = 0
+
+        while not self._stop and self._network:
+            with self._lock:
+                if not self._actions:
+                    break
+
+                action_id, action = next(self._actions.iteritems())
+
+            args = dict(action)
+            name = args.pop('action')
+            sent_at = time.time()
+
+            try:
+                ACTIONS[name](self._network, **args)
+            except pylast.WSError as e:
+                code = error_code(e)
+
+                if code in AUTH_ERRORS:
+                    # keep the actions until the user connects again
+                    session_rejected(e)
+                    self._network = None
+                    break
+
+                if code not in REJECTED_ERRORS:
+                    # offline, unavailable or rate limited; try again later
+                    print e
+                    failed = True
+                    break
+
+                # Last.fm rejected the action, retrying it won't help
+                print e
+                idle_add(self.emit, 'failed', action)
+            except Exception as e:
+                # leave the action on the queue and try again later
+                print e
+                failed = True
+                break
+            else:
+                self._retry_delay = RETRY_MIN
+
+            with self._lock:
+                self._actions.pop(action_id, None)
+                self._journal.append({'op': 'done', 'id': action_id})
+
+            self.sent += 1
+            self.rate = self.sent / max(time.time() - started, THROTTLE)
+            idle_add(self.emit, 'progress')
+
+            time.sleep(max(0, THROTTLE - (time.time() - sent_at)))
+
+        with self._lock:
+            self._worker = None
+
+            # nothing left to send, the journal can be dropped
+            if not self._actions:
+                self._journal.clear()
+
+        if not self._stop and self._network:
+            if failed:
+                self._schedule_retry()
+            else:
+                # actions could have been pushed while the worker was
+                # finishing
+                self._start_worker()
+
+        idle_add(self.emit, 'progress')
+
+    @classmethod
+    def initialise_instance(cls):
+        '''
+        Initializes the shared queue.
+        '''
+        if not cls.instance:
+            cls.instance = ActionQueue(QUEUE_FILE)
+
+    @classmethod
+    def destroy_instance(cls):
+        '''
+        Stops the shared queue.
+        '''
+        if cls.instance:
+            cls.instance.stop()
+            cls.instance = None
+
+    @classmethod
+    def get_instance(cls):
+        '''
+        Returns the shared queue.
+        '''
+        return cls.instance
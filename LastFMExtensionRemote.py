@@ -0,0 +1,479 @@
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+# Copyright (C) 2012 - Carrasco Agustin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+'''
+Client side of the protocol spoken by the fingerprint servers (see the
+--serve mode of matcher.py), that fingerprint songs for other machines. It's
+used by matcher.py, outside of Rhythmbox, so it MUST NOT import gi.
+
+The protocol is line based. The client sends json messages, one per line:
+- {"ping": true}, answered with {"pong": true, "jobs": <running jobs>}. When
+  the server has a secret, the first message MUST be a ping with it on the
+  secret key, or the connection is closed.
+- {"batch": [<request>, ...]}, where each request is the same of the worker
+  mode of matcher.py. Requests with a size key are followed (after the line
+  and in the same order) by that many bytes with the content of the file,
+  so the server doesn't need to see the client's files. Over TCP every
+  request MUST be uploaded, and files over MAX_UPLOAD bytes are refused.
+  When the duration of a song is known, only the beginning of the file that
+  the fingerprint needs is uploaded (see upload_size), and the request has
+  the duration key, as the server can't know it from the cut file.
+The server answers each request with a line with the same response of the
+worker mode, as soon as it's ready (not in the order of the batch).
+The addresses of the servers can be prefixed with the secret, like
+secret@host:port.
+'''
+
+from Queue import Queue, Empty
+
+import os
+import json
+import time
+import socket
+import struct
+import threading
+
+from LastFMExtensionDecoder import WINDOW
+
+# port used when a TCP address doesn't have one
+PORT = 7878
+
+# seconds to wait for a server to accept a connection and answer a ping
+CONNECT_TIMEOUT = 5
+
+# seconds before trying to connect again to a server that is down
+RETRY = 60
+
+# requests sent together on a batch, and seconds waited for more requests
+# before sending an incomplete batch
+BATCH_SIZE = 16
+BATCH_WAIT = 0.05
+
+# size of the chunks the files are sent in, and default maximum size of an
+# uploaded file
+UPLOAD_CHUNK = 64 * 1024
+MAX_UPLOAD = 256 << 20
+
+# seconds of audio uploaded when a file is cut: the window decoded for a
+# fingerprint, plus a margin as the bitrate of the files isn't constant
+UPLOAD_SECONDS = WINDOW * 1.2
+
+# formats that can be decoded after cutting them at any point
+TRUNCATABLE = ('.mp3', '.ogg', '.oga', '.opus', '.flac')
+
+
+class RemoteError(Exception):
+    '''
+    Error raised when a request couldn't be done by a server (because it's
+    down, the connection was lost or it didn't answer in time).
+    '''
+    pass
+
+
+def split_secret(address):
+    '''
+    Splits the secret (if any) from the address of a server. Returns a
+    (secret, address) tuple, with an empty secret if there isn't one.
+    '''
+    address = address.strip()
+
+    # UNIX socket paths can have an @ too
+    if '@' not in address.split('/')[0]:
+        return '', address
+
+    secret, _, address = address.partition('@')
+
+    return secret, address
+
+
+def metadata_size(path):
+    '''
+    Returns the size of the metadata at the beginning of a file (an ID3v2
+    tag or the FLAC metadata blocks), where the cover art usually is.
+    '''
+    with open(path, 'rb') as audio_file:
+        header = audio_file.read(10)
+
+        if header[:3] == 'ID3' and len(header) == 10:
+            # the size is a synchsafe integer, without the header or footer
+            size = 0
+
+            for byte in header[6:]:
+                size = size << 7 | ord(byte) & 0x7f
+
+            return 10 + size + (10 if ord(header[5]) & 0x10 else 0)
+
+        if header[:4] == 'fLaC':
+            offset = 4
+
+            while True:
+                audio_file.seek(offset)
+                block = audio_file.read(4)
+
+                if len(block) < 4:
+                    return offset
+
+                offset += 4 + struct.unpack('>I', '\0' + block[1:])[0]
+
+                # the first bit flags the last block
+                if ord(block[0]) & 0x80:
+                    return offset
+
+    return 0
+
+
+def upload_size(path, duration):
+    '''
+    Returns the amount of bytes to upload of a file so the server can decode
+    the fingerprint window: the metadata and the first UPLOAD_SECONDS of
+    audio, estimated from the duration. The whole file is uploaded when the
+    duration isn't known or the format can't be cut.
+    '''
+    size = os.path.getsize(path)
+
+    if not duration or duration <= UPLOAD_SECONDS or \
+        os.path.splitext(path)[1].lower() not in TRUNCATABLE:
+        return size
+
+    header = min(metadata_size(path), size)
+
+    return header + int((size - header) * UPLOAD_SECONDS / duration)
+
+
+def parse_address(address):
+    '''
+    Parses the address of a server, that is either host:port (or just host)
+    for TCP or the path of a UNIX socket (anything with a slash). Returns a
+    (host, port) tuple or the path.
+    '''
+    address = address.strip()
+
+    if '/' in address:
+        return address
+
+    host, _, port = address.rpartition(':')
+
+    if not host:
+        return address, PORT
+
+    return host, int(port)
+
+
+def connect(address, timeout=None):
+    '''
+    Opens a connection to a server.
+    '''
+    address = parse_address(address)
+
+    if isinstance(address, tuple):
+        return socket.create_connection(address, timeout)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(address)
+
+    return sock
+
+
+class RemoteJob(object):
+    '''
+    Request sent to a server, waiting for it's response.
+    '''
+
+    def __init__(self, client, request, upload):
+        super(RemoteJob, self).__init__()
+
+        self.client = client
+        self.request = request
+        self.upload = upload
+
+        self._done = threading.Event()
+        self._response = None
+        self._error = None
+
+    def wait(self, timeout=None):
+        '''
+        Waits for the response of the server and returns it. Raises a
+        RemoteError if the job failed, or if it didn't finish after timeout
+        seconds (the server is considered down then).
+        '''
+        if not self._done.wait(timeout):
+            self.client.fail('The server didn\'t answer in time')
+
+            raise RemoteError('The fingerprint server %s didn\'t answer in '
+                'time' % self.client.address)
+
+        if self._error:
+            raise self._error
+
+        return self._response
+
+    def finish(self, response=None, error=None):
+        self._response = response
+        self._error = error
+        self._done.set()
+
+
+class RemoteClient(object):
+    '''
+    Connection to a fingerprint server. The connection is opened (and the
+    server checked with a ping) when it's needed, and kept open for the next
+    requests. The requests submitted while the previous batch is being sent
+    are sent together in the next one, and the responses are read on another
+    thread, so a single connection serves all the workers.
+    When the server can't be reached or the connection is lost, the pending
+    requests fail and the server isn't tried again until RETRY seconds pass.
+    '''
+
+    def __init__(self, address):
+        super(RemoteClient, self).__init__()
+
+        # the secret is kept apart, so it isn't shown on the messages
+        self._secret, self.address = split_secret(address)
+
+        # the files are sent to servers on other machines
+        self.upload = isinstance(parse_address(self.address), tuple)
+
+        self._lock = threading.Lock()
+        self._socket = None
+        self._outbox = None
+        self._pending = {}
+        self._next_id = 0
+        self._down_until = 0
+
+    def healthy(self):
+        '''
+        Indicates if the server can be used, connecting to it if it's needed.
+        '''
+        with self._lock:
+            if self._socket:
+                return True
+
+            if time.time() < self._down_until:
+                return False
+
+            try:
+                sock = connect(self.address, CONNECT_TIMEOUT)
+                rfile = sock.makefile('rb')
+
+                sock.sendall(json.dumps({'ping': True,
+                    'secret': self._secret}) + '\n')
+
+                if not json.loads(rfile.readline()).get('pong'):
+                    raise ValueError('Unexpected answer to ping')
+
+                sock.settimeout(None)
+            except (socket.error, ValueError) as e:
+                print 'Fingerprint server %s is down: %s' % (self.address, e)
+                self._down_until = time.time() + RETRY
+
+                return False
+
+            self._socket = sock
+            self._outbox = Queue()
+
+            for target, args in ((self._receive, (sock, rfile)),
+                                 (self._send, (sock, self._outbox))):
+                thread = threading.Thread(target=target, args=args)
+                thread.daemon = True
+                thread.start()
+
+            return True
+
+    def submit(self, request):
+        '''
+        Sends a request to the server (on the next batch) and returns the
+        RemoteJob that will receive it's response. Raises a RemoteError if
+        the server is down.
+        '''
+        if not self.healthy():
+            raise RemoteError('The fingerprint server %s is down' %
+                self.address)
+
+        request = dict(request)
+        duration = request.pop('duration', None)
+
+        if self.upload:
+            request['size'] = upload_size(request['path'], duration)
+
+            if request['size'] > MAX_UPLOAD:
+                raise RemoteError('%s is too big to be uploaded' %
+                    request['path'])
+
+            if request['size'] < os.path.getsize(request['path']):
+                request['duration'] = duration
+
+        job = RemoteJob(self, request, self.upload)
+
+        with self._lock:
+            if not self._socket:
+                raise RemoteError('The connection with the fingerprint '
+                    'server %s was lost' % self.address)
+
+            request['id'] = self._next_id
+            self._next_id += 1
+
+            self._pending[request['id']] = job
+            self._outbox.put(job)
+
+        return job
+
+    def fail(self, reason):
+        '''
+        Drops the connection (failing the pending requests) and marks the
+        server as down.
+        '''
+        with self._lock:
+            sock = self._socket
+
+        if sock:
+            self._disconnect(sock, reason)
+
+    def close(self):
+        '''
+        Closes the connection with the server.
+        '''
+        self.fail('The client was closed')
+
+    def _disconnect(self, sock, reason):
+        with self._lock:
+            if self._socket is not sock:
+                return
+
+            self._socket = None
+            self._outbox.put(None)
+            self._down_until = time.time() + RETRY
+
+            pending = self._pending
+            self._pending = {}
+
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+        sock.close()
+
+        error = RemoteError('Lost the fingerprint server %s: %s' %
+            (self.address, reason))
+
+        for job in pending.itervalues():
+            job.finish(error=error)
+
+    def _send(self, sock, outbox):
+        while True:
+            jobs = [outbox.get()]
+
+            if jobs[0] is None:
+                break
+
+            # gather the requests submitted meanwhile
+            while len(jobs) < BATCH_SIZE:
+                try:
+                    job = outbox.get(timeout=BATCH_WAIT)
+                except Empty:
+                    break
+
+                if job is None:
+                    outbox.put(None)
+                    break
+
+                jobs.append(job)
+
+            try:
+                sock.sendall(json.dumps({'batch':
+                    [job.request for job in jobs]}) + '\n')
+
+                for job in jobs:
+                    if job.upload:
+                        self._upload(sock, job.request)
+            except (socket.error, IOError) as e:
+                self._disconnect(sock, str(e))
+                break
+
+    def _upload(self, sock, request):
+        remaining = request['size']
+
+        with open(request['path'], 'rb') as audio_file:
+            while remaining:
+                chunk = audio_file.read(min(remaining, UPLOAD_CHUNK))
+
+                # the file was truncated; keep the stream in sync anyway
+                if not chunk:
+                    chunk = '\0' * min(remaining, UPLOAD_CHUNK)
+
+                sock.sendall(chunk)
+                remaining -= len(chunk)
+
+    def _receive(self, sock, rfile):
+        try:
+            for line in iter(rfile.readline, ''):
+                response = json.loads(line)
+
+                with self._lock:
+                    job = self._pending.pop(response.get('id'), None)
+
+                if job:
+                    job.finish(response)
+
+            reason = 'The server closed the connection'
+        except (socket.error, ValueError) as e:
+            reason = str(e)
+
+        self._disconnect(sock, reason)
+
+
+class RemotePool(object):
+    '''
+    Set of fingerprint servers. The requests are distributed among the
+    healthy servers in turns.
+    '''
+
+    def __init__(self, addresses):
+        super(RemotePool, self).__init__()
+
+        self.clients = [RemoteClient(address) for address in addresses]
+
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def submit(self, request):
+        '''
+        Sends a request to the next healthy server and returns it's
+        RemoteJob. Raises a RemoteError if every server is down.
+        '''
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.clients)
+
+        for index in range(len(self.clients)):
+            client = self.clients[(start + index) % len(self.clients)]
+
+            try:
+                return client.submit(request)
+            except RemoteError:
+                continue
+
+        raise RemoteError('There is no fingerprint server available')
+
+    def close(self):
+        '''
+        Closes the connections with all the servers.
+        '''
+        for client in self.clients:
+            client.close()
@@ -0,0 +1,175 @@
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+# Copyright (C) 2012 - Carrasco Agustin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+'''
+Compact sketches of fingerprints, used to find near-duplicate songs without
+comparing every pair of them. It's used by matcher.py, outside of Rhythmbox,
+so it MUST NOT import gi.
+'''
+
+from collections import defaultdict
+
+import array
+
+# number of values on a sketch
+SKETCH_SIZE = 64
+
+# the sketch is split on BANDS bands of SKETCH_SIZE / BANDS values; two songs
+# are candidates if all the values of any of their bands are equal. With 16
+# bands of 4 values, songs with a similarity of 0.5 are found with a
+# probability of 0.64 and songs with 0.75 with a probability of 0.99
+BANDS = 16
+
+# minimum estimated similarity of two songs to consider them duplicates
+THRESHOLD = 0.5
+
+# value of the slots of a sketch no feature fell on
+EMPTY = 0xFFFFFFFF
+
+# odd constant used to scramble the features (golden ratio)
+MULTIPLIER = 0x9E3779B1
+
+
+def sketch(fpdata, size=SKETCH_SIZE):
+    '''
+    Returns the MinHash sketch of the fingerprint data returned by
+    lastfp.extract, as a list of size integers.
+    The data is read as a sequence of 32 bits words, the features of the song
+    are the distinct words and a single hash of each one is split on size
+    slots (one permutation hashing), so the sketch is computed on a single
+    pass over the data. The fraction of equal values on the sketches of two
+    songs estimates the Jaccard similarity of their features.
+    '''
+    words = array.array('I')
+    words.fromstring(fpdata[:len(fpdata) - len(fpdata) % words.itemsize])
+
+    values = [EMPTY] * size
+
+    for word in set(words):
+        value = (word * MULTIPLIER) & 0xFFFFFFFF
+        slot = value % size
+        value //= size
+
+        if value < values[slot]:
+            values[slot] = value
+
+    return values
+
+
+def similarity(sketch_a, sketch_b):
+    '''
+    Returns the estimated similarity (between 0 and 1) of the songs with the
+    given sketches. Slots empty on both sketches aren't taken into account.
+    '''
+    equal = total = 0
+
+    for value_a, value_b in zip(sketch_a, sketch_b):
+        if value_a == value_b == EMPTY:
+            continue
+
+        total += 1
+        equal += value_a == value_b
+
+    return float(equal) / total if total else 0.
+
+
+class LSHIndex(object):
+    '''
+    Locality-sensitive hashing index of sketches. Each band of a sketch is a
+    key of a table of buckets, so the songs that share a bucket with another
+    one are found in linear time instead of comparing every pair.
+    '''
+
+    def __init__(self, bands=BANDS):
+        super(LSHIndex, self).__init__()
+
+        self._bands = bands
+        self._sketches = {}
+        self._buckets = [defaultdict(list) for _ in range(bands)]
+
+    def __len__(self):
+        return len(self._sketches)
+
+    def add(self, key, sketch):
+        '''
+        Adds the sketch of a song to the index, identified by the given key.
+        '''
+        self._sketches[key] = sketch
+        rows = len(sketch) // self._bands
+
+        for band, buckets in enumerate(self._buckets):
+            band_values = tuple(sketch[band * rows:(band + 1) * rows])
+
+            # bands without features would join unrelated songs
+            if EMPTY not in band_values:
+                buckets[band_values].append(key)
+
+    def candidates(self):
+        '''
+        Returns the set of (key, key) pairs that share at least one bucket.
+        '''
+        pairs = set()
+
+        for buckets in self._buckets:
+            for keys in buckets.itervalues():
+                for index, key_a in enumerate(keys):
+                    for key_b in keys[index + 1:]:
+                        pairs.add((key_a, key_b) if key_a < key_b else
+                                  (key_b, key_a))
+
+        return pairs
+
+    def duplicates(self, threshold=THRESHOLD):
+        '''
+        Returns the groups of songs that look like duplicates, as lists of
+        (key, similarity) tuples (sorted by key), where similarity is the
+        highest estimated similarity of the song with another of the group.
+        Only the candidate pairs are compared, and the ones whose similarity
+        is below the threshold are discarded.
+        '''
+        parents = {}
+        best = defaultdict(float)
+
+        def find(key):
+            root = key
+
+            while parents.get(root, root) != root:
+                root = parents[root]
+
+            # compress the path, so the next searches are shorter
+            while key != root:
+                parents[key], key = root, parents[key]
+
+            return root
+
+        for key_a, key_b in self.candidates():
+            value = similarity(self._sketches[key_a], self._sketches[key_b])
+
+            if value < threshold:
+                continue
+
+            best[key_a] = max(best[key_a], value)
+            best[key_b] = max(best[key_b], value)
+            parents[find(key_a)] = find(key_b)
+
+        groups = defaultdict(list)
+
+        for key in best:
+            groups[find(key)].append((key, best[key]))
+
+        return [sorted(group) for group in groups.itervalues()]
@@ -0,0 +1,820 @@
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+# Copyright (C) 2012 - Carrasco Agustin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from gi.repository import RB, Gtk, GObject, GLib
+from collections import namedtuple, OrderedDict
+
+import math
+import time
+import threading
+import pylast
+
+from LastFMExtensionUtils import asynchronous_call as async, idle_add, \
+    bind_properties
+from LastFMExtensionJournal import Journal, Checkpoint
+from LastFMExtensionLibrary import LibraryIndex, normalize, make_key
+
+# sync strategies, in order of preference when they cost the same
+PER_TRACK = 'per-track'
+PER_ARTIST = 'per-artist'
+WHOLE_LIBRARY = 'whole-library'
+STRATEGIES = (PER_TRACK, PER_ARTIST, WHOLE_LIBRARY)
+
+# number of items requested on each page of the user's Last.fm items
+PAGE_SIZE = 50
+
+# seconds to wait for more new entries before syncing them, max amount of
+# entries synced together and max age (in seconds) of an entry to be new
+NEW_ENTRIES_DELAY = 10
+NEW_ENTRIES_BATCH = 1000
+NEW_ENTRY_AGE = 60 * 60
+
+# journal where the loved tracks are mirrored and seconds before the mirror
+# is refreshed from Last.fm
+LOVED_MIRROR_FILE = 'loved_tracks.mirror'
+LOVED_MIRROR_REFRESH = 24 * 60 * 60
+
+# plan chosen for a sync, with the estimated requests for every strategy
+SyncPlan = namedtuple('SyncPlan', ['strategy', 'requests', 'estimates'])
+
+# snapshot of an entry that is waiting to be synced
+PendingEntry = namedtuple('PendingEntry', ['location', 'artist', 'title'])
+
+
+def pages(items):
+    '''
+    Returns the number of pages needed to retrieve the given amount of items.
+    '''
+    return max(1, int(math.ceil(float(items) / PAGE_SIZE)))
+
+
+def plan_sync(local_count, artist_counts, remote_total,
+              strategies=STRATEGIES):
+    '''
+    Estimates the number of requests that each strategy needs to sync the
+    given local entries and returns a SyncPlan with the cheapest one.
+
+    Parameters:
+        local_count -- number of local entries to sync.
+        artist_counts -- dictionary with the number of local entries of each
+                         artist.
+        remote_total -- number of items on the user's Last.fm library.
+        strategies -- the strategies that can be used.
+    '''
+    estimates = {}
+
+    # one track.getInfo for each entry
+    if PER_TRACK in strategies:
+        estimates[PER_TRACK] = local_count
+
+    # the user's tracks of each artist, which can't be more than the ones on
+    # the whole library; the local entries are used as an estimation
+    if PER_ARTIST in strategies:
+        estimates[PER_ARTIST] = sum(pages(min(count, remote_total))
+            for count in artist_counts.itervalues())
+
+    # all the pages of the user's library
+    if WHOLE_LIBRARY in strategies:
+        estimates[WHOLE_LIBRARY] = pages(remote_total)
+
+    strategy = min(estimates,
+        key=lambda strategy: (estimates[strategy], STRATEGIES.index(strategy)))
+
+    return SyncPlan(strategy, estimates[strategy], estimates)
+
+
+def fetch_page(network, method, params, page, limit=PAGE_SIZE):
+    '''
+    Retrieves a page of a paginated Last.fm method.
+    Returns a tuple with the item nodes, the total amount of pages and the
+    total amount of items.
+    '''
+    params = dict(params, page=str(page), limit=str(limit))
+    doc = pylast._Request(network, method, params).execute()
+
+    main = doc.documentElement.getElementsByTagName('*')[0]
+
+    total_pages = pylast._number(main.getAttribute('totalPages') or
+        main.getAttribute('totalpages'))
+    total = pylast._number(main.getAttribute('total'))
+
+    nodes = [node for node in main.childNodes
+        if node.nodeType == node.ELEMENT_NODE]
+
+    return nodes, total_pages, total
+
+
+class FullSync(GObject.Object):
+    '''
+    Base class for the syncs that go through the whole library.
+    Before starting, the sync estimates the requests needed by each of the
+    strategies it supports (see plan_sync) and uses the cheapest one. The
+    progress is saved on a Checkpoint, so an interrupted sync can be resumed.
+
+    Subclasses must define the Last.fm method used to page through the user's
+    items, how to parse those items and how to fetch and apply the value of a
+    single track.
+    '''
+    # signals
+    __gsignals__ = {
+        'done': (GObject.SIGNAL_RUN_LAST, None, ())
+        }
+
+    progress = GObject.property(type=float, default=1)
+
+    # name used when logging, strategies supported and Last.fm paged method
+    name = 'FullSync'
+    strategies = (PER_TRACK, WHOLE_LIBRARY)
+    remote_method = None
+
+    # value applied to the entries not found when paging the user's items
+    # (None if nothing should be applied)
+    missing_value = None
+
+    def __init__(self, network, db, query_model, checkpoint, index):
+        '''
+        Parameters:
+            network -- the pylast network to use.
+            db -- the Rhythmbox database.
+            query_model -- query model (or list of rows) with the entries to
+                           sync.
+            checkpoint -- Checkpoint where the progress is saved.
+            index -- the LibraryIndex used to resolve the Last.fm names.
+        '''
+        super(FullSync, self).__init__()
+
+        self._network = network
+        self._db = db
+        self._query_model = query_model
+        self._checkpoint = checkpoint
+        self._index = index
+        self._cancel = False
+        self._errors = 0
+        self._user = None
+
+    def start(self):
+        '''
+        Starts the sync. It MUST be called from the Gtk main loop.
+        '''
+        # snapshot of the entries that weren't synced on a previous run
+        pending = []
+        total = 0
+
+        for row in self._query_model:
+            total += 1
+            entry = row[0]
+
+            if entry.get_string(RB.RhythmDBPropType.LOCATION) \
+                not in self._checkpoint.done and not self._is_fresh(entry):
+                pending.append(self._snapshot(entry))
+
+        if not pending:
+            self._checkpoint.clear()
+            self.progress = 1.
+            self.emit('done')
+            return
+
+        self._total = float(total)
+        self._synced = float(total - len(pending))
+        self.progress = self._synced / self._total
+
+        async(self._run, self._finished)(pending)
+
+    def cancel(self):
+        self._cancel = True
+
+    def plan(self, pending):
+        '''
+        Chooses the cheapest strategy to sync the pending entries.
+        '''
+        artist_counts = {}
+
+        for item in pending:
+            artist = normalize(item.artist)
+            artist_counts[artist] = artist_counts.get(artist, 0) + 1
+
+        if self.strategies == (PER_TRACK,):
+            remote_total = 0
+        else:
+            remote_total = fetch_page(self._network, self.remote_method,
+                {'user': self._user}, 1, 1)[2]
+
+        return plan_sync(len(pending), artist_counts, remote_total,
+            self.strategies)
+
+    def _is_fresh(self, entry):
+        '''
+        Indicates if an entry was synced recently enough to skip it. By
+        default, all the entries are synced.
+        '''
+        return False
+
+    def _snapshot(self, entry):
+        return PendingEntry(entry.get_string(RB.RhythmDBPropType.LOCATION),
+            unicode(entry.get_string(RB.RhythmDBPropType.ARTIST), 'utf-8'),
+            unicode(entry.get_string(RB.RhythmDBPropType.TITLE), 'utf-8'))
+
+    def _run(self, pending):
+        self._user = self._network.get_authenticated_user().get_name()
+
+        plan = self.plan(pending)
+
+        print '%s: syncing %d entries with the %s strategy (%d requests; ' \
+            'estimates: %s)' % (self.name, len(pending), plan.strategy,
+            plan.requests, ', '.join('%s=%d' % estimate
+                for estimate in plan.estimates.iteritems()))
+
+        if plan.strategy == PER_TRACK:
+            self._sync_per_track(pending)
+        elif plan.strategy == PER_ARTIST:
+            self._sync_per_artist(pending)
+        else:
+            self._sync_remote(pending, {})
+
+    def _finished(self, result):
+        if isinstance(result, Exception):
+            print result
+
+        # the checkpoint is only kept if the sync didn't reach the end, or if
+        # some entries couldn't be synced (so a resume only retries those)
+        elif self._errors:
+            print '%s: %d requests failed, some entries weren\'t synced' % (
+                self.name, self._errors)
+
+        elif not self._cancel:
+            self._checkpoint.clear()
+
+        idle_add(self.emit, 'done')
+
+    def _sync_per_track(self, pending):
+        for item in pending:
+            if self._cancel:
+                return
+
+            try:
+                value = self._fetch_track(
+                    self._network.get_track(item.artist, item.title))
+            except Exception as e:
+                # the track is left unmarked, to be synced on the next run
+                print '%s: couldn\'t sync %s - %s: %s' % (self.name,
+                    item.artist, item.title, e)
+                self._errors += 1
+                continue
+
+            if value is not None:
+                self._apply([(item.location, value)])
+
+            self._mark(item.location)
+
+    def _sync_per_artist(self, pending):
+        by_artist = {}
+
+        for item in pending:
+            by_artist.setdefault(normalize(item.artist), []).append(item)
+
+        for items in by_artist.itervalues():
+            if self._cancel:
+                return
+
+            # a failing artist doesn't stop the sync, its entries are just
+            # left unmarked
+            try:
+                self._sync_remote(items, {'artist': items[0].artist})
+            except Exception as e:
+                print '%s: couldn\'t sync %s: %s' % (self.name,
+                    items[0].artist, e)
+                self._errors += 1
+
+    def _sync_remote(self, pending, params):
+        '''
+        Pages through the user's items on Last.fm and applies them to the
+        pending entries, resolving the names through the library index.
+        '''
+        params['user'] = self._user
+        locations = set(item.location for item in pending)
+        found = set()
+        failed = False
+        synced = self._synced
+        page = total_pages = 1
+
+        while page <= total_pages:
+            if self._cancel:
+                return
+
+            try:
+                nodes, total_pages, _ = fetch_page(self._network,
+                    self.remote_method, params, page)
+            except Exception as e:
+                print '%s: couldn\'t fetch page %d: %s' % (self.name, page, e)
+                self._errors += 1
+                failed = True
+                page += 1
+                continue
+
+            values = [self._parse_node(node) for node in nodes]
+            resolved = self._index.resolve_many([pair for pair, _ in values])
+
+            updates = []
+
+            for pair, value in values:
+                for item in resolved.get(pair, ()):
+                    if item.location in locations:
+                        updates.append((item.location, value))
+
+            found.update(location for location, _ in updates)
+
+            self._apply(updates)
+            self._mark(*[location for location, _ in updates])
+
+            # the progress advances with the pages, not the matches
+            self._set_progress(max(self._synced,
+                synced + len(pending) * float(page) / max(total_pages, 1)))
+
+            page += 1
+
+        # the entries not found could be on the failed pages, so they are
+        # left unmarked to be synced on the next run
+        if failed:
+            return
+
+        # all the entries not found on Last.fm are synced too
+        if self.missing_value is not None:
+            self._apply([(location, self.missing_value)
+                for location in locations if location not in found])
+
+        self._mark(*locations)
+
+    def _mark(self, *locations):
+        '''
+        Saves the synced locations on the checkpoint and updates the progress.
+        '''
+        new = len([location for location in locations
+            if location not in self._checkpoint.done])
+
+        self._checkpoint.mark(int(self._synced + new), *locations)
+        self._synced += new
+
+        self._set_progress(self._synced)
+
+    def _set_progress(self, synced):
+        idle_add(self.set_property, 'progress', min(synced / self._total, 1.))
+
+    def _apply(self, updates):
+        if updates:
+            idle_add(self._apply_updates, updates)
+
+    def _apply_updates(self, updates):
+        for location, value in updates:
+            entry = self._db.entry_lookup_by_location(location)
+
+            if entry:
+                self._apply_value(entry, value)
+
+        self._db.commit()
+
+    def _parse_node(self, node):
+        '''
+        Parses an item node from the remote method and returns a tuple with
+        the (artist, title) pair and the value to apply to the entries.
+        '''
+        raise NotImplementedError()
+
+    def _fetch_track(self, track):
+        '''
+        Retrieves the value for a single pylast Track.
+        '''
+        raise NotImplementedError()
+
+    def _apply_value(self, entry, value):
+        '''
+        Applies a retrieved value to an entry. Always called from the Gtk main
+        loop.
+        '''
+        raise NotImplementedError()
+
+
+class SyncLedger(object):
+    '''
+    Compact record of the last sync of each entry, keyed by the entry
+    location. For each entry it saves the local and remote values after the
+    sync and when it happened, so later syncs can skip the entries that
+    didn't change and were confirmed recently.
+    The ledger is backed by a Journal, so it survives restarts.
+    '''
+
+    def __init__(self, name):
+        '''
+        Initialises the ledger. The journal is read the first time the ledger
+        is used.
+        '''
+        super(SyncLedger, self).__init__()
+
+        self._journal = Journal(name)
+        self._records = None
+        self._pending = []
+        self._appended = 0
+
+    def _load(self):
+        if self._records is None:
+            self._records = {}
+
+            for location, local, remote, timestamp in self._journal.load():
+                self._records[location] = (local, remote, timestamp)
+
+            self._appended = len(self._records)
+
+    def is_fresh(self, location, local, window):
+        '''
+        Indicates if the entry was synced less than window seconds ago and its
+        local value didn't change since then.
+        '''
+        self._load()
+        record = self._records.get(location)
+
+        return record is not None and record[0] == local and \
+            time.time() - record[2] < window
+
+    def record(self, location, local, remote):
+        '''
+        Records the sync of an entry. The record isn't saved until flush is
+        called.
+        '''
+        self._load()
+
+        record = (local, remote, int(time.time()))
+        self._records[location] = record
+        self._pending.append((location,) + record)
+
+    def flush(self):
+        '''
+        Saves the pending records. When the journal has grown to twice the
+        amount of entries on the ledger, it is compacted.
+        '''
+        if not self._pending:
+            return
+
+        self._appended += len(self._pending)
+
+        if self._appended > 2 * len(self._records):
+            self._journal.rewrite((location,) + record
+                for location, record in self._records.iteritems())
+            self._appended = len(self._records)
+        else:
+            self._journal.append(*self._pending)
+
+        self._pending = []
+
+
+class NewEntriesSync(object):
+    '''
+    Syncs the entries as they are added to the library, without going through
+    the whole library. New entries are queued and, once the additions calm
+    down (or the queue gets big enough), they are synced in batches with a
+    FullSync subclass, so big imports are reconciled with the bulk strategies.
+    '''
+
+    def __init__(self, db, entry_type, sync_class, **sync_args):
+        '''
+        Parameters:
+            db -- the Rhythmbox database.
+            entry_type -- the type of the entries to sync.
+            sync_class -- the FullSync subclass used to sync each batch.
+            sync_args -- extra keyword arguments for the sync_class.
+        '''
+        self.network = None
+        self._db = db
+        self._entry_type = entry_type
+        self._sync_class = sync_class
+        self._sync_args = sync_args
+        self._queue = OrderedDict()
+        self._source_id = None
+        self._signal_id = None
+        self._sync = None
+
+    def connect_signals(self):
+        '''
+        Starts listening to the entries added to the database.
+        '''
+        self._signal_id = self._db.connect('entry-added', self._entry_added)
+
+    def disconnect_signals(self):
+        '''
+        Stops listening to the database and drops the queued entries.
+        '''
+        self._db.disconnect(self._signal_id)
+        self._signal_id = None
+
+        if self._source_id:
+            GLib.source_remove(self._source_id)
+            self._source_id = None
+
+        if self._sync:
+            self._sync.cancel()
+
+        self._queue.clear()
+
+    def _entry_added(self, db, entry):
+        # only entries of the library that were just added (the db also emits
+        # the signal when it's loading the entries at startup)
+        if entry.get_entry_type() != self._entry_type:
+            return
+
+        first_seen = entry.get_ulong(RB.RhythmDBPropType.FIRST_SEEN)
+
+        if time.time() - first_seen > NEW_ENTRY_AGE:
+            return
+
+        self._queue[entry.get_string(RB.RhythmDBPropType.LOCATION)] = None
+
+        # wait for more entries unless there are enough for a batch
+        if self._source_id:
+            GLib.source_remove(self._source_id)
+
+        if len(self._queue) >= NEW_ENTRIES_BATCH:
+            self._source_id = GLib.idle_add(self._drain)
+        else:
+            self._source_id = GLib.timeout_add_seconds(NEW_ENTRIES_DELAY,
+                self._drain)
+
+    def _drain(self):
+        self._source_id = None
+
+        # wait until the running batch finishes
+        if self._sync or not self.network:
+            self._source_id = GLib.timeout_add_seconds(NEW_ENTRIES_DELAY,
+                self._drain)
+            return False
+
+        rows = []
+
+        while self._queue and len(rows) < NEW_ENTRIES_BATCH:
+            location = self._queue.popitem(last=False)[0]
+            entry = self._db.entry_lookup_by_location(location)
+
+            if entry:
+                rows.append((entry,))
+
+        if not rows:
+            return False
+
+        self._sync = self._sync_class(self.network, self._db, rows,
+            Checkpoint(), LibraryIndex.get_instance(), **self._sync_args)
+
+        def batch_done(sync):
+            self._sync = None
+
+            if self._queue and not self._source_id:
+                self._source_id = GLib.idle_add(self._drain)
+
+        self._sync.connect('done', batch_done)
+        self._sync.start()
+
+        return False
+
+
+class LovedMirror(object):
+    '''
+    Local mirror of the user's loved tracks, kept as a set of normalized
+    (artist, title) keys, so checking if a track is loved doesn't need a
+    request. The mirror is loaded in bulk from Last.fm and saved on a Journal,
+    so it's available right away after a restart.
+    The first record of the journal holds the time of the last full refresh;
+    the tracks loved from the player are appended after the keys.
+    '''
+
+    # unique instance of the mirror
+    instance = None
+
+    def __init__(self, name):
+        super(LovedMirror, self).__init__()
+
+        self._journal = Journal(name)
+        self._lock = threading.Lock()
+        self._keys = set()
+        self._refreshed = 0
+
+        for record in self._journal.load():
+            if isinstance(record, dict):
+                self._refreshed = record.get('refreshed', 0)
+            else:
+                self._keys.add(tuple(record))
+
+    @property
+    def ready(self):
+        '''
+        Indicates if the mirror was loaded from Last.fm at least once.
+        '''
+        return self._refreshed > 0
+
+    @property
+    def stale(self):
+        '''
+        Indicates if the mirror should be refreshed from Last.fm. Only the
+        full refreshes count, not the tracks added locally.
+        '''
+        return time.time() - self._refreshed > LOVED_MIRROR_REFRESH
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def is_loved(self, artist, title):
+        '''
+        Indicates if the given track is on the user's loved tracks.
+        '''
+        return make_key(artist, title) in self._keys
+
+    def keys(self):
+        '''
+        Returns a list with the keys of all the loved tracks.
+        '''
+        with self._lock:
+            return list(self._keys)
+
+    def add(self, artist, title):
+        '''
+        Adds a track to the mirror, for when it's loved from the player.
+        '''
+        key = make_key(artist, title)
+
+        with self._lock:
+            if key in self._keys:
+                return
+
+            self._keys.add(key)
+
+        self._journal.append(key)
+
+    def refresh(self, network):
+        '''
+        Reloads all the user's loved tracks from Last.fm. This method is
+        blocking, so it should be called asynchronously.
+        '''
+        loved = network.get_authenticated_user().get_loved_tracks(limit=None)
+        keys = set(make_key(loved_track.track.get_artist().get_name(),
+            loved_track.track.get_title()) for loved_track in loved)
+
+        refreshed = time.time()
+
+        with self._lock:
+            self._keys = keys
+            self._refreshed = refreshed
+
+        self._journal.rewrite([{'refreshed': refreshed}] + sorted(keys))
+
+    @classmethod
+    def get_instance(cls):
+        '''
+        Returns the shared mirror, creating it the first time.
+        '''
+        if not cls.instance:
+            cls.instance = LovedMirror(LOVED_MIRROR_FILE)
+
+        return cls.instance
+
+
+class FullSyncManager(object):
+    '''
+    Manages a FullSync and the widgets used to start/stop it from the plugin
+    preferences dialog.
+    '''
+
+    def __init__(self, db, query_model, sync_class, checkpoint_file,
+                 **sync_args):
+        '''
+        Parameters:
+            db -- the Rhythmbox database.
+            query_model -- query model with all the entries to sync.
+            sync_class -- the FullSync subclass to use.
+            checkpoint_file -- journal where the sync progress is saved.
+            sync_args -- extra keyword arguments for the sync_class.
+        '''
+        self._network = None
+        self._sync_args = sync_args
+        self._db = db
+        self._query_model = query_model
+        self._sync_class = sync_class
+        self._full_sync = None
+        self._box = None
+        self._start_widget = None
+        self._stop_widget = None
+        self._checkpoint = Checkpoint(checkpoint_file)
+
+    @property
+    def network(self):
+        return self._network
+
+    @network.setter
+    def network(self, network):
+        self._network = network
+
+        if self._start_widget:
+            idle_add(self._start_widget.set_sensitive, network is not None)
+
+    def _init_widgets(self, box):
+        self._box = box
+
+        # start widget
+        self._start_widget = Gtk.Button(margin_left=25)
+        self._update_start_label()
+
+        # stop widget
+        self._stop_widget = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL,
+            margin_left=25)
+
+        self._progress_bar = Gtk.ProgressBar()
+        self._stop_widget.pack_start(self._progress_bar, False, False, 0)
+
+        stop_button = Gtk.Button(label=_('Stop'), margin_left=5)
+        self._stop_widget.pack_start(stop_button, False, False, 0)
+
+        # callbacks for widgets
+        def do_full_sync(start_button):
+            # hide this button and show the other before starting, since the
+            # sync can be done right away (and swap them back)
+            self._swap_widgets(self._start_widget, self._stop_widget)
+
+            self._start_full_sync()
+
+        self._start_widget.connect('clicked', do_full_sync)
+
+        def cancel_full_sync(stop_button):
+            # cancel the sync
+            if self._full_sync:
+                self._full_sync.cancel()
+
+            # hide this widget and show the start button
+            self._update_start_label()
+            self._swap_widgets(self._stop_widget, self._start_widget)
+
+        stop_button.connect('clicked', cancel_full_sync)
+
+    def add_to_widget(self, box):
+        # choose and add the correct widget
+        self._init_widgets(box)
+
+        if self._full_sync:
+            self._wire_sync_progress()
+            box.pack_start(self._stop_widget, False, False, 0)
+        else:
+            box.pack_start(self._start_widget, False, False, 0)
+
+            if not self.network:
+                self._start_widget.set_sensitive(False)
+
+    def _swap_widgets(self, old, new):
+        if old.get_parent() is self._box:
+            self._box.remove(old)
+            self._box.pack_start(new, False, False, 0)
+            self._box.show_all()
+
+    def _update_start_label(self):
+        # let the user know if the sync will resume a previous run
+        if self._checkpoint.resumable:
+            self._start_widget.set_label(_('Resume full sync'))
+        else:
+            self._start_widget.set_label(_('Do a full sync'))
+
+    def _wire_sync_progress(self):
+        # connect the progress bar progress, starting from the work already
+        # done by a previous run
+        bind_properties(self._full_sync, self._progress_bar, 'progress',
+            'fraction')
+        self._progress_bar.set_fraction(self._full_sync.progress)
+
+    def _start_full_sync(self):
+        # create the sync
+        self._full_sync = self._sync_class(self._network, self._db,
+            self._query_model, self._checkpoint, LibraryIndex.get_instance(),
+            **self._sync_args)
+
+        # connect to the done signal
+        def full_sync_done(full_sync):
+            self._full_sync = None
+
+            if self._start_widget:
+                self._update_start_label()
+                self._swap_widgets(self._stop_widget, self._start_widget)
+
+        self._full_sync.connect('done', full_sync_done)
+
+        # show the progress and start the sync
+        self._wire_sync_progress()
+        self._full_sync.start()
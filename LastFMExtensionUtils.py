@@ -22,7 +22,10 @@ from gi.repository import GLib
 from gi.repository import Notify
 from ConfigParser import SafeConfigParser
 
+from Queue import Queue
+
 import os
+import time
 import threading
 import LastFMExtensionKeys
 
@@ -81,6 +84,140 @@ def idle_add(fun, *args):
 
     Gdk.threads_add_idle(GLib.PRIORITY_DEFAULT_IDLE, idle_call, args)
 
+class RequestTimeout(Exception):
+    '''
+    Raised when the result of a request isn't ready before it's deadline.
+    '''
+    pass
+
+class PendingRequest(object):
+    '''
+    Handle for a request submitted to the RequestExecutor.
+    '''
+
+    def __init__(self):
+        super(PendingRequest, self).__init__()
+
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def done(self):
+        ''' Indicates if the request already finished. '''
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        '''
+        Waits for the request to finish and returns it's result, raising the
+        exception thrown by it, if any. If timeout seconds pass and the request
+        didn't finish, raises RequestTimeout.
+        '''
+        if not self._done.wait(timeout):
+            raise RequestTimeout('The request didn\'t finish in time.')
+
+        if self._error:
+            raise self._error
+
+        return self._result
+
+    def _finish(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done.set()
+
+class RequestExecutor(object):
+    '''
+    Shared pool of threads to run blocking requests (usually to Last.fm)
+    concurrently, instead of one after another. Threads are started as they
+    are needed, up to the size of the pool.
+    '''
+
+    # unique instance of the executor
+    instance = None
+
+    # default number of threads
+    SIZE = 8
+
+    def __init__(self, size=SIZE):
+        super(RequestExecutor, self).__init__()
+
+        self._size = size
+        self._requests = Queue()
+        self._lock = threading.Lock()
+        self._threads = 0
+        self._idle = 0
+
+    def submit(self, fun, *args, **kwargs):
+        '''
+        Queues a call to fun with the given arguments. Returns a
+        PendingRequest to wait for it's result.
+        '''
+        pending = PendingRequest()
+        self._requests.put((pending, fun, args, kwargs))
+
+        with self._lock:
+            if self._requests.qsize() > self._idle and \
+               self._threads < self._size:
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+
+                self._threads += 1
+                self._idle += 1
+
+        return pending
+
+    def _run(self):
+        while True:
+            pending, fun, args, kwargs = self._requests.get()
+
+            with self._lock:
+                self._idle -= 1
+
+            try:
+                pending._finish(result=fun(*args, **kwargs))
+            except Exception as e:
+                pending._finish(error=e)
+
+            with self._lock:
+                self._idle += 1
+
+    @classmethod
+    def get_instance(cls):
+        '''
+        Returns the shared executor, creating it if it's needed.
+        '''
+        if not cls.instance:
+            cls.instance = RequestExecutor()
+
+        return cls.instance
+
+class Deadline(object):
+    '''
+    Deadline shared by several requests, to wait for their results without
+    exceeding a total time.
+    '''
+
+    def __init__(self, seconds):
+        super(Deadline, self).__init__()
+
+        self._end = time.time() + seconds
+
+    def remaining(self):
+        ''' Seconds left until the deadline (never negative). '''
+        return max(0, self._end - time.time())
+
+    def result(self, pending, default=None):
+        '''
+        Returns the result of a PendingRequest, or the default value if it
+        failed or didn't finish before the deadline.
+        '''
+        try:
+            return pending.result(self.remaining())
+        except Exception as e:
+            print e
+            return default
+
 def notify(title, text):
     '''
     Shows a desktop notification.
@@ -143,12 +280,21 @@ class Settings(SafeConfigParser, object):
 
         self._observers[section][option].append((callback, data))
 
+    def disconnect(self, section, option, callback):
+        observers = self._observers.get(section, {}).get(option, [])
+
+        for observer in observers:
+            if observer[0] == callback:
+                observers.remove(observer)
+                break
+
     def set(self, section, option, value=None):
         SafeConfigParser.set(self, section, option, str(value))
 
-        # comunicate the observers about the change
+        # comunicate the observers about the change (they may connect or
+        # disconnect observers meanwhile)
         if section in self._observers and option in self._observers[section]:
-            for callback, data in self._observers[section][option]:
+            for callback, data in list(self._observers[section][option]):
                 callback(value, *data)
 
         # save the settings on the disk
@@ -166,7 +312,7 @@ class SettingsSection(object):
             return getattr(self._settings, attr)(self._section, *args, **kwargs)
 
         if attr.startswith('get') or attr == 'has_option' or attr == 'set' or\
-            attr == 'connect':
+            attr == 'connect' or attr == 'disconnect':
             return call_with_section
 
         super(SettingsSection, self).__getattr__(self, attr)
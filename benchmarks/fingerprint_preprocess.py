@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""Benchmark of the PCM preprocessing done before extracting a fingerprint.
+Usage:
+
+    $ python benchmarks/fingerprint_preprocess.py path/to/wavs/
+
+For each WAV file of the directory, measures the CPU time spent feeding the
+extractor with the whole decoded stream (what lastfp.match_file did before)
+and with the window of blocks downmixed by NumPy and by audioop. When lastfp
+is installed, it also checks that every path extracts the same fingerprint
+data as the old one (the fpid is looked up from it); otherwise only the
+preprocessing is measured.
+"""
+import os, sys, time, wave
+from glob import glob
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+import LastFMExtensionDecoder as Decoder
+
+try:
+    import lastfp
+except ImportError:
+    lastfp = None
+
+class WavAudio(object):
+    '''
+    Minimal WAV reader with the same interface of the audioread files.
+    '''
+    def __init__(self, path):
+        self._wav = wave.open(path)
+
+        if self._wav.getsampwidth() != Decoder.SAMPLE_WIDTH:
+            raise ValueError('%s: only 16 bits WAVs are supported' % path)
+
+        self.samplerate = self._wav.getframerate()
+        self.channels = self._wav.getnchannels()
+        self.duration = self._wav.getnframes() / float(self.samplerate)
+
+    def __iter__(self):
+        while True:
+            block = self._wav.readframes(4096)
+
+            if not block:
+                break
+
+            yield block
+
+    def close(self):
+        self._wav.close()
+
+def match_file_blocks(audio):
+    # lastfp.match_file fed the whole decoded file to the extractor
+    return iter(audio), audio.samplerate, audio.channels
+
+def numpy_blocks(audio):
+    return Decoder.preprocessed_blocks(audio)
+
+def audioop_blocks(audio):
+    numpy, Decoder.numpy = Decoder.numpy, None
+
+    try:
+        return Decoder.preprocessed_blocks(audio)
+    finally:
+        Decoder.numpy = numpy
+
+def measure(path, pipeline):
+    '''
+    Returns the CPU time spent by a pipeline on a file and the fingerprint
+    data extracted (None without lastfp).
+    '''
+    audio = WavAudio(path)
+    start = time.clock()
+    fpdata = None
+
+    try:
+        blocks, samplerate, channels = pipeline(audio)
+
+        if lastfp:
+            fpdata = lastfp.extract(blocks, samplerate, channels)
+        else:
+            for _ in blocks:
+                pass
+    finally:
+        audio.close()
+
+    return time.clock() - start, fpdata
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print "usage: fingerprint_preprocess.py wavs_dir"
+        sys.exit(1)
+
+    pipelines = [('match_file', match_file_blocks),
+        ('audioop', audioop_blocks)]
+
+    if Decoder.numpy is not None:
+        pipelines.insert(1, ('numpy', numpy_blocks))
+
+    paths = sorted(glob(os.path.join(sys.argv[1], '*.wav')))
+    totals = dict((name, 0.) for name, _ in pipelines)
+    different = []
+
+    print '%-40s' % 'file' + ''.join('%12s' % name for name, _ in pipelines)
+
+    for path in paths:
+        results = [measure(path, pipeline) for _, pipeline in pipelines]
+
+        for (name, _), (cpu, fpdata) in zip(pipelines, results):
+            totals[name] += cpu
+
+            if fpdata != results[0][1]:
+                different.append((os.path.basename(path), name))
+
+        print '%-40s' % os.path.basename(path)[:40] + \
+            ''.join('%12.3f' % cpu for cpu, _ in results)
+
+    if paths:
+        print '%-40s' % 'mean' + ''.join('%12.3f' % (totals[name] / len(paths))
+            for name, _ in pipelines)
+
+    for name, pipeline in different:
+        print '%s: the %s fingerprint differs from match_file' % (name,
+            pipeline)
+
+    if not lastfp:
+        print '(lastfp not found, only the preprocessing was measured)'
@@ -19,17 +19,26 @@
 from gi.repository import RB, Gtk, Gio
 from urlparse import urlparse
 from urllib import unquote
-from subprocess import check_output, CalledProcessError
+from collections import OrderedDict
+from xml.sax.saxutils import escape
 import math
+import multiprocessing
 import rb
 
 import LastFMExtensionGui as GUI
 from lastfm_extension import LastFMExtension
 from LastFMExtensionGenreGuesser import LastFMGenreGuesser
-from LastFMExtensionUtils import asynchronous_call as async, idle_add
+from LastFMExtensionUtils import asynchronous_call as async, idle_add, \
+    notify, RequestExecutor, Deadline
+from LastFMExtensionFingerprintEngine import FingerprintPool, QUEUED, \
+    RUNNING
+from LastFMExtensionFingerprintCache import FingerprintCache
+from LastFMExtensionAlbumCache import AlbumTracklists
+from LastFMExtensionSketch import LSHIndex
+from LastFMExtensionRemote import RemotePool
+from LastFMExtensionFuzzyMatcher import pair_similarity
 import lastfm_extension
-import os
-import LastFMExtensionKeys
+import pylast
 
 # try to import lastfp
 class LastFMFingerprinterException(Exception):
@@ -43,16 +52,34 @@ except:
                                     'LastFM fingerprint library not found.')
 
 # constants
-DIALOG_BUILDER_FILE = 'lastfmExtensionFingerprintDialog.glade'
 MATCHER = 'matcher.py'
-DIALOG_NAME = 'song-selection-dialog'
-BOX = 'songe-selection-dialog-vbox'
-STATUS_BOX = 'statusBox'
-ACTION_SAVE = 'actionSave'
 
 # rhythmbox magic number for days in a year(??????)
 DAYS = 365.2
 
+# seconds to wait for the extra info of a track
+EXTRA_INFO_DEADLINE = 20
+
+# maximum difference (in seconds) between the duration of a song and the one
+# of a track found by it's tags to accept it without fingerprinting the song
+DURATION_TOLERANCE = 5
+
+# amount of search results checked against the duration of a song and the
+# seconds to wait for their durations
+SEARCH_CANDIDATES = 5
+SEARCH_DEADLINE = 15
+
+# journal where the fingerprint results are cached
+CACHE_FILE = 'fingerprints.cache'
+
+# settings keys
+WORKERS = 'workers'
+AUTO_ACCEPT = 'auto_accept'
+SERVERS = 'servers'
+
+# default minimum rank (as a percentage) to accept a match without review
+DEFAULT_AUTO_ACCEPT = 90
+
 # name and description
 NAME = "LastFMFingerprinter"
 DESCRIPTION = "Fingerprint your songs and match them against Last.FM."
@@ -62,23 +89,38 @@ ui_context_menu = """
   <popup name="BrowserSourceViewPopup">
 	 <placeholder name="PluginPlaceholder">
          <menuitem name="FingerprintSong" action="FingerprintSong"/>
+         <menuitem name="FingerprintBatch" action="FingerprintBatch"/>
+         <menuitem name="ReviewMatches" action="ReviewMatches"/>
      </placeholder>
   </popup>
   <popup name="PlaylistViewPopup">
 	 <placeholder name="PluginPlaceholder">
          <menuitem name="FingerprintSong" action="FingerprintSong"/>
+         <menuitem name="FingerprintBatch" action="FingerprintBatch"/>
+         <menuitem name="ReviewMatches" action="ReviewMatches"/>
      </placeholder>
   </popup>
   <popup name="QueuePlaylistViewPopup">
      <placeholder name="PluginPlaceholder">
 	     <menuitem name="FingerprintSong" action="FingerprintSong"/>
+         <menuitem name="FingerprintBatch" action="FingerprintBatch"/>
+         <menuitem name="ReviewMatches" action="ReviewMatches"/>
      </placeholder>
   </popup>
   <popup name="PodcastViewPopup">
      <placeholder name="PluginPlaceholder">
 	     <menuitem name="FingerprintSong" action="FingerprintSong"/>
+         <menuitem name="FingerprintBatch" action="FingerprintBatch"/>
+         <menuitem name="ReviewMatches" action="ReviewMatches"/>
      </placeholder>
   </popup>
+  <menubar name="MenuBar">
+    <menu name="ToolsMenu" action="Tools">
+      <placeholder name="ToolsOps">
+        <menuitem name="FindDuplicates" action="FindDuplicates"/>
+      </placeholder>
+    </menu>
+  </menubar>
 </ui>
 """
 
@@ -93,6 +135,22 @@ class Extension(LastFMExtension):
         Initialises the extension, using the base plugin to populate some of the
         internal properties used on the fingerprinting process.
         '''
+        # entries shown on the review window, indexed by location
+        self.queue = OrderedDict()
+        self.review_window = None
+
+        # entries being fingerprinted on batch mode and the ones whose
+        # matches need to be reviewed, with their results
+        self.batch = OrderedDict()
+        self.review = OrderedDict()
+        self.batch_stats = [0, 0]
+
+        # entries being scanned for duplicates, indexed by location, and the
+        # sketches already extracted
+        self.scan = {}
+        self.sketches = {}
+        self.duplicates_window = None
+
         super(Extension, self).__init__(plugin, settings)
 
         self.order = 3
@@ -103,17 +161,21 @@ class Extension(LastFMExtension):
         # rhythmbox shell
         self.shell = plugin.shell
 
+        # library model, scanned for duplicates
+        self.library_source = plugin.shell.props.library_source
+
         # lastfm genre guesser
         self.genre_guesser = LastFMGenreGuesser(plugin)
 
-        # save the matcher path
+        # save the matcher path and create the pool of workers that run it
         self.matcher_path = rb.find_plugin_file(plugin, MATCHER)
+        self.pool = FingerprintPool(self.matcher_path, self.workers)
+        self.result_id = self.pool.connect('result', self._result_ready)
+        self.progress_id = self.pool.connect('progress', self._pool_progress)
+        self.servers = self.servers
 
-        # get the builder file path
-        self.builder_file = rb.find_plugin_file(plugin, DIALOG_BUILDER_FILE)
-
-        # queue for requests
-        self.queue = []
+        # cache of the already fingerprinted files
+        self.cache = FingerprintCache(CACHE_FILE)
 
     def destroy(self, plugin):
         '''
@@ -125,8 +187,25 @@ class Extension(LastFMExtension):
         del self.shell
         del self.genre_guesser
         del self.matcher_path
-        del self.builder_file
+        self.pool.disconnect(self.result_id)
+        self.pool.disconnect(self.progress_id)
+
+        if self.pool.remote:
+            self.pool.remote.close()
+
+        del self.pool
+        del self.result_id
+        del self.progress_id
+        del self.cache
         del self.queue
+        del self.review_window
+        del self.batch
+        del self.review
+        del self.batch_stats
+        del self.scan
+        del self.sketches
+        del self.duplicates_window
+        del self.library_source
 
     @property
     def extension_name(self):
@@ -142,6 +221,70 @@ class Extension(LastFMExtension):
         '''
         return DESCRIPTION
 
+    @property
+    def workers(self):
+        '''
+        Number of songs fingerprinted at the same time. By default, one per
+        core.
+        '''
+        if not self.settings.has_option(WORKERS):
+            self.workers = multiprocessing.cpu_count()
+
+        return self.settings.getint(WORKERS)
+
+    @workers.setter
+    def workers(self, workers):
+        self.settings.set(WORKERS, workers)
+
+        try:
+            self.pool.size = workers
+        except AttributeError:
+            pass
+
+    @property
+    def auto_accept(self):
+        '''
+        Minimum rank (as a percentage) the top match of a song fingerprinted
+        on batch mode must have to be saved without reviewing it.
+        '''
+        if not self.settings.has_option(AUTO_ACCEPT):
+            self.auto_accept = DEFAULT_AUTO_ACCEPT
+
+        return self.settings.getint(AUTO_ACCEPT)
+
+    @auto_accept.setter
+    def auto_accept(self, auto_accept):
+        self.settings.set(AUTO_ACCEPT, auto_accept)
+
+    @property
+    def servers(self):
+        '''
+        Addresses of the fingerprint servers the songs are sent to (host:port,
+        secret@host:port or UNIX socket paths, separated by commas). Empty to
+        fingerprint them locally.
+        '''
+        if not self.settings.has_option(SERVERS):
+            self.servers = ''
+
+        return self.settings.get(SERVERS)
+
+    @servers.setter
+    def servers(self, servers):
+        self.settings.set(SERVERS, servers)
+
+        try:
+            pool = self.pool
+        except AttributeError:
+            return
+
+        if pool.remote:
+            pool.remote.close()
+
+        addresses = [address.strip() for address in servers.split(',')
+            if address.strip()]
+
+        pool.remote = RemotePool(addresses) if addresses else None
+
     @property
     def ui_str(self):
         '''
@@ -180,7 +323,26 @@ class Extension(LastFMExtension):
            rb.find_plugin_file(plugin, lastfm_extension.LASTFM_ICON)))
         self.action_fingerprint.set_gicon(icon)
 
+        self.action_batch = Gtk.Action('FingerprintBatch',
+            _('Fingerprint Songs in _Batch'),
+            _("Fingerprint the songs, saving the good matches without asking."),
+            None)
+        self.action_batch.set_gicon(icon)
+
+        self.action_review = Gtk.Action('ReviewMatches',
+            _('_Review Fingerprint Matches'),
+            _("Review the matches that couldn't be saved automatically."),
+            None, sensitive=False)
+
+        self.action_duplicates = Gtk.Action('FindDuplicates',
+            _('Find _Duplicate Songs'),
+            _("Find the songs of the library that sound the same."),
+            None)
+
         self.finger_action_group.add_action(self.action_fingerprint)
+        self.finger_action_group.add_action(self.action_batch)
+        self.finger_action_group.add_action(self.action_review)
+        self.finger_action_group.add_action(self.action_duplicates)
         plugin.uim.insert_action_group(self.finger_action_group, -1)
 
     def connect_signals(self, plugin):
@@ -192,6 +354,15 @@ class Extension(LastFMExtension):
         super(Extension, self).connect_signals(plugin)
         self.fp_id = self.action_fingerprint.connect('activate',
                                                       self.fingerprint_song)
+        self.batch_id = self.action_batch.connect('activate',
+            self.fingerprint_batch)
+        self.review_id = self.action_review.connect('activate',
+            self.review_matches)
+        self.duplicates_id = self.action_duplicates.connect('activate',
+            self.find_duplicates)
+
+        # there could be matches left for review from a previous batch
+        self.action_review.set_sensitive(len(self.review) > 0)
 
     def disconnect_signals(self, plugin):
         '''
@@ -202,9 +373,18 @@ class Extension(LastFMExtension):
 
         # disconnect signal
         self.action_fingerprint.disconnect(self.fp_id)
+        self.action_batch.disconnect(self.batch_id)
+        self.action_review.disconnect(self.review_id)
+        self.action_duplicates.disconnect(self.duplicates_id)
+
+        # stop the matcher workers until they are needed again
+        self.pool.stop()
 
         # delete variables
         del self.fp_id
+        del self.batch_id
+        del self.review_id
+        del self.duplicates_id
 
     def destroy_actions(self, plugin):
         '''
@@ -220,6 +400,9 @@ class Extension(LastFMExtension):
 
         # delete action
         del self.action_fingerprint
+        del self.action_batch
+        del self.action_review
+        del self.action_duplicates
 
     def fingerprint_song(self, _):
         '''
@@ -228,6 +411,55 @@ class Extension(LastFMExtension):
         for entry in self.get_selected_songs():
             self.request_fingerprint(entry)
 
+    def fingerprint_batch(self, _):
+        '''
+        Callback for the batch action of the different cm items.
+        '''
+        for entry in self.get_selected_songs():
+            self.request_fingerprint(entry, batch=True)
+
+    def review_matches(self, _):
+        '''
+        Callback for the review action. Shows on the review window the songs
+        fingerprinted on batch mode whose matches weren't good enough to be
+        saved automatically.
+        '''
+        window = self._get_review_window()
+
+        for location, (entry, result) in self.review.iteritems():
+            if location not in self.queue:
+                self.queue[location] = entry
+                window.add(location, entry)
+                window.set_result(location, result)
+
+        self.review.clear()
+        self.action_review.set_sensitive(False)
+
+    def find_duplicates(self, _):
+        '''
+        Callback for the find duplicates action. Extracts the sketch of the
+        fingerprint of every song of the library (without querying Last.fm)
+        and, once all of them are ready, shows the groups of songs that sound
+        the same.
+        '''
+        if self.scan:
+            return
+
+        for row in self.library_source.props.base_query_model:
+            entry = row[0]
+            location = entry.get_string(RB.RhythmDBPropType.LOCATION)
+
+            if not location.startswith('file://'):
+                continue
+
+            self.scan[location] = entry
+            self.pool.submit(('sketch', location), self._sketch,
+                unquote(urlparse(entry.get_playback_uri()).path),
+                entry.get_ulong(RB.RhythmDBPropType.DURATION))
+
+        notify('Looking for duplicates',
+            'Scanning %d songs, this may take a while' % len(self.scan))
+
     def get_selected_songs(self):
         '''
         Returns a list of the selected songs in the current view.
@@ -237,183 +469,397 @@ class Extension(LastFMExtension):
 
         return selected
 
-    def request_fingerprint(self, entry):
+    def request_fingerprint(self, entry, batch=False):
         '''
         This is this extension principal interface. This method should be called
         whenever it's needed to fingerprint a song.
-        It uses the extension queue system, to avoid multiple request to happen
-        at the same time.
+        The song is fingerprinted right away by the pool of workers and shown
+        on the review window, where it's matches are filled in as soon as
+        they are ready.
+        On batch mode the song isn't shown: the top match is saved if it's
+        rank is over the auto accept threshold, otherwise the song is left for
+        review. Songs identified by their tags are saved, as the match
+        already passed the name and duration checks.
         '''
-        if len(self.queue) == 0:
-            self._fingerprint(entry)
+        location = entry.get_string(RB.RhythmDBPropType.LOCATION)
 
-        self.queue.append(entry)
+        if location in self.queue or location in self.batch:
+            return
 
-    def _fingerprint(self, entry):
-        '''
-        This is the actual function that starts the fingerprinting.
-        It shows a Dialog to indicate the user to wait, and executes the
-        fingerprinting proccess asynchronously.
-        '''
-        # show the fingerprinter dialog
-        ui = self._show_dialog(entry)
+        if batch:
+            self.batch[location] = entry
+        else:
+            self.queue[location] = entry
+            self._get_review_window().add(location, entry)
 
         # get artist, album, track and path
         path = unquote(urlparse(entry.get_playback_uri()).path)
         artist = entry.get_string(RB.RhythmDBPropType.ARTIST)
         album = entry.get_string(RB.RhythmDBPropType.ALBUM)
         title = entry.get_string(RB.RhythmDBPropType.TITLE)
+        duration = entry.get_ulong(RB.RhythmDBPropType.DURATION)
 
-        # fingerprint and match the entry asynchronously
-        async(self._match, self._append_options, entry, *ui)(self.network,
-            path, artist, album, title)
+        # identify and match the entry on the pool; if it's already being
+        # matched, it's result is used
+        self.pool.submit(location, self._match, self.network, path, artist,
+            album, title, duration)
 
-    def _show_dialog(self, entry):
+    def _get_review_window(self):
         '''
-        Shows a wait dialog with the entry title and artist in the title.
-        This dialog is used to show the matching options after they are fetched.
+        Returns the review window, creating it if it isn't open.
         '''
-        # create a new builder over the builder_file
-        builder = Gtk.Builder()
-        builder.add_from_file(self.builder_file)
+        if not self.review_window:
+            self.review_window = ReviewWindow(self._save_selected,
+                self._close_review_window)
+            self._pool_progress(self.pool)
 
-        # connect signals
-        builder.connect_signals(self)
+        self.review_window.present()
 
-        # show the dialog
-        dialog = builder.get_object(DIALOG_NAME)
-        dialog.set_title('Matches for %s - %s' %
-		                    (entry.get_string(RB.RhythmDBPropType.ARTIST),
-		                      entry.get_string(RB.RhythmDBPropType.TITLE)))
-        dialog.present()
+        return self.review_window
 
-        # get the status box and the box
-        main_box = builder.get_object(BOX)
-        status_box = builder.get_object(STATUS_BOX)
-        action_save = builder.get_object(ACTION_SAVE)
+    def _result_ready(self, pool, location):
+        '''
+        Callback for when the pool finishes matching an entry.
+        '''
+        if isinstance(location, tuple):
+            self._sketch_ready(location)
+
+        elif location in self.batch:
+            self._batch_result(location)
+
+        elif location in self.queue:
+            self.review_window.set_result(location,
+                self.pool.results.pop(location))
+
+        else:
+            # the review window was closed before the result was ready
+            self.pool.results.pop(location)
+
+    def _pool_progress(self, pool):
+        '''
+        Callback for when a job of the pool changes it's state. Shows the
+        state of the workers on the review window.
+        '''
+        if self.review_window:
+            progress = pool.progress()
+            self.review_window.set_progress(progress[QUEUED],
+                progress[RUNNING])
+
+    def _batch_result(self, location):
+        '''
+        Saves the top match of an entry fingerprinted on batch mode if it's
+        good enough, or leaves it for review.
+        '''
+        entry = self.batch.pop(location)
+        result = self.pool.results.pop(location)
+
+        if isinstance(result, list) and result:
+            top = max(result, key=lambda track: track.rank)
+
+            # the rank of a track found by the tags isn't a fingerprint rank,
+            # so it isn't compared with the threshold: the track is only
+            # returned if it's names and duration match the song's ones
+            if getattr(top, 'from_tags', False) or \
+                top.rank * 100 >= self.auto_accept:
+                self._save_track(entry, top)
+                self.batch_stats[0] += 1
+            else:
+                self.review[location] = (entry, result)
+
+                if self.initialised:
+                    self.action_review.set_sensitive(True)
+        else:
+            self.batch_stats[1] += 1
 
-        return main_box, status_box, action_save
+        # inform the results once the batch is done
+        if not self.batch:
+            saved, failed = self.batch_stats
+            self.batch_stats = [0, 0]
 
-    def _match(self, network, path, artist, album, title):
+            notify('Batch fingerprint finished',
+                '%d songs saved, %d to review, %d without matches' %
+                (saved, len(self.review), failed))
+
+    def _match(self, worker, network, path, artist, album, title, duration):
         '''
-        This method encapsulates the fingerprinting and matching process.
-        It takes info from the entry to realize the fingerprinting and uses
-        pylast to retrieve the tracks info, which is finally returned as a list
-        of Track instances.
+        This method encapsulates the identification and matching process.
+        The cheapest ways to identify the song are tried first:
+        - The cached result of a previous fingerprint of the file (or a copy
+          of it), which doesn't decode it nor queries Last.fm.
+        - The tags of the song, corrected or searched on Last.fm. The track
+          found is only accepted if it's names are similar to the tags and
+          it's duration matches the song's one; otherwise the song is
+          fingerprinted.
+        - Fingerprinting the song, which uses pylast to retrieve the tracks
+          that match the fingerprint.
+        The result is returned as a list of Track instances.
         '''
-        # match the song
+        cached = self.cache.lookup(path)
+
+        if cached:
+            return [self._cached_track(network, *match)
+                for match in cached[1]]
+
         try:
-            environ = os.environ.copy()
-            environ['PYTHONPATH'] = os.path.dirname(
-                LastFMExtensionKeys.__file__)
+            track = self._lookup_tags(network, artist, title, duration)
+        except Exception as e:
+            # fall back to the fingerprint
+            print e
+            track = None
 
-            fpid = check_output(
-                [self.matcher_path, path, artist, album, title], env=environ)
+        if track:
+            return [track]
 
-            result = network.get_tracks_by_fpid(fpid)
+        # match the song; if the fingerprinter fails, it raises a
+        # FingerprintError with the reason
+        fpid = worker.fingerprint(path, artist, album, title, duration)
+        tracks = network.get_tracks_by_fpid(fpid)
 
-        except CalledProcessError as error:
-            # in the case the fingerprinter fails, raise an exception
-            raise Exception(error.output)
+        self.cache.store(path, fpid, [(track.get_artist().get_name(),
+            track.get_title(), track.rank) for track in tracks])
 
-        return result
+        return tracks
 
-    def _append_options(self, result, entry, main_box, status_box,
-                         action_save):
+    def _lookup_tags(self, network, artist, title, duration):
         '''
-        This method appends toggles buttons to the dialog, with the info of the
-        matched tracks and connects the signal to save the selected option.
+        Tries to identify a song by it's tags, asking Last.fm for the
+        correction of it's artist and title and, if that fails, searching the
+        title. Returns the first track whose artist and title are similar
+        enough to the tags (see pair_similarity) and whose duration is close
+        enough to the song's one, or None. The track is marked with from_tags
+        and ranked by how close it is, just to sort and show the matches.
         '''
-        # box which will contain the toggles
-        vbox = Gtk.VBox()
+        if not title or not duration:
+            return None
+
+        try:
+            corrected = network.get_track(artist, title).get_correction()
+        except pylast.WSError:
+            # the track is unknown to Last.fm
+            corrected = None
+
+        if corrected:
+            candidates = [corrected]
+        else:
+            candidates = pylast.TrackSearch(artist, title,
+                network).get_next_page()[:SEARCH_CANDIDATES]
+
+        # a search returns any track with a similar title, and a correction
+        # can point to a different track, so the names must still match
+        candidates = [(track, pair_similarity((artist, title),
+            (track.get_artist().get_name(), track.get_title())))
+            for track in candidates]
+        candidates = [(track, score) for track, score in candidates if score]
 
-        # if there where actual results
-        if type(result) is list and len(result) > 0:
-            # options list
-            options = []
+        # check the durations of the candidates at the same time
+        executor = RequestExecutor.get_instance()
+        deadline = Deadline(SEARCH_DEADLINE)
 
-            # for each option
-            for track in result:
-                # append the option and make sure they are all in the same group
-                label = '%d%%: %s' % (math.ceil(track.rank * 100), str(track))
+        durations = [executor.submit(track.get_duration)
+            for track, _ in candidates]
 
-                if not options:
-                    toggle = Gtk.RadioButton(label=label)
-                else:
-                    toggle = Gtk.RadioButton(label=label)
-                    toggle.join_group(options[0])
+        for (track, score), track_duration in zip(candidates, durations):
+            track_duration = deadline.result(track_duration)
 
-                options.append(toggle)
+            # Last.fm doesn't know the duration of every track
+            if not track_duration:
+                continue
 
-                toggle.set_mode(False)
-                vbox.pack_start(toggle, True, True, 0)
+            difference = abs(track_duration / 1000. - duration)
 
-            # also, add a checkbox to ask if fetch extra info
-            check_extra = Gtk.CheckButton('Fetch extra info?')
-            check_extra.set_tooltip_text('Fetch track playcount, rating, '
-                                          + 'genre, album name, track number '
-                                          + 'and release year')
+            if difference <= DURATION_TOLERANCE:
+                track.rank = score * \
+                    (1 - difference / (2. * DURATION_TOLERANCE))
+                track.from_tags = True
+                return track
 
-            vbox.pack_end(check_extra, True, True, 0)
+        return None
 
-            # connect and activate the save action
-            action_save.connect('activate', self._save_selected, entry, result,
-                                 main_box.get_parent(), options, check_extra)
-            idle_add(action_save.set_sensitive, True)
+    def _sketch(self, worker, path, duration):
+        '''
+        Returns the sketch of the fingerprint of a song, extracting it only
+        if it isn't cached.
+        '''
+        sketch = self.cache.lookup_sketch(path)
+
+        if sketch is None:
+            sketch = worker.sketch(path, duration)
+            self.cache.store_sketch(path, sketch)
+
+        return sketch
+
+    def _sketch_ready(self, key):
+        '''
+        Callback for when the sketch of a song being scanned for duplicates is
+        ready. Once all of them are, the duplicates are searched on another
+        thread.
+        '''
+        location = key[1]
+        result = self.pool.results.pop(key)
 
-        # if there weren't valid results
+        if isinstance(result, list):
+            self.sketches[location] = result
         else:
-            # if we catched and exception show the error, otherwise, indicate
-            # that there weren't matches
-            if type(result) is Exception:
-                label = Gtk.Label(result.message)
-            else:
-                label = Gtk.Label('No matches found.')
+            print result
 
-            vbox.pack_start(label, True, True, 0)
+        self.scan.pop(location, None)
 
-        # show the box
-        vbox.show_all()
+        if not self.scan:
+            sketches = self.sketches
+            self.sketches = {}
 
-        # delete the old box and append the new
-        idle_add(status_box.destroy)
-        idle_add(main_box.pack_start, vbox, True, True, 0)
+            async(self._group_duplicates, self._duplicates_found)(sketches)
 
-    def _close_fingerprinter_window(self, dialog):
+    def _group_duplicates(self, sketches):
         '''
-        Callback for closing the dialog.
+        Returns the groups of duplicate songs, using a LSHIndex of their
+        sketches so only the likely pairs are compared.
         '''
-        dialog.destroy()
+        index = LSHIndex()
+
+        for location, sketch in sketches.iteritems():
+            index.add(location, sketch)
 
-        self.queue.pop(0)
+        return index.duplicates()
 
-        if len(self.queue) > 0:
-            self._fingerprint(self.queue[0])
+    def _duplicates_found(self, groups):
+        '''
+        Callback used after the duplicates are grouped, to show them.
+        '''
+        idle_add(self._show_duplicates, groups)
 
-    def _save_selected(self, _, entry, tracks, dialog, options, extra):
+    def _show_duplicates(self, groups):
         '''
-        Callback for closing the dialog.
+        Shows the groups of duplicate songs on the duplicates window.
         '''
-        for option in options:
-            if option.get_active():
-                track = tracks[options.index(option)]
+        if isinstance(groups, Exception):
+            GUI.show_error_message(str(groups))
+            return
+
+        if not groups:
+            notify('Looking for duplicates', 'No duplicate songs were found')
+            return
+
+        if self.duplicates_window:
+            self.duplicates_window.window.destroy()
+
+        self.duplicates_window = DuplicatesWindow(self.db, groups,
+            self._play_entry, self._close_duplicates_window)
+
+    def _play_entry(self, entry):
+        self.shell.props.shell_player.play_entry(entry, self.library_source)
+
+    def _close_duplicates_window(self):
+        self.duplicates_window = None
+
+    def _cached_track(self, network, artist, title, rank):
+        track = pylast.Track(artist, title, network)
+        track.rank = rank
+
+        return track
+
+    def _close_review_window(self):
+        '''
+        Callback for when the review window is closed. The songs that weren't
+        saved are forgotten, and the ones still queued aren't fingerprinted.
+        '''
+        for location in self.queue:
+            self.pool.cancel(location)
+
+        self.review_window = None
+        self.queue.clear()
+
+    def _save_selected(self, location, entry, track, extra):
+        '''
+        Callback for when a match is saved on the review window.
+        '''
+        self._save_track(entry, track)
+        del self.queue[location]
+
+        # asynchronously retrieve extra data
+        if extra:
+            playcount = entry.get_ulong(RB.RhythmDBPropType.PLAY_COUNT)
+            async(self._fetch_extra_info,
+                self._delayed_properties_save, entry)(track, playcount)
+
+    def get_configuration_widget(self):
+        '''
+        Returns a GTK widget to be used as a configuration interface for the
+        extension on the plugin's preferences dialog. Besides the checkbox to
+        enable the extension, it allows to choose how many songs are
+        fingerprinted at the same time, the auto accept threshold of the
+        batch mode and the fingerprint servers.
+        '''
+        enable_widget = super(Extension, self).get_configuration_widget()[1]
+
+        # workers spin button
+        def workers_callback(spin):
+            self.workers = spin.get_value_as_int()
+
+        workers_spin = Gtk.SpinButton.new_with_range(1, 64, 1)
+        workers_spin.set_value(self.workers)
+        workers_spin.set_tooltip_text(_('Number of songs fingerprinted at '
+            'the same time'))
+        workers_spin.connect('value-changed', workers_callback)
+
+        workers_label = Gtk.Label(_('Fingerprint workers:'))
+
+        workers_box = Gtk.Box(spacing=5, margin_left=25)
+        workers_box.pack_start(workers_label, False, False, 0)
+        workers_box.pack_start(workers_spin, False, False, 0)
+
+        # auto accept spin button
+        def auto_accept_callback(spin):
+            self.auto_accept = spin.get_value_as_int()
+
+        auto_accept_spin = Gtk.SpinButton.new_with_range(0, 100, 1)
+        auto_accept_spin.set_value(self.auto_accept)
+        auto_accept_spin.set_tooltip_text(_('On batch mode, matches with '
+            'a lower rank are left for review'))
+        auto_accept_spin.connect('value-changed', auto_accept_callback)
+
+        auto_accept_label = Gtk.Label(_('Auto accept matches over (%):'))
 
-                self.db.entry_set(entry, RB.RhythmDBPropType.ARTIST,
-                                          track.get_artist().get_name().encode(
-                                                                      'utf8'))
-                self.db.entry_set(entry, RB.RhythmDBPropType.TITLE,
-                                          track.get_title().encode('utf8'))
-                self.db.commit()
+        auto_accept_box = Gtk.Box(spacing=5, margin_left=25)
+        auto_accept_box.pack_start(auto_accept_label, False, False, 0)
+        auto_accept_box.pack_start(auto_accept_spin, False, False, 0)
 
-                # asynchronously retrieve extra data
-                if extra.get_active():
-                    playcount = entry.get_ulong(RB.RhythmDBPropType.PLAY_COUNT)
-                    async(self._fetch_extra_info,
-                        self._delayed_properties_save, entry)(track, playcount)
+        # fingerprint servers entry
+        def servers_callback(entry, *args):
+            if entry.get_text() != self.servers:
+                self.servers = entry.get_text()
 
-                break
+        servers_entry = Gtk.Entry(text=self.servers)
+        servers_entry.set_tooltip_text(_('Addresses (host:port, '
+            'secret@host:port or socket paths, separated by commas) of the '
+            'servers that fingerprint the songs. Leave it empty to '
+            'fingerprint them on this machine'))
+        servers_entry.connect('activate', servers_callback)
+        servers_entry.connect('focus-out-event', servers_callback)
 
-        self._close_fingerprinter_window(dialog)
+        servers_label = Gtk.Label(_('Fingerprint servers:'))
+
+        servers_box = Gtk.Box(spacing=5, margin_left=25)
+        servers_box.pack_start(servers_label, False, False, 0)
+        servers_box.pack_start(servers_entry, True, True, 0)
+
+        widget = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        widget.pack_start(enable_widget, False, False, 0)
+        widget.pack_start(workers_box, False, False, 0)
+        widget.pack_start(auto_accept_box, False, False, 0)
+        widget.pack_start(servers_box, False, False, 0)
+
+        return _('General'), widget
+
+    def _save_track(self, entry, track):
+        '''
+        Saves the artist and title of a matched track on the entry.
+        '''
+        self.db.entry_set(entry, RB.RhythmDBPropType.ARTIST,
+            track.get_artist().get_name().encode('utf8'))
+        self.db.entry_set(entry, RB.RhythmDBPropType.TITLE,
+            track.get_title().encode('utf8'))
+        self.db.commit()
 
     def _fetch_extra_info(self, track, old_playcount):
         '''
@@ -427,36 +873,52 @@ class Extension(LastFMExtension):
             - Album Artist
             - Track Number
             - Track Genre
+        The requests run concurrently on the shared RequestExecutor (only the
+        album data waits for the album), and whatever isn't ready before
+        EXTRA_INFO_DEADLINE is skipped.
         '''
+        executor = RequestExecutor.get_instance()
+        deadline = Deadline(EXTRA_INFO_DEADLINE)
+
+        # fire all the independent requests at once
+        playcount = executor.submit(track.get_playcount, True)
+        genre = executor.submit(self.genre_guesser.guess, track)
+        loved = executor.submit(track.is_loved)
+        album = deadline.result(executor.submit(track.get_album))
+
+        if album:
+            date = executor.submit(album.get_release_date)
+            track_number = executor.submit(
+                AlbumTracklists.get_instance().track_number, album,
+                track.get_title())
+
         # list for extra info with it's db keys
         info = []
 
         # play count - only add if it's bigger than the old playcount
-        new_playcount = track.get_playcount(True)
+        new_playcount = deadline.result(playcount, 0)
 
         if new_playcount > old_playcount:
             info.append((RB.RhythmDBPropType.PLAY_COUNT, new_playcount))
 
         # genre
-        genre = self.genre_guesser.guess(track)
+        genre = deadline.result(genre)
 
         if genre:
             info.append((RB.RhythmDBPropType.GENRE, genre.encode('utf-8')))
 
         # loved track (rating 5 stars)
-        if track.is_loved():
+        if deadline.result(loved, False):
             info.append((RB.RhythmDBPropType.RATING, 5))
 
         # album data
-        album = track.get_album()
-
         if album:
             # album name
             info.append((RB.RhythmDBPropType.ALBUM,
                           album.get_name().encode('utf-8')))
 
             # release date (year)
-            date = album.get_release_date()
+            date = deadline.result(date, '')
 
             if date.strip() != '':
                 info.append((RB.RhythmDBPropType.DATE,
@@ -467,13 +929,10 @@ class Extension(LastFMExtension):
                           album.get_artist().get_name().encode('utf-8')))
 
             # track number
-            tracks = album.get_tracks()
+            track_number = deadline.result(track_number)
 
-            for track_number in range(0, len(tracks)):
-                if track == tracks[track_number]:
-                    break
-
-            info.append((RB.RhythmDBPropType.TRACK_NUMBER, track_number + 1))
+            if track_number:
+                info.append((RB.RhythmDBPropType.TRACK_NUMBER, track_number))
 
         return info
 
@@ -489,3 +948,356 @@ class Extension(LastFMExtension):
             self.db.commit()
 
         idle_add(do_save, info, entry)
+
+
+class ReviewWindow(object):
+    '''
+    Window where the matches of all the fingerprinted songs are reviewed.
+    Each song is a row of a Gtk.TreeStore with it's matches as children, so
+    a single window (and a single model) holds all the results, and they are
+    filled in incrementally as they arrive.
+    '''
+
+    # model columns
+    (LOCATION, TEXT, RANK, ACTIVE, MATCH, INDEX) = range(6)
+
+    def __init__(self, save_callback, close_callback):
+        '''
+        Creates the window.
+
+        Parameters:
+            save_callback -- function called for each saved song, with the
+                             location, the entry, the chosen Track and whether
+                             the extra info should be fetched.
+            close_callback -- function called when the window is closed.
+        '''
+        super(ReviewWindow, self).__init__()
+
+        self._save_callback = save_callback
+        self._close_callback = close_callback
+
+        # location -> (row reference, entry, matches)
+        self._rows = {}
+        self._waiting = 0
+
+        # state of the workers
+        self._queued = 0
+        self._running = 0
+
+        self.model = Gtk.TreeStore(str, str, str, bool, bool, int)
+
+        # build the view; fixed sizes keep it fast with lots of rows
+        view = Gtk.TreeView(model=self.model)
+        view.set_fixed_height_mode(True)
+
+        toggle = Gtk.CellRendererToggle()
+        toggle.connect('toggled', self._toggled)
+        column = Gtk.TreeViewColumn('', toggle, active=self.ACTIVE,
+            radio=self.MATCH)
+        column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        column.set_fixed_width(50)
+        view.append_column(column)
+
+        column = Gtk.TreeViewColumn(_('Song'), Gtk.CellRendererText(),
+            markup=self.TEXT)
+        column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        column.set_fixed_width(450)
+        column.set_expand(True)
+        view.append_column(column)
+
+        column = Gtk.TreeViewColumn(_('Rank'), Gtk.CellRendererText(),
+            text=self.RANK)
+        column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        column.set_fixed_width(60)
+        view.append_column(column)
+
+        scrolled = Gtk.ScrolledWindow()
+        scrolled.add(view)
+
+        # status and buttons
+        self._status = Gtk.Label(xalign=0)
+
+        self._extra = Gtk.CheckButton(_('Fetch extra info?'))
+        self._extra.set_tooltip_text(_('Fetch track playcount, rating, genre, '
+            'album name, track number and release year'))
+
+        save_button = Gtk.Button(label=_('Save'))
+        save_button.connect('clicked', self._save)
+
+        close_button = Gtk.Button(label=_('Close'))
+        close_button.connect('clicked', lambda *_: self.window.destroy())
+
+        buttons = Gtk.Box(spacing=5)
+        buttons.pack_start(self._status, True, True, 0)
+        buttons.pack_start(self._extra, False, False, 0)
+        buttons.pack_start(save_button, False, False, 0)
+        buttons.pack_start(close_button, False, False, 0)
+
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=5,
+            border_width=5)
+        box.pack_start(scrolled, True, True, 0)
+        box.pack_start(buttons, False, False, 0)
+
+        self.window = Gtk.Window(title=_('Fingerprint matches'),
+            default_width=600, default_height=400)
+        self.window.add(box)
+        self.window.connect('destroy', self._destroyed)
+        self.window.show_all()
+
+        self._update_status()
+
+    def present(self):
+        self.window.present()
+
+    def add(self, location, entry):
+        '''
+        Adds a song to the window, waiting for it's matches.
+        '''
+        if location in self._rows:
+            return
+
+        text = u'%s  <i>%s</i>' % (self._song_text(entry),
+            _('Fingerprinting...'))
+
+        tree_iter = self.model.append(None,
+            (location, text, '', False, False, -1))
+        reference = Gtk.TreeRowReference.new(self.model,
+            self.model.get_path(tree_iter))
+
+        self._rows[location] = (reference, entry, None)
+        self._waiting += 1
+        self._update_status()
+
+    def set_result(self, location, result):
+        '''
+        Fills in the matches of a song. The result is either a list of Track
+        instances or the Exception raised while matching the song.
+        '''
+        if location not in self._rows:
+            return
+
+        reference, entry, matches = self._rows[location]
+
+        if matches is not None:
+            return
+
+        tree_iter = self.model.get_iter(reference.get_path())
+        text = self._song_text(entry)
+
+        if isinstance(result, list) and result:
+            matches = sorted(result, key=lambda track: track.rank,
+                reverse=True)
+
+            for index, track in enumerate(matches):
+                self.model.append(tree_iter, (location,
+                    escape(u'%s - %s' % (track.get_artist().get_name(),
+                        track.get_title())),
+                    '%d%%' % math.ceil(track.rank * 100), index == 0, True,
+                    index))
+
+            self.model.set(tree_iter, self.TEXT, text, self.ACTIVE, True)
+        else:
+            if isinstance(result, Exception):
+                message = unicode(str(result), 'utf-8', 'replace')
+            else:
+                message = _('No matches found.')
+
+            matches = []
+            self.model.set(tree_iter, self.TEXT,
+                u'%s  <i>%s</i>' % (text, escape(message)))
+
+        self._rows[location] = (reference, entry, matches)
+        self._waiting -= 1
+        self._update_status()
+
+    def remove(self, location):
+        '''
+        Removes a song from the window.
+        '''
+        reference, _, matches = self._rows.pop(location)
+
+        self.model.remove(self.model.get_iter(reference.get_path()))
+
+        if matches is None:
+            self._waiting -= 1
+
+        self._update_status()
+
+    def _song_text(self, entry):
+        return u'<b>%s - %s</b>' % tuple(escape(unicode(entry.get_string(prop),
+            'utf-8')) for prop in (RB.RhythmDBPropType.ARTIST,
+                                   RB.RhythmDBPropType.TITLE))
+
+    def set_progress(self, queued, running):
+        '''
+        Shows the amount of songs queued and being fingerprinted by the
+        workers (including the ones fingerprinted on batch mode).
+        '''
+        self._queued = queued
+        self._running = running
+        self._update_status()
+
+    def _update_status(self):
+        self._status.set_text(_('%d songs, %d waiting for matches '
+            '(%d queued, %d fingerprinting)') % (len(self._rows),
+            self._waiting, self._queued, self._running))
+
+    def _toggled(self, renderer, path):
+        tree_iter = self.model.get_iter(path)
+        parent = self.model.iter_parent(tree_iter)
+
+        if parent:
+            # a match was chosen; unselect it's siblings and the song
+            child = self.model.iter_children(parent)
+
+            while child:
+                self.model.set_value(child, self.ACTIVE, False)
+                child = self.model.iter_next(child)
+
+            self.model.set_value(tree_iter, self.ACTIVE, True)
+            self.model.set_value(parent, self.ACTIVE, True)
+
+        elif self.model.iter_has_child(tree_iter):
+            active = self.model.get_value(tree_iter, self.ACTIVE)
+            self.model.set_value(tree_iter, self.ACTIVE, not active)
+
+    def _save(self, *args):
+        '''
+        Saves the chosen match of every selected song and removes them from
+        the window.
+        '''
+        saved = []
+        extra = self._extra.get_active()
+
+        for location, (reference, entry, matches) in self._rows.iteritems():
+            if not matches:
+                continue
+
+            tree_iter = self.model.get_iter(reference.get_path())
+
+            if not self.model.get_value(tree_iter, self.ACTIVE):
+                continue
+
+            child = self.model.iter_children(tree_iter)
+
+            while child:
+                if self.model.get_value(child, self.ACTIVE):
+                    index = self.model.get_value(child, self.INDEX)
+                    self._save_callback(location, entry, matches[index],
+                        extra)
+                    saved.append(location)
+                    break
+
+                child = self.model.iter_next(child)
+
+        for location in saved:
+            self.remove(location)
+
+    def _destroyed(self, *args):
+        self._rows = {}
+        self._close_callback()
+
+
+class DuplicatesWindow(object):
+    '''
+    Window that lists the groups of songs that sound the same, so they can be
+    reviewed. Each group is a row of a Gtk.TreeStore with it's songs as
+    children; activating a song plays it.
+    '''
+
+    # model columns
+    (LOCATION, TEXT, SIMILARITY) = range(3)
+
+    def __init__(self, db, groups, play_callback, close_callback):
+        '''
+        Creates the window.
+
+        Parameters:
+            db -- the Rhythmbox database, to find the entries of the songs.
+            groups -- list of groups of (location, similarity) tuples.
+            play_callback -- function called with the entry of an activated
+                             song.
+            close_callback -- function called when the window is closed.
+        '''
+        super(DuplicatesWindow, self).__init__()
+
+        self._db = db
+        self._play_callback = play_callback
+        self._close_callback = close_callback
+
+        self.model = Gtk.TreeStore(str, str, str)
+
+        songs = 0
+
+        for number, group in enumerate(groups, 1):
+            tree_iter = self.model.append(None, (None,
+                _('<b>Group %d</b> (%d songs)') % (number, len(group)), ''))
+
+            for location, similarity in group:
+                self.model.append(tree_iter, (location,
+                    self._song_text(location),
+                    '%d%%' % math.floor(similarity * 100)))
+
+            songs += len(group)
+
+        view = Gtk.TreeView(model=self.model)
+        view.set_fixed_height_mode(True)
+        view.connect('row-activated', self._activated)
+
+        column = Gtk.TreeViewColumn(_('Song'), Gtk.CellRendererText(),
+            markup=self.TEXT)
+        column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        column.set_fixed_width(500)
+        column.set_expand(True)
+        view.append_column(column)
+
+        column = Gtk.TreeViewColumn(_('Similarity'), Gtk.CellRendererText(),
+            text=self.SIMILARITY)
+        column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        column.set_fixed_width(80)
+        view.append_column(column)
+
+        view.expand_all()
+
+        scrolled = Gtk.ScrolledWindow()
+        scrolled.add(view)
+
+        status = Gtk.Label(xalign=0,
+            label=_('%d songs on %d groups') % (songs, len(groups)))
+
+        close_button = Gtk.Button(label=_('Close'))
+        close_button.connect('clicked', lambda *_: self.window.destroy())
+
+        buttons = Gtk.Box(spacing=5)
+        buttons.pack_start(status, True, True, 0)
+        buttons.pack_start(close_button, False, False, 0)
+
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=5,
+            border_width=5)
+        box.pack_start(scrolled, True, True, 0)
+        box.pack_start(buttons, False, False, 0)
+
+        self.window = Gtk.Window(title=_('Duplicate songs'),
+            default_width=600, default_height=400)
+        self.window.add(box)
+        self.window.connect('destroy', lambda *_: self._close_callback())
+        self.window.show_all()
+
+    def _song_text(self, location):
+        entry = self._db.entry_lookup_by_location(location)
+        path = unquote(urlparse(location).path)
+
+        if not entry:
+            return escape(unicode(path, 'utf-8', 'replace'))
+
+        return u'%s - %s  <small>%s</small>' % tuple(
+            escape(unicode(text, 'utf-8', 'replace')) for text in (
+                entry.get_string(RB.RhythmDBPropType.ARTIST),
+                entry.get_string(RB.RhythmDBPropType.TITLE), path))
+
+    def _activated(self, view, path, column):
+        location = self.model[path][self.LOCATION]
+        entry = location and self._db.entry_lookup_by_location(location)
+
+        if entry:
+            self._play_callback(entry)
@@ -21,7 +21,8 @@ from gi.repository import Gtk, Gio, RB
 
 import rb
 
-from LastFMExtensionUtils import asynchronous_call as async, notify, idle_add
+from LastFMExtensionUtils import notify
+from LastFMExtensionQueue import ActionQueue
 
 # name and description
 NAME = "LastFMLoveBan"
@@ -164,6 +165,10 @@ class Extension(LastFMExtensionWithPlayer):
         # signal for baning a track
         self.ban_id = self.action_ban.connect('activate', self._ban_track)
 
+        # signal for the actions rejected by Last.fm
+        self.failed_id = ActionQueue.get_instance().connect('failed',
+            self._action_failed)
+
     def disconnect_signals(self, plugin):
         '''
         Disconnects all the signals connected by the extension.
@@ -174,10 +179,12 @@ class Extension(LastFMExtensionWithPlayer):
         # disconnect signals
         self.action_love.disconnect(self.love_id)
         self.action_ban.disconnect(self.ban_id)
+        ActionQueue.get_instance().disconnect(self.failed_id)
 
         # delete variables
         del self.love_id
         del self.ban_id
+        del self.failed_id
 
     def destroy_actions(self, plugin):
         '''
@@ -252,70 +259,51 @@ class Extension(LastFMExtensionWithPlayer):
         Callback for when the Love action is called. It initiates the process
         for loving a track.
         '''
-        entry, track = self.get_current_track()
-
-        if not entry or not track:
-            return
+        self._queue_action('love', 5, 'Loved track',
+            'You just marked the track %s - %s as loved')
 
-        async(track.love, self._track_loved, track, entry)()
+    def _ban_track(self, _):
+        '''
+        Callback for when the Ban action is called. It initiates the process
+        for banning a track.
+        '''
+        self._queue_action('ban', 0, 'Banned track',
+            'You just marked the track %s - %s as banned')
 
-    def _track_loved(self, result, track, entry):
+    def _queue_action(self, action, rating, titulo, texto):
         '''
-        Callback for when the track is finally marked as loved or when the
-        action failed for some reason. It informs the user of the result of
-        the action.
+        Changes the rating of the playing entry right away and queues the
+        action to be sent to Last.fm. The queue retries the action until the
+        network is back, even after restarting Rhythmbox.
         '''
-        # show a different message for fail/success
-        if isinstance(result, Exception):
-            titulo = 'Failed to love track'
-            texto = 'There was an error in the connection while ' + \
-                    'trying to mark the track as loved.'
+        entry = self.player.get_playing_entry()
 
-            print result
-        else:
-            titulo = 'Loved track'
-            texto = 'You just marked the track %s - %s as loved' % \
-              (track.get_title().encode('utf-8'), track.get_artist())
+        if not entry:
+            return
 
-            # bonus: 5 stars to the loved track
-            idle_add(self._set_rating, entry, 5)
+        title = unicode(entry.get_string(RB.RhythmDBPropType.TITLE), 'utf-8')
+        artist = unicode(entry.get_string(RB.RhythmDBPropType.ARTIST),
+            'utf-8')
 
-        notify(titulo, texto)
+        self._set_rating(entry, rating)
+        ActionQueue.get_instance().push(action, artist=artist, title=title)
 
-    def _ban_track(self, _):
+        notify(titulo, texto % (title.encode('utf-8'), artist.encode('utf-8')))
+
+    def _action_failed(self, queue, action):
         '''
-        Callback for when the Ban action is called. It initiates the process
-        for banning a track.
+        Callback for when Last.fm rejects a queued action. It informs the user
+        of the failure.
         '''
-        entry, track = self.get_current_track()
-
-        if not entry or not track:
+        if action['action'] not in ('love', 'ban'):
             return
 
-        async(track.ban, self._track_banned, track, entry)()
+        verb = 'loved' if action['action'] == 'love' else 'banned'
 
-    def _track_banned(self, result, track, entry):
-        '''
-        Callback for when the track is finally marked as banned or when the
-        action failed for some reason. It informs the user of the result of
-        the action.
-        '''
-        # show a different message for fail/success
-        if isinstance(result, Exception):
-            titulo = 'Failed to ban track'
-            texto = 'There was an error in the connection while ' + \
-                    'trying to mark the track as banned.'
-
-            print result
-        else:
-            titulo = 'Banned track'
-            texto = 'You just marked the track %s - %s as banned' % \
-              (track.get_title().encode('utf-8'), track.get_artist())
-
-            # bonus: 0 stars to the loved track
-            idle_add(self._set_rating, entry, 0)
-
-        notify(titulo, texto)
+        notify('Failed to %s track' % action['action'],
+            'Last.fm refused to mark the track %s - %s as %s.' %
+            (action['title'].encode('utf-8'), action['artist'].encode('utf-8'),
+             verb))
 
     def _set_rating(self, entry, rating):
         self.db.entry_set(entry, RB.RhythmDBPropType.RATING, rating)
@@ -17,14 +17,20 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
 
 from lastfm_extension import LastFMExtensionWithPlayer
-from gi.repository import RB
+from gi.repository import RB, Gtk
 
 from LastFMExtensionUtils import asynchronous_call as async, idle_add
+from LastFMExtensionSync import FullSync, FullSyncManager, NewEntriesSync, \
+    LovedMirror, SyncPlan, PER_TRACK, WHOLE_LIBRARY
+from LastFMExtensionQueue import ActionQueue
 
 #name and description
 NAME = "LastFMLovedSync"
 DESCRIPTION = "Sync your tracks loved status with Last.FM!"
 
+# journal where the full sync progress is saved
+CHECKPOINT_FILE = 'loved_sync.checkpoint'
+
 class Extension(LastFMExtensionWithPlayer):
     '''
     This extensions allows the player to synchronize a track loved status the
@@ -37,6 +43,18 @@ class Extension(LastFMExtensionWithPlayer):
         '''
         super(Extension, self).__init__(plugin, config)
 
+        library_source = plugin.shell.props.library_source
+        self._query_model = library_source.props.base_query_model
+
+        self._full_sync_man = FullSyncManager(self.db, self._query_model,
+            FullLovedSync,
+            CHECKPOINT_FILE)
+        self._new_entries_sync = NewEntriesSync(self.db,
+            library_source.props.entry_type, FullLovedSync)
+
+        if plugin.network:
+            self._full_sync_man.network = plugin.network
+
         self.order = 1
 
     @property
@@ -53,6 +71,152 @@ class Extension(LastFMExtensionWithPlayer):
         '''
         return DESCRIPTION
 
+    def connection_changed(self, connected, plugin):
+        super(Extension, self).connection_changed(connected, plugin)
+
+        self._full_sync_man.network = plugin.network if connected else None
+
+    def connect_signals(self, plugin):
+        '''
+        Besides the playing-changed signal, starts syncing the new entries
+        added to the library.
+        '''
+        super(Extension, self).connect_signals(plugin)
+
+        self._new_entries_sync.network = plugin.network
+        self._new_entries_sync.connect_signals()
+
+        # refresh the loved tracks mirror in background if it's too old
+        mirror = LovedMirror.get_instance()
+
+        if mirror.stale:
+            async(mirror.refresh, self._mirror_refreshed)(plugin.network)
+
+    def disconnect_signals(self, plugin):
+        '''
+        Disconnects the signals and stops syncing the new entries.
+        '''
+        super(Extension, self).disconnect_signals(plugin)
+
+        self._new_entries_sync.disconnect_signals()
+        self._new_entries_sync.network = None
+
+    def _mirror_refreshed(self, result):
+        if isinstance(result, Exception):
+            print result
+
+    def get_configuration_widget(self):
+        '''
+        Returns a GTK widget to be used as a configuration interface for the
+        extension on the plugin's preferences dialog. Besides the checkbox to
+        enable the per-play sync, it allows to do a full sync.
+        '''
+        enable_widget = super(Extension, self).get_configuration_widget()[1]
+        enable_widget.set_label(_('Enable per-play sync'))
+        enable_widget.set_margin_left(25)
+
+        # create the actual widget
+        title = Gtk.Label(xalign=0)
+        title.set_markup('<b>%s</b>' % _('Loved Sync:'))
+
+        widget = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        widget.pack_start(title, False, False, 0)
+        widget.pack_start(enable_widget, False, False, 0)
+
+        # add the full sync widtet
+        self._full_sync_man.add_to_widget(widget)
+
+        # add the widget to push the local loved tracks
+        widget.pack_start(self._create_push_widget(), False, False, 0)
+
+        return _('Sync'), widget
+
+    def _create_push_widget(self):
+        '''
+        Creates the widget that allows to love on Last.fm the tracks rated
+        with 5 stars locally, showing the progress of the actions queue.
+        '''
+        queue = ActionQueue.get_instance()
+
+        push_button = Gtk.Button(label=_('Love my 5 stars tracks on Last.fm'),
+            margin_left=25)
+        push_button.set_tooltip_text(_('Loves on Last.fm all the tracks '
+            'rated with 5 stars that aren\'t loved yet'))
+        push_button.connect('clicked', self._push_rated)
+
+        progress_bar = Gtk.ProgressBar(show_text=True, margin_left=25)
+
+        def update_progress(queue):
+            total = queue.sent + queue.pending
+
+            progress_bar.set_fraction(
+                float(queue.sent) / total if total else 1.)
+            progress_bar.set_text(_('%d pending (%.1f tracks/s)') %
+                (queue.pending, queue.rate))
+
+        update_progress(queue)
+        progress_id = queue.connect('progress', update_progress)
+
+        widget = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=5)
+        widget.pack_start(push_button, False, False, 0)
+        widget.pack_start(progress_bar, False, False, 0)
+        widget.connect('destroy', lambda *_: queue.disconnect(progress_id))
+
+        return widget
+
+    def _push_rated(self, button):
+        '''
+        Callback for the push button. Makes sure the loved tracks mirror is up
+        to date before diffing it against the local ratings.
+        '''
+        network = self._full_sync_man.network
+        mirror = LovedMirror.get_instance()
+
+        if not network:
+            return
+
+        button.set_sensitive(False)
+
+        if mirror.stale:
+            async(mirror.refresh, self._mirror_ready, button)(network)
+        else:
+            self._queue_rated(button)
+
+    def _mirror_ready(self, result, button):
+        if isinstance(result, Exception):
+            print result
+            idle_add(button.set_sensitive, True)
+        else:
+            idle_add(self._queue_rated, button)
+
+    def _queue_rated(self, button):
+        '''
+        Queues a love action for each local 5 stars entry that isn't on the
+        loved tracks mirror.
+        '''
+        mirror = LovedMirror.get_instance()
+        actions = []
+
+        for row in self._query_model:
+            entry = row[0]
+
+            if entry.get_double(RB.RhythmDBPropType.RATING) < 5:
+                continue
+
+            artist = unicode(entry.get_string(RB.RhythmDBPropType.ARTIST),
+                'utf-8')
+            title = unicode(entry.get_string(RB.RhythmDBPropType.TITLE),
+                'utf-8')
+
+            if not mirror.is_loved(artist, title):
+                actions.append({'action': 'love', 'artist': artist,
+                    'title': title})
+
+        print '%s: queued %d tracks to love' % (NAME, len(actions))
+
+        ActionQueue.get_instance().push_many(actions)
+        button.set_sensitive(True)
+
     def playing_changed(self, shell_player, playing, plugin):
         '''
         Callback for the playing-changed signal. Initiates the process to
@@ -68,8 +232,15 @@ class Extension(LastFMExtensionWithPlayer):
         if not entry or not track:
             return
 
-        #obtenemos la playcount de lastfm asincronamente
-        async(track.is_loved, self._update_loved, entry)()
+        # check the loved tracks mirror; only ask Last.fm if it was never
+        # loaded
+        mirror = LovedMirror.get_instance()
+
+        if mirror.ready:
+            self._update_loved(mirror.is_loved(track.get_artist().get_name(),
+                track.get_title()), entry)
+        else:
+            async(track.is_loved, self._update_loved, entry)()
 
     def _update_loved(self, loved, entry):
         '''
@@ -84,4 +255,48 @@ class Extension(LastFMExtensionWithPlayer):
             idle_add(set_rating, entry)
 
 
+class FullLovedSync(FullSync):
+    '''
+    Syncs the loved status of the whole library, giving 5 stars to the loved
+    tracks. Depending on the amount of loved tracks, it either asks for the
+    status of each track or loads all the user's loved tracks on the
+    LovedMirror and rates the whole library in one pass.
+    '''
+    name = NAME
+    strategies = (PER_TRACK, WHOLE_LIBRARY)
+    remote_method = 'user.getLovedTracks'
+
+    def plan(self, pending):
+        '''
+        When the loved tracks mirror is up to date, no requests are needed.
+        '''
+        mirror = LovedMirror.get_instance()
+
+        if mirror.ready and not mirror.stale:
+            return SyncPlan(WHOLE_LIBRARY, 0, {WHOLE_LIBRARY: 0})
+
+        return super(FullLovedSync, self).plan(pending)
 
+    def _sync_remote(self, pending, params):
+        '''
+        Refreshes the loved tracks mirror if needed and rates all the pending
+        entries that are on it.
+        '''
+        mirror = LovedMirror.get_instance()
+
+        if not mirror.ready or mirror.stale:
+            mirror.refresh(self._network)
+
+        locations = set(item.location for item in pending)
+        resolved = self._index.resolve_many(mirror.keys())
+
+        self._apply([(item.location, True) for items in resolved.itervalues()
+            for item in items if item.location in locations])
+        self._mark(*locations)
+
+    def _fetch_track(self, track):
+        return track.is_loved()
+
+    def _apply_value(self, entry, loved):
+        if type(loved) is bool and loved:
+            self._db.entry_set(entry, RB.RhythmDBPropType.RATING, 5)
@@ -19,13 +19,27 @@
 from lastfm_extension import LastFMExtensionWithPlayer
 from gi.repository import RB, Gtk, GObject
 
-from LastFMExtensionUtils import asynchronous_call as async, idle_add, \
-    bind_properties
+from LastFMExtensionUtils import asynchronous_call as async, idle_add
+from LastFMExtensionSync import FullSync, FullSyncManager, NewEntriesSync, \
+    SyncLedger, PER_TRACK, PER_ARTIST, WHOLE_LIBRARY
+
+import pylast
 
 # name and description
 NAME = "LastFMPlaycountSync"
 DESCRIPTION = "Sync your tracks playcount with Last.FM!"
 
+# journals where the full sync progress and the synced entries are saved
+CHECKPOINT_FILE = 'playcount_sync.checkpoint'
+LEDGER_FILE = 'playcount_sync.ledger'
+
+# settings keys
+FRESHNESS = 'freshness_days'
+
+# default days a synced playcount is considered fresh
+DEFAULT_FRESHNESS = 7
+DAY = 24 * 60 * 60
+
 class Extension(LastFMExtensionWithPlayer):
     '''
     This extensions allows the player to synchronize a track playcount with the
@@ -38,8 +52,16 @@ class Extension(LastFMExtensionWithPlayer):
         '''
         super(Extension, self).__init__(plugin, settings)
 
-        self._full_sync_man = FullPlaycountSyncManager(self.db,
-            plugin.shell.props.library_source.props.base_query_model)
+        library_source = plugin.shell.props.library_source
+        freshness = lambda: self.freshness * DAY
+
+        self._ledger = SyncLedger(LEDGER_FILE)
+        self._full_sync_man = FullSyncManager(self.db,
+            library_source.props.base_query_model, FullPlaycountSync,
+            CHECKPOINT_FILE, ledger=self._ledger, freshness=freshness)
+        self._new_entries_sync = NewEntriesSync(self.db,
+            library_source.props.entry_type, FullPlaycountSync,
+            ledger=self._ledger, freshness=freshness)
 
         if plugin.network:
             self._full_sync_man.network = plugin.network
@@ -60,11 +82,45 @@ class Extension(LastFMExtensionWithPlayer):
         '''
         return DESCRIPTION
 
+    @property
+    def freshness(self):
+        '''
+        Days during which a synced playcount isn't queried again on a full
+        sync, unless the local playcount changes.
+        '''
+        if not self.settings.has_option(FRESHNESS):
+            self.freshness = DEFAULT_FRESHNESS
+
+        return self.settings.getint(FRESHNESS)
+
+    @freshness.setter
+    def freshness(self, days):
+        self.settings.set(FRESHNESS, days)
+
     def connection_changed(self, connected, plugin):
         super(Extension, self).connection_changed(connected, plugin)
 
         self._full_sync_man.network = plugin.network if connected else None
 
+    def connect_signals(self, plugin):
+        '''
+        Besides the playing-changed signal, starts syncing the new entries
+        added to the library.
+        '''
+        super(Extension, self).connect_signals(plugin)
+
+        self._new_entries_sync.network = plugin.network
+        self._new_entries_sync.connect_signals()
+
+    def disconnect_signals(self, plugin):
+        '''
+        Disconnects the signals and stops syncing the new entries.
+        '''
+        super(Extension, self).disconnect_signals(plugin)
+
+        self._new_entries_sync.disconnect_signals()
+        self._new_entries_sync.network = None
+
     def get_configuration_widget(self):
         '''
         Returns a GTK widget to be used as a configuration interface for the
@@ -85,6 +141,24 @@ class Extension(LastFMExtensionWithPlayer):
         widget.pack_start(title, False, False, 0)
         widget.pack_start(enable_widget, False, False, 0)
 
+        # freshness spin button
+        def freshness_callback(spin):
+            self.freshness = spin.get_value_as_int()
+
+        freshness_spin = Gtk.SpinButton.new_with_range(0, 365, 1)
+        freshness_spin.set_value(self.freshness)
+        freshness_spin.set_tooltip_text(_('Tracks whose local playcount '
+            'didn\'t change are skipped by the full sync during this time'))
+        freshness_spin.connect('value-changed', freshness_callback)
+
+        freshness_label = Gtk.Label(_('Days before re-syncing a track:'))
+
+        freshness_box = Gtk.Box(spacing=5, margin_left=25)
+        freshness_box.pack_start(freshness_label, False, False, 0)
+        freshness_box.pack_start(freshness_spin, False, False, 0)
+
+        widget.pack_start(freshness_box, False, False, 0)
+
         # add the full sync widtet
         self._full_sync_man.add_to_widget(widget)
 
@@ -149,147 +223,63 @@ class TrackPlaycountSync(GObject.Object):
         idle_add(self.emit, 'done')
 
 
-class FullPlaycountSync(GObject.Object):
-    # signals
-    __gsignals__ = {
-        'done': (GObject.SIGNAL_RUN_LAST, None, ())
-        }
-
-    progress = GObject.property(type=float, default=1)
-
-    def __init__(self, network, db, query_model):
-        super(FullPlaycountSync, self).__init__()
-        self._network = network
-        self._db = db
-        self._query_model = query_model
-        self._cancel = False
-
-    def _do_sync(self, iterator, total, synced):
-        try:
-            # get the entry
-            entry = self._query_model[iterator.next().path][0]
-        except StopIteration:
-            self._cancel = True
-
-        if self._cancel:
-            # if canceled (either the iteration finished or user canceled)
-            # emit the done signal
-            self.emit('done')
-
-        else:
-            # if not, go ahead and poll the next playcount
-            # update the progress
-            synced += 1
-            self.progress = synced / total
-
-            # get the lastfm track
-            title = unicode(entry.get_string(RB.RhythmDBPropType.TITLE),
-                         'utf-8')
-            artist = unicode(entry.get_string(RB.RhythmDBPropType.ARTIST),
-                          'utf-8')
-
-            track = self._network.get_track(artist, title)
-
-            # create the track sync and connect to the done signal
-            track_sync = TrackPlaycountSync(self._db, entry, track)
-            track_sync.connect('done', lambda _, *data: self._do_sync(*data),
-                iterator, total, synced)
-
-            # start the track sync
-            track_sync.start()
-
-    def start(self):
-        self.progress = 0.
-
-        self._do_sync(iter(self._query_model), len(self._query_model), 0.)
-
-    def cancel(self):
-        self._cancel = True
-
-
-class FullPlaycountSyncManager(object):
-    def __init__(self, db, query_model):
-        self._network = None
-        self._db = db
-        self._query_model = query_model
-        self._full_sync = None
-        self._start_widget = None
-        self._stop_widget = None
-
-    @property
-    def network(self):
-        return self._network
-
-    @network.setter
-    def network(self, network):
-        self._network = network
-
-        if self._start_widget:
-            idle_add(self._start_widget.set_sensitive, network is not None)
-
-    def _init_widgets(self, box):
-        # start widget
-        self._start_widget = Gtk.Button(label=_('Do a full sync'),
-            margin_left=25)
-
-        # stop widget
-        self._stop_widget = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL,
-            margin_left=25)
-
-        progress_bar = Gtk.ProgressBar()
-        self._stop_widget.pack_start(progress_bar, False, False, 0)
-
-        stop_button = Gtk.Button(label=_('Stop'), margin_left=5)
-        self._stop_widget.pack_start(stop_button, False, False, 0)
-
-        # callbacks for widgets
-        def do_full_sync(start_button):
-            self._start_full_sync()
-            self._wire_sync_progress(progress_bar)
+class FullPlaycountSync(FullSync):
+    '''
+    Syncs the playcount of the whole library. Besides asking for the
+    playcount of each track, it can page through the user's Last.fm library
+    (entirely or by artist) when that needs less requests.
+    '''
+    name = NAME
+    strategies = (PER_TRACK, PER_ARTIST, WHOLE_LIBRARY)
+    remote_method = 'library.getTracks'
+    missing_value = 0
 
-            # hide this button and show the other
-            box.remove(self._start_widget)
-            box.pack_start(self._stop_widget, False, False, 0)
-            box.show_all()
+    def __init__(self, network, db, query_model, checkpoint, index, ledger,
+                 freshness):
+        '''
+        Besides the FullSync parameters, it receives the SyncLedger used to
+        skip the entries synced recently and a function that returns for how
+        many seconds a synced entry stays fresh.
+        '''
+        super(FullPlaycountSync, self).__init__(network, db, query_model,
+            checkpoint, index)
 
-        self._start_widget.connect('clicked', do_full_sync)
+        self._ledger = ledger
+        self._window = freshness()
 
-        def cancel_full_sync(stop_button):
-            # cancel the sync
-            self._full_sync.cancel()
+    def _is_fresh(self, entry):
+        return self._ledger.is_fresh(
+            entry.get_string(RB.RhythmDBPropType.LOCATION),
+            entry.get_ulong(RB.RhythmDBPropType.PLAY_COUNT), self._window)
 
-            # hide this widget and show the start button
-            box.remove(self._stop_widget)
-            box.pack_start(self._start_widget, False, False, 0)
-            box.show_all()
+    def _parse_node(self, node):
+        title = pylast._extract(node, 'name')
+        artist = pylast._extract(node, 'name', 1)
+        playcount = pylast._number(pylast._extract(node, 'playcount'))
 
-        stop_button.connect('clicked', cancel_full_sync)
+        return (artist, title), playcount
 
-    def add_to_widget(self, box):
-        # choose and add the correct widget
-        self._init_widgets(box)
+    def _fetch_track(self, track):
+        return track.get_playcount(True)
 
-        if self._full_sync:
-            box.pack_start(self._stop_widget, False, False, 0)
-        else:
-            box.pack_start(self._start_widget, False, False, 0)
+    def _apply_value(self, entry, playcount):
+        '''
+        The playcount is updated ONLY if the one retreived from LastFM is
+        HIGHER than the one stored locally.
+        '''
+        old_playcount = entry.get_ulong(RB.RhythmDBPropType.PLAY_COUNT)
 
-            if not self.network:
-                self._start_widget.set_sensitive(False)
+        if type(playcount) is not int:
+            return
 
-    def _wire_sync_progress(self, progress_bar):
-        # connect the progress bar progress
-        bind_properties(self._full_sync, progress_bar, 'progress',
-            'fraction')
+        if playcount and old_playcount < playcount:
+            self._db.entry_set(entry, RB.RhythmDBPropType.PLAY_COUNT,
+                playcount)
 
-    def _start_full_sync(self):
-        # create and start the sync
-        self._full_sync = FullPlaycountSync(self._network, self._db,
-            self._query_model)
-        self._full_sync.start()
+        self._ledger.record(entry.get_string(RB.RhythmDBPropType.LOCATION),
+            max(old_playcount, playcount), playcount)
 
-        # connect to the done signal
-        def full_sync_done(full_sync):
-            self._full_sync = None
+    def _apply_updates(self, updates):
+        super(FullPlaycountSync, self)._apply_updates(updates)
 
-        self._full_sync.connect('done', full_sync_done)
+        self._ledger.flush()
@@ -0,0 +1,446 @@
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+# Copyright (C) 2012 - Carrasco Agustin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
+
+from lastfm_extension import LastFMExtensionWithPlayer
+from gi.repository import RB, Gtk, GObject, GLib
+
+from LastFMExtensionUtils import idle_add
+from LastFMExtensionJournal import Journal
+from LastFMExtensionQueue import RETRY_MIN, RETRY_MAX, REJECTED_ERRORS, \
+    AUTH_ERRORS, error_code, session_rejected
+
+import time
+import threading
+import pylast
+
+# name and description
+NAME = "LastFMScrobbler"
+DESCRIPTION = "Scrobble your tracks to Last.FM, even while offline! " \
+    "(disable the stock Last.fm plugin to avoid double scrobbles)"
+
+# journal where the scrobbles waiting to be submitted are saved
+QUEUE_FILE = 'scrobbles.queue'
+
+# most scrobbles Last.fm accepts on a single request
+BATCH_SIZE = 50
+
+# seconds to wait before sending a now playing update, so skipping through
+# several tracks only sends the last one
+NOW_PLAYING_DELAY = 2
+
+# a track is scrobbled once it's played for half it's duration or for
+# SCROBBLE_TIME seconds, whichever comes first. Shorter tracks than
+# MIN_DURATION aren't scrobbled
+SCROBBLE_TIME = 240
+MIN_DURATION = 30
+
+# ignored scrobbles codes that are worth retrying (daily limit exceeded)
+RETRY_IGNORED = ('5',)
+
+class Extension(LastFMExtensionWithPlayer):
+    '''
+    This extension scrobbles the played tracks to Last.fm. The plays are saved
+    on a persistent queue as soon as they count as a scrobble, and submitted
+    in batches, so the plays made while offline are sent once the connection
+    is back with as few requests as possible.
+    '''
+
+    def __init__(self, plugin, settings):
+        '''
+        Initializes the extension.
+        '''
+        self._queue = ScrobbleQueue(QUEUE_FILE)
+        self._entry = None
+
+        super(Extension, self).__init__(plugin, settings)
+
+        self.order = 4
+
+    @property
+    def extension_name(self):
+        '''
+        Returns the extension name. Read only property.
+        '''
+        return NAME
+
+    @property
+    def extension_desc(self):
+        '''
+        Returns a description for the extensions. Read only property.
+        '''
+        return DESCRIPTION
+
+    def connect_signals(self, plugin):
+        '''
+        Besides the playing-changed signal, connects the signals needed to
+        follow the playing song and starts submitting the queued scrobbles.
+        '''
+        super(Extension, self).connect_signals(plugin)
+
+        self.song_changed_id = self.player.connect('playing-song-changed',
+            self._song_changed)
+        self.elapsed_id = self.player.connect('elapsed-changed',
+            self._elapsed_changed)
+
+        self._queue.network = plugin.network
+        self._song_changed(self.player, self.player.get_playing_entry())
+
+    def disconnect_signals(self, plugin):
+        '''
+        Disconnects the signals and stops submitting scrobbles. The pending
+        scrobbles are kept on the queue.
+        '''
+        super(Extension, self).disconnect_signals(plugin)
+
+        self.player.disconnect(self.song_changed_id)
+        self.player.disconnect(self.elapsed_id)
+
+        del self.song_changed_id
+        del self.elapsed_id
+
+        self._queue.network = None
+        self._entry = None
+
+    def get_configuration_widget(self):
+        '''
+        Returns a GTK widget to be used as a configuration interface for the
+        extension on the plugin's preferences dialog. Besides the checkbox to
+        enable the extension, it shows how many scrobbles are waiting to be
+        submitted.
+        '''
+        enable_widget = super(Extension, self).get_configuration_widget()[1]
+        enable_widget.set_margin_left(25)
+
+        title = Gtk.Label(xalign=0)
+        title.set_markup('<b>%s</b>' % _('Scrobbler:'))
+
+        pending_label = Gtk.Label(xalign=0, margin_left=25)
+
+        def update_pending(queue):
+            pending_label.set_text(_('%d scrobbles waiting to be submitted') %
+                queue.pending)
+
+        update_pending(self._queue)
+        progress_id = self._queue.connect('progress', update_pending)
+
+        widget = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        widget.pack_start(title, False, False, 0)
+        widget.pack_start(enable_widget, False, False, 0)
+        widget.pack_start(pending_label, False, False, 0)
+        widget.connect('destroy',
+            lambda *_: self._queue.disconnect(progress_id))
+
+        return _('General'), widget
+
+    def _song_changed(self, player, entry):
+        '''
+        Callback for the playing-song-changed signal. Starts following the
+        play of the new entry and updates the now playing track.
+        '''
+        self._entry = entry
+        self._played = 0
+        self._last_elapsed = None
+        self._scrobbled = False
+        self._started = int(time.time())
+
+        if entry:
+            self._queue.now_playing(self._track_info(entry))
+
+    def _elapsed_changed(self, player, elapsed):
+        '''
+        Callback for the elapsed-changed signal. Counts the seconds the entry
+        was actually played (seeking doesn't count) and queues the scrobble
+        once it's played enough.
+        '''
+        if not self._entry or self._scrobbled:
+            return
+
+        if self._last_elapsed is not None and \
+           elapsed - self._last_elapsed == 1:
+            self._played += 1
+
+        self._last_elapsed = elapsed
+
+        duration = self._entry.get_ulong(RB.RhythmDBPropType.DURATION)
+
+        if duration < MIN_DURATION or \
+           self._played < min(duration / 2, SCROBBLE_TIME):
+            return
+
+        self._scrobbled = True
+
+        scrobble = self._track_info(self._entry)
+        scrobble['timestamp'] = self._started
+
+        self._queue.push(scrobble)
+
+    def _track_info(self, entry):
+        '''
+        Returns the scrobble parameters for an entry, as expected by
+        pylast's scrobble_many.
+        '''
+        info = {
+            'artist': unicode(entry.get_string(RB.RhythmDBPropType.ARTIST),
+                'utf-8'),
+            'title': unicode(entry.get_string(RB.RhythmDBPropType.TITLE),
+                'utf-8')
+            }
+
+        album = entry.get_string(RB.RhythmDBPropType.ALBUM)
+
+        if album:
+            info['album'] = unicode(album, 'utf-8')
+
+        for key, prop in (('duration', RB.RhythmDBPropType.DURATION),
+                          ('track_number', RB.RhythmDBPropType.TRACK_NUMBER)):
+            value = entry.get_ulong(prop)
+
+            if value:
+                info[key] = value
+
+        return info
+
+
+class ScrobbleQueue(GObject.Object):
+    '''
+    Persistent queue of scrobbles. Scrobbles are written to a Journal as soon
+    as they are pushed, and a background worker submits them in batches of
+    BATCH_SIZE, retrying with an exponential backoff while Last.fm can't be
+    reached. If Last.fm rejects the session, the scrobbles are kept until the
+    user connects again.
+    Now playing updates aren't queued: only the last one is kept, and it's
+    dropped if it can't be sent.
+    '''
+    # signals
+    __gsignals__ = {
+        'progress': (GObject.SIGNAL_RUN_LAST, None, ())
+        }
+
+    def __init__(self, name):
+        '''
+        Initialises the queue, loading the scrobbles that weren't submitted on
+        a previous run.
+        '''
+        super(ScrobbleQueue, self).__init__()
+
+        self._journal = Journal(name)
+        self._lock = threading.Lock()
+        self._scrobbles = {}
+        self._next_id = 0
+        self._now_playing = None
+        self._now_playing_id = None
+        self._network = None
+        self._worker = None
+        self._retry = None
+        self._retry_delay = RETRY_MIN
+
+        for record in self._journal.load():
+            if record['op'] == 'push':
+                self._scrobbles[record['id']] = record['scrobble']
+                self._next_id = max(self._next_id, record['id'] + 1)
+            else:
+                for scrobble_id in record['ids']:
+                    self._scrobbles.pop(scrobble_id, None)
+
+    @property
+    def pending(self):
+        ''' Amount of scrobbles waiting to be submitted. '''
+        return len(self._scrobbles)
+
+    @property
+    def network(self):
+        return self._network
+
+    @network.setter
+    def network(self, network):
+        self._network = network
+        self._cancel_retry()
+
+        if network:
+            self._start_worker()
+
+    def push(self, scrobble):
+        '''
+        Queues a scrobble. The scrobble is a dictionary with the parameters
+        expected by pylast's scrobble_many (at least artist, title and
+        timestamp).
+        '''
+        with self._lock:
+            scrobble_id = self._next_id
+            self._scrobbles[scrobble_id] = scrobble
+            self._next_id += 1
+
+            # written under the lock, so the worker can't journal the
+            # scrobble as done (or drop the journal) before it's pushed
+            self._journal.append({'op': 'push', 'id': scrobble_id,
+                'scrobble': scrobble})
+
+        self.emit('progress')
+
+        if self._network and not self._retry:
+            self._start_worker()
+
+    def now_playing(self, track):
+        '''
+        Sets the track to be sent as now playing. The update is delayed a
+        little, so if it's replaced meanwhile only the last one is sent.
+        '''
+        with self._lock:
+            self._now_playing = track
+
+        if self._now_playing_id:
+            GLib.source_remove(self._now_playing_id)
+
+        self._now_playing_id = GLib.timeout_add_seconds(NOW_PLAYING_DELAY,
+            self._send_now_playing)
+
+    def _send_now_playing(self):
+        self._now_playing_id = None
+
+        if self._network:
+            self._start_worker()
+
+        return False
+
+    def _cancel_retry(self):
+        if self._retry:
+            self._retry.cancel()
+            self._retry = None
+
+    def _schedule_retry(self):
+        print 'Last.fm unreachable, retrying in %d seconds' % self._retry_delay
+
+        self._retry = threading.Timer(self._retry_delay, self._retry_worker)
+        self._retry.daemon = True
+        self._retry.start()
+
+        self._retry_delay = min(self._retry_delay * 2, RETRY_MAX)
+
+    def _retry_worker(self):
+        self._retry = None
+        self._start_worker()
+
+    def _start_worker(self):
+        with self._lock:
+            if (self._scrobbles or self._now_playing) and not self._worker:
+                self._worker = threading.Thread(target=self._run)
+                self._worker.daemon = True
+                self._worker.start()
+
+    def _run(self):
+        failed = False
+
+        while self._network:
+            with self._lock:
+                now_playing, self._now_playing = self._now_playing, None
+                batch = sorted(self._scrobbles.iteritems())[:BATCH_SIZE]
+
+            if not now_playing and not batch:
+                break
+
+            try:
+                if now_playing:
+                    self._network.update_now_playing(**now_playing)
+
+                if batch:
+                    self._submit(batch)
+            except pylast.WSError as e:
+                if error_code(e) in AUTH_ERRORS:
+                    # keep the scrobbles until the user connects again
+                    session_rejected(e)
+                    self._network = None
+                    break
+
+                print e
+                failed = True
+                break
+            except Exception as e:
+                # the scrobbles are left on the queue to try again later
+                print e
+                failed = True
+                break
+
+            self._retry_delay = RETRY_MIN
+            idle_add(self.emit, 'progress')
+
+        with self._lock:
+            self._worker = None
+
+            # nothing left to submit, the journal can be dropped
+            if not self._scrobbles:
+                self._journal.clear()
+
+        if failed and self._network:
+            self._schedule_retry()
+
+        idle_add(self.emit, 'progress')
+
+    def _submit(self, batch):
+        '''
+        Submits a batch of (id, scrobble) pairs and removes from the queue the
+        ones Last.fm accepted or permanently ignored. If Last.fm rejects the
+        whole batch because of a bad scrobble (invalid parameters), the batch
+        is split in halves to isolate it; any other error leaves the batch on
+        the queue.
+        '''
+        try:
+            doc = self._network.scrobble_many([scrobble
+                for _, scrobble in batch])[0]
+        except pylast.WSError as e:
+            if error_code(e) not in REJECTED_ERRORS:
+                raise
+
+            if len(batch) > 1:
+                half = len(batch) / 2
+                self._submit(batch[:half])
+                self._submit(batch[half:])
+                return
+
+            print 'Scrobble rejected by Last.fm: %s' % e
+            self._remove([batch[0][0]])
+            return
+
+        done = []
+
+        for (scrobble_id, scrobble), node in zip(batch,
+            doc.getElementsByTagName('scrobble')):
+            ignored = node.getElementsByTagName('ignoredMessage')
+            code = ignored[0].getAttribute('code') if ignored else '0'
+
+            if code in RETRY_IGNORED:
+                continue
+
+            if code != '0':
+                print 'Scrobble of %s - %s ignored by Last.fm (code %s)' % \
+                    (scrobble['artist'].encode('utf-8'),
+                     scrobble['title'].encode('utf-8'), code)
+
+            done.append(scrobble_id)
+
+        self._remove(done)
+
+        if len(done) < len(batch):
+            # the daily limit was reached, try again later
+            raise Exception('Daily scrobble limit exceeded')
+
+    def _remove(self, ids):
+        with self._lock:
+            for scrobble_id in ids:
+                self._scrobbles.pop(scrobble_id, None)
+
+            self._journal.append({'op': 'done', 'ids': ids})
@@ -91,7 +91,17 @@ else
     declare -a libfiles=("lastfm_extension.plugin" "lastfm_extension.py" 
                          "LastFMExtensionGenreGuesser.py" 
                          "LastFMExtensionKeys.py" "LastFMExtensionUtils.py"
-                         "LastFMExtensionGui.py" "pylast.py")
+                         "LastFMExtensionGui.py" "LastFMExtensionJournal.py"
+                         "LastFMExtensionLibrary.py"
+                         "LastFMExtensionFuzzyMatcher.py"
+                         "LastFMExtensionSync.py" "LastFMExtensionQueue.py"
+                         "LastFMExtensionFingerprintEngine.py"
+                         "LastFMExtensionFingerprintCache.py"
+                         "LastFMExtensionDecoder.py"
+                         "LastFMExtensionAlbumCache.py"
+                         "LastFMExtensionSketch.py"
+                         "LastFMExtensionRemote.py"
+                         "pylast.py")
     
     for item in "${libfiles[@]}"
     do
@@ -100,8 +110,7 @@ else
     
     #share files
     declare -a sharefiles=("extensions" "img" "genres.txt" "matcher.py" 
-                           "lastfmExtensionConfigDialog.glade"
-                           "lastfmExtensionFingerprintDialog.glade")
+                           "lastfmExtensionConfigDialog.glade")
     
     for item in "${sharefiles[@]}"
     do
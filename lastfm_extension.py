@@ -24,6 +24,7 @@ from gi.repository import Peas
 from gi.repository import RB
 
 from glob import iglob
+from ConfigParser import SafeConfigParser
 import os
 import imp
 import rb
@@ -31,6 +32,8 @@ import rb
 import LastFMExtensionKeys as Keys
 import LastFMExtensionUtils
 from LastFMExtensionGui import ConfigDialog
+from LastFMExtensionLibrary import LibraryIndex
+from LastFMExtensionQueue import ActionQueue
 
 import gettext
 
@@ -311,30 +314,127 @@ class LastFMExtensionWithPlayer(LastFMExtension):
 
         return (entry, self.network.get_track(artist, title))
 
+class LastFMExtensionStub(object):
+    '''
+    Placeholder for an extension listed on the manifest whose module wasn't
+    imported yet. It only knows the data of the manifest and the enabled
+    setting, and asks the Bag to load the real extension once it's enabled or
+    it's configuration is shown (the real extension, even disabled, offers
+    more than the checkbox to enable it).
+    '''
+
+    def __init__(self, bag, plugin, settings, name, module, description,
+        order):
+        super(LastFMExtensionStub, self).__init__()
+
+        self.bag = bag
+        self.plugin = plugin
+        self.module = module
+        self.order = order
+        self.settings = settings.get_section(name)
+
+        self._name = name
+        self._description = description
+
+        self.settings.connect(Keys.ENABLED, self.on_enabled_notify, plugin)
+
+    def destroy(self, plugin):
+        '''
+        Disconnects the stub from the settings, when it's replaced by the real
+        extension or the plugin is deactivated.
+        '''
+        self.settings.disconnect(Keys.ENABLED, self.on_enabled_notify)
+
+        del self.settings
+        del self.bag
+        del self.plugin
+
+    @property
+    def extension_name(self):
+        return self._name
+
+    @property
+    def extension_desc(self):
+        return self._description
+
+    @property
+    def enabled(self):
+        return self.settings.has_option(Keys.ENABLED) and \
+            self.settings.getboolean(Keys.ENABLED)
+
+    def get_configuration_widget(self):
+        '''
+        Loads the real extension and returns it's configuration widget. If
+        the extension can't be loaded, returns the checkbox to enable it, the
+        same that LastFMExtension shows by default.
+        '''
+        extension = self.bag.load_extension(self.plugin, self)
+
+        if extension:
+            return extension.get_configuration_widget()
+
+        def toggled_callback(checkbox):
+            self.settings.set(Keys.ENABLED, checkbox.get_active())
+
+        widget = Gtk.CheckButton(_("Activate %s ") % self)
+        widget.set_active(self.enabled)
+        widget.connect('toggled', toggled_callback)
+        widget.set_tooltip_text(self.extension_desc)
+
+        return _('General'), widget
+
+    def on_enabled_notify(self, enabled, plugin):
+        if enabled:
+            self.bag.load_extension(plugin, self)
+
+    def __str__(self, *args, **kwargs):
+        return self.extension_name
+
 class LastFMExtensionBag(object):
     '''
     This class serves as intermediary between the Plugin and it's Configurable,
     so both can access the loaded extensions.
     Also it works as a sort of factory, responsible of initialising and
     destroying all configured extensions.
+    The extensions are listed on a manifest, read without importing them; the
+    module of each extension is only imported when the extension is enabled,
+    and until then it's represented by a LastFMExtensionStub. Modules of the
+    extensions directory that aren't on the manifest are loaded right away.
     '''
 
     # unique instance of this Bag
     instance = None
 
-    # extensions directory
+    # extensions directory and manifest
     EXT_DIR = 'extensions'
+    MANIFEST = 'extensions.manifest'
 
     def __init__(self, plugin, settings):
         '''
-        Initialise the bag, dinamically generating all the plugins.
+        Initialise the bag, loading the enabled extensions.
         '''
         self.settings = settings
         self.extensions = {}
-        extensions_class = self.discover_extensions(plugin)
+        self.ext_dir = rb.find_plugin_file(plugin, self.EXT_DIR)
 
-        # load all the extensions and configure them
-        for extension_class in extensions_class:
+        manifest = self.read_manifest()
+
+        for name in manifest.sections():
+            stub = LastFMExtensionStub(self, plugin, settings, name,
+                manifest.get(name, 'module'),
+                manifest.get(name, 'description'),
+                manifest.getint(name, 'order'))
+
+            self.extensions[name] = stub
+
+            if stub.enabled:
+                self.load_extension(plugin, stub)
+
+        listed = set(manifest.get(name, 'module')
+            for name in manifest.sections())
+
+        # load all the other extensions and configure them
+        for extension_class in self.discover_extensions(listed):
             extension = extension_class(plugin, settings)
 
             self.extensions[extension.extension_name] = extension
@@ -348,32 +448,70 @@ class LastFMExtensionBag(object):
         for extension in self.extensions.itervalues():
             extension.destroy(plugin)
 
-    def discover_extensions(self, plugin):
+    def read_manifest(self):
+        '''
+        Reads the manifest of the extensions. A missing manifest is an empty
+        one (so all the extensions are discovered).
+        '''
+        manifest = SafeConfigParser()
+        manifest.read(os.path.join(self.ext_dir, self.MANIFEST))
+
+        return manifest
+
+    def load_extension(self, plugin, stub):
+        '''
+        Imports the module of an extension represented by a stub and replaces
+        the stub with the real extension, that initialises itself if it's
+        enabled. Returns the extension, or None if it couldn't be imported.
+        '''
+        extension_class = self._import_extension(stub.module)
+
+        if not extension_class:
+            return None
+
+        stub.destroy(plugin)
+
+        extension = extension_class(plugin, self.settings)
+        self.extensions[extension.extension_name] = extension
+
+        return extension
+
+    def discover_extensions(self, excluded=()):
+        '''
+        Imports the modules of the extensions directory (but the excluded
+        ones) and returns their extension classes.
+        '''
         extensions = []
-        ext_dir = rb.find_plugin_file(plugin, self.EXT_DIR)
 
         # iterate through all py files on the extensions directory
-        for py_file in iglob(os.path.join(ext_dir, '*.py')):
+        for py_file in iglob(os.path.join(self.ext_dir, '*.py')):
             module_name = os.path.basename(py_file).split(os.path.extsep)[0]
 
-            fp, path, desc = imp.find_module(module_name, [ext_dir])
+            if module_name in excluded:
+                continue
 
-            try:
-                module = imp.load_module(module_name, fp, path, desc)
+            ext_class = self._import_extension(module_name)
 
-                # if there is an extension class, this is an extension
-                ext_class = getattr(module, 'Extension')
+            if ext_class:
+                extensions.append(ext_class)
 
-                if ext_class:
-                    extensions.append(ext_class)
+        return extensions
 
-            except Exception as ex:
-                print ex.message
-            finally:
-                if fp:
-                    fp.close()
+    def _import_extension(self, module_name):
+        fp = None
 
-        return extensions
+        try:
+            fp, path, desc = imp.find_module(module_name, [self.ext_dir])
+            module = imp.load_module(module_name, fp, path, desc)
+
+            # if there is an extension class, this is an extension
+            return getattr(module, 'Extension')
+
+        except Exception as ex:
+            print ex.message
+        finally:
+            if fp:
+                fp.close()
 
     @classmethod
     def initialise_instance(cls, plugin, settings):
@@ -427,12 +565,16 @@ class LastFMExtensionPlugin (GObject.Object, Peas.Activatable):
         # connect a signal to the connected property
         self.settings.connect(Keys.CONNECTED, self.conection_changed)
 
+        # initialise the queue for the actions sent to Last.fm
+        ActionQueue.initialise_instance()
+
         # asign variables and initialise the network and extensions
         self.conection_changed(self.connected)
 
         # initialise the extensions bag
         self.shell = self.object
         self.uim = self.object.props.ui_manager
+        LibraryIndex.initialise_instance(self)
         LastFMExtensionBag.initialise_instance(self, settings)
 
     def do_deactivate(self):
@@ -442,6 +584,8 @@ class LastFMExtensionPlugin (GObject.Object, Peas.Activatable):
 
         # TESTING
         LastFMExtensionBag.destroy_instance(self)
+        LibraryIndex.destroy_instance()
+        ActionQueue.destroy_instance()
 
         del self.shell
         del self.uim
@@ -454,3 +598,5 @@ class LastFMExtensionPlugin (GObject.Object, Peas.Activatable):
                 session_key=self.settings.get(Keys.SESSION))
         else:
             self.network = None
+
+        ActionQueue.get_instance().network = self.network
@@ -2,37 +2,482 @@
 """A simple program for using pylastfp to fingerprint MP3 files. Usage:
 
     $ python matcher.py mysterious_music.mp3
+
+It can also run as a persistent worker, reading one json request per line
+from stdin and writing one json response per line to stdout:
+
+    $ python matcher.py --worker
+
+Or fingerprint a list of files with several processes, reading one path (or
+one json object with the keys path, artist, album and title) per line from
+stdin and writing one json result per line:
+
+    $ find ~/Music -name '*.mp3' | python matcher.py --batch -j 4 -o fp.jsonl
+
+When the output file already exists, the files it has an fpid for are skipped
+and the new results are appended to it, so an interrupted batch can be resumed
+running the same command again. With --sketch, only the sketches used to find
+duplicate songs are computed, without querying Last.fm.
+
+Finally, it can run as a fingerprint server, listening on a TCP address
+(localhost:7878 by default) or on a UNIX socket (see LastFMExtensionRemote
+for the protocol):
+
+    $ python matcher.py --serve -j 8
+
+The connections aren't encrypted, so the best way to use the server from
+other machines is forwarding it's port with ssh (ssh -L 7878:localhost:7878
+server). On a trusted network it can listen on other addresses, with a secret
+the clients must send (configured as secret@host:port on their side):
+
+    $ MATCHER_SECRET=... python matcher.py --serve myhost:7878 -j 8
 """
-import sys, os, lastfp
+import sys, os, json, time, argparse, multiprocessing, lastfp
+import signal, socket, struct, hmac, tempfile, threading, SocketServer
+from Queue import Queue
+
+import LastFMExtensionDecoder as Decoder
+import LastFMExtensionSketch as Sketch
+import LastFMExtensionRemote as Remote
+
+# errors reported by the worker
+EXTRACTION_ERROR = 'extraction'
+QUERY_ERROR = 'query'
+UNKNOWN_ERROR = 'unknown'
+
+# seconds the server waits for a client to accept a response before dropping
+# it, so a stuck client doesn't keep it's connection (and files) forever
+SEND_TIMEOUT = 30
+
+# addresses a server can listen on without being reachable by other machines
+LOOPBACK = ('localhost', '127.0.0.1', '::1')
+
+def extract(path):
+    '''
+    Extracts the fingerprint data of a file and returns it with the duration
+    of the file. Only the window of audio the extractor needs is decoded,
+    and it's streamed into it by blocks, already downmixed.
+    '''
+    path = os.path.abspath(os.path.expanduser(path))
+
+    with Decoder.open_audio(path) as audio:
+        blocks, samplerate, channels = Decoder.preprocessed_blocks(audio)
+
+        return lastfp.extract(blocks, samplerate, channels), audio.duration
+
+def fingerprint(path, artist, album, title, duration=None):
+    '''
+    Fingerprints a file and returns it's fpid. The duration of the song must
+    be given when the file was cut (see LastFMExtensionRemote.upload_size).
+    '''
+    metadata = { 'artist':artist, 'album':album, 'track':title }
+    fpdata, file_duration = extract(path)
+
+    return lastfp.fpid_query(int(duration or file_duration), fpdata, metadata)
+
+def match(request):
+    '''
+    Fingerprints the file of a request and returns the response for it: the
+    request itself, with either the fpid or an error (one of the *_ERROR
+    constants) and a message.
+    '''
+    response = dict(request)
+
+    try:
+        if response.pop('sketch', False):
+            response['sketch'] = Sketch.sketch(extract(request['path'])[0])
+        else:
+            response['fpid'] = fingerprint(request['path'],
+                request.get('artist', ''), request.get('album', ''),
+                request.get('title', ''), request.get('duration'))
+    except lastfp.ExtractionError:
+        response['error'] = EXTRACTION_ERROR
+        response['message'] = 'Fingerprinting failed! ' \
+            '(Is the song too short?)'
+    except lastfp.QueryError:
+        response['error'] = QUERY_ERROR
+        response['message'] = 'Could not match fingerprint!'
+    except Exception as e:
+        response['error'] = UNKNOWN_ERROR
+        response['message'] = str(e)
+
+    return response
+
+def serve():
+    '''
+    Worker mode. Each request is a json object with the keys id, path,
+    artist, album and title (and duration, for cut files); each response has
+    the id of the request and either the fpid or an error (one of the
+    *_ERROR constants) with a message.
+    Requests with the sketch key set only extract the fingerprint, without
+    querying Last.fm, and get it's sketch (see LastFMExtensionSketch) instead
+    of the fpid.
+    '''
+    # lastfp (and it's decoders) may print to stdout, so keep it only for
+    # the responses
+    out = sys.stdout
+    sys.stdout = sys.stderr
+
+    for line in iter(sys.stdin.readline, ''):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            continue
+
+        out.write(json.dumps(worker_response(match(request))) + '\n')
+        out.flush()
+
+def worker_response(response):
+    '''
+    Strips a response down to the keys the worker mode answers with.
+    '''
+    return dict((key, value) for key, value in response.iteritems()
+        if key in ('id', 'fpid', 'sketch', 'error', 'message'))
+
+def timed_match(request):
+    '''
+    Batch worker. Same as match, but the response also has the seconds it
+    took to fingerprint the file.
+    '''
+    started = time.time()
+    response = match(request)
+    response['seconds'] = round(time.time() - started, 3)
+
+    return response
+
+def read_requests(lines, done, sketch=False):
+    '''
+    Parses the lines of a batch, that are either paths or json objects,
+    skipping the empty lines and the files already done.
+    '''
+    for line in lines:
+        line = line.strip()
+
+        if not line:
+            continue
+
+        if line.startswith('{'):
+            request = json.loads(line)
+        else:
+            request = {'path': line}
+
+        if request['path'] not in done:
+            if sketch:
+                request['sketch'] = True
+
+            yield request
+
+def finished_paths(path, key='fpid'):
+    '''
+    Returns the set of files that already have an fpid (or the given key) on
+    a batch output file. Lines that can't be parsed (like the last one of an
+    interrupted batch) are ignored.
+    '''
+    done = set()
+
+    if not os.path.exists(path):
+        return done
+
+    with open(path) as results:
+        for line in results:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+
+            if result.get(key) is not None:
+                done.add(result['path'])
+
+    return done
+
+def batch(argv):
+    '''
+    Batch mode. Fingerprints the files listed on stdin with a pool of
+    processes, writing the results as they are ready (not in the order of the
+    list).
+    '''
+    parser = argparse.ArgumentParser(prog='matcher.py --batch')
+    parser.add_argument('-j', '--jobs', type=int,
+        default=multiprocessing.cpu_count(),
+        help='number of files fingerprinted at the same time')
+    parser.add_argument('-o', '--output',
+        help='file where the results are appended (and resumed from)')
+    parser.add_argument('-s', '--sketch', action='store_true',
+        help='only extract the sketches of the fingerprints, to find '
+             'duplicates, without querying Last.fm')
+    options = parser.parse_args(argv)
+
+    out = sys.stdout
+    sys.stdout = sys.stderr
+
+    done = set()
+
+    if options.output:
+        done = finished_paths(options.output,
+            'sketch' if options.sketch else 'fpid')
+        out = open(options.output, 'a+')
+
+        # don't glue the first result to a truncated line
+        out.seek(0, os.SEEK_END)
+
+        if out.tell():
+            out.seek(-1, os.SEEK_END)
+
+            if out.read(1) != '\n':
+                out.write('\n')
+
+    if done:
+        print 'Skipping %d already fingerprinted files' % len(done)
+
+    pool = multiprocessing.Pool(options.jobs)
+    failed = 0
+
+    try:
+        for response in pool.imap_unordered(timed_match,
+                read_requests(sys.stdin, done, options.sketch)):
+            failed += 'error' in response
+
+            out.write(json.dumps(response) + '\n')
+            out.flush()
+    except KeyboardInterrupt:
+        pool.terminate()
+        return 1
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+        if out is not sys.__stdout__:
+            out.close()
+
+    return 1 if failed else 0
+
+class JobHandler(SocketServer.StreamRequestHandler):
+    '''
+    Handles the connection of a client of the server. The batches of
+    requests are read on another thread (saving the files that come with them
+    to temporary files) and fingerprinted on the pool of processes of the
+    server. The responses are queued as soon as they are ready and written
+    from the thread of the connection, so a slow client never blocks the
+    pool.
+    '''
+
+    def handle(self):
+        self.replies = Queue()
+
+        # only the writes time out: between batches the client can be idle
+        # for as long as it wants
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+            struct.pack('ll', SEND_TIMEOUT, 0))
+
+        reader = threading.Thread(target=self.read)
+        reader.daemon = True
+        reader.start()
+
+        for reply in iter(self.replies.get, None):
+            try:
+                self.wfile.write(json.dumps(reply) + '\n')
+                self.wfile.flush()
+            except (socket.error, IOError, ValueError):
+                # the client is gone or stopped reading, stop the reader too
+                try:
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+                break
+
+    def read(self):
+        authorized = not self.server.secret
+
+        try:
+            for line in iter(self.rfile.readline, ''):
+                # a ValueError means the stream is out of sync, there is no
+                # way to go on
+                message = json.loads(line)
+
+                if not authorized:
+                    if not self.authorize(message):
+                        print 'Refused a client with a wrong secret'
+                        break
+
+                    authorized = True
+
+                if message.get('ping'):
+                    self.replies.put({'pong': True, 'jobs': self.server.jobs})
+
+                for request in message.get('batch', []):
+                    self.submit(request)
+        except (socket.error, IOError, ValueError):
+            pass
+        finally:
+            self.replies.put(None)
+
+    def authorize(self, message):
+        secret = unicode(message.get('secret') or u'')
+
+        return hmac.compare_digest(secret.encode('utf-8'), self.server.secret)
+
+    def submit(self, request):
+        uploaded = 'size' in request
+
+        if uploaded:
+            size = int(request.pop('size'))
+
+            if not 0 <= size <= self.server.max_upload:
+                self.reject(request, 'The file is too big to be uploaded')
+
+                # the content can't be skipped, so the stream is out of sync
+                raise IOError('Refused an upload of %d bytes' % size)
+
+            request['path'] = self.receive(request['path'], size)
+
+        elif self.server.uploads:
+            # over TCP the paths are the client's ones, and opening them
+            # would let any client read the files of the server
+            self.reject(request, 'The files must be uploaded')
+            return
+
+        with self.server.lock:
+            self.server.jobs += 1
 
-import LastFMExtensionKeys as Keys
+        self.server.pool.apply_async(match, (request,),
+            callback=lambda response: self.finished(response, uploaded))
 
-'''
-Modified match function to return only the fpid
-'''
-def match(apikey, pcmiter, samplerate, duration, channels=2, metadata=None):
-    fpdata = lastfp.extract(pcmiter, samplerate, channels)
-    fpid = lastfp.fpid_query(duration, fpdata, metadata)
-    return fpid
+    def reject(self, request, message):
+        self.replies.put({'id': request.get('id'), 'error': UNKNOWN_ERROR,
+            'message': message})
 
-lastfp.match = match
+    def receive(self, path, size):
+        # keep the extension, the decoders may need it
+        descriptor, temp_path = tempfile.mkstemp(
+            suffix=os.path.splitext(path)[1], prefix='matcher-')
+
+        try:
+            with os.fdopen(descriptor, 'wb') as audio_file:
+                while size:
+                    chunk = self.rfile.read(min(size, Remote.UPLOAD_CHUNK))
+
+                    if not chunk:
+                        raise IOError('The client closed the connection')
+
+                    audio_file.write(chunk)
+                    size -= len(chunk)
+        except:
+            os.remove(temp_path)
+            raise
+
+        return temp_path
+
+    def finished(self, response, uploaded):
+        # called from the result thread of the pool, that MUST NOT block
+        with self.server.lock:
+            self.server.jobs -= 1
+
+        if uploaded:
+            try:
+                os.remove(response['path'])
+            except OSError:
+                pass
+
+        self.replies.put(worker_response(response))
+
+class TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def serve_socket(argv):
+    '''
+    Server mode. Fingerprints the songs sent by the clients connected to the
+    given address with a pool of processes.
+    '''
+    parser = argparse.ArgumentParser(prog='matcher.py --serve')
+    parser.add_argument('address', nargs='?',
+        default='localhost:%d' % Remote.PORT,
+        help='host:port to listen on (localhost:%d by default), or the path '
+             'of a UNIX socket' % Remote.PORT)
+    parser.add_argument('-j', '--jobs', type=int,
+        default=multiprocessing.cpu_count(),
+        help='number of files fingerprinted at the same time')
+    parser.add_argument('--secret', default=os.environ.get('MATCHER_SECRET'),
+        help='secret the clients must send before any request (defaults to '
+             'the MATCHER_SECRET environment variable)')
+    parser.add_argument('--max-upload', type=int,
+        default=Remote.MAX_UPLOAD // (1 << 20),
+        help='maximum size (in MB) of the files uploaded over TCP')
+    options = parser.parse_args(argv)
+
+    sys.stdout = sys.stderr
+
+    # the pool is forked before starting any thread
+    pool = multiprocessing.Pool(options.jobs)
+    address = Remote.parse_address(options.address)
+
+    if isinstance(address, tuple):
+        if address[0] not in LOOPBACK and not options.secret:
+            print 'Warning: listening on %s without a secret, anyone who ' \
+                'can reach it can use the server' % options.address
+
+        server = TCPServer(address, JobHandler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+
+        server = UnixServer(address, JobHandler)
+
+    server.pool = pool
+    server.lock = threading.Lock()
+    server.jobs = 0
+    server.uploads = isinstance(address, tuple)
+    server.max_upload = options.max_upload << 20
+    server.secret = options.secret or ''
+
+    # clean up when killed too
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    print 'Serving on %s with %d jobs' % (options.address, options.jobs)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.terminate()
+        pool.join()
+
+        if not isinstance(address, tuple):
+            os.remove(address)
+
+    return 0
 
 if __name__ == '__main__':
     args = sys.argv[1:]
+    if args == ['--worker']:
+        serve()
+        sys.exit(0)
+
+    if args and args[0] == '--batch':
+        sys.exit(batch(args[1:]))
+
+    if args and args[0] == '--serve':
+        sys.exit(serve_socket(args[1:]))
+
     if not args:
         print "usage: matcher.py mysterious_music.mp3"
         sys.exit(1)
 
-    path = os.path.abspath(os.path.expanduser(args[0]))
+    path = args[0]
     artist = args[1]
     album = args[2]
     title = args[3]
 
     # Perform match.
     try:
-        fpid = lastfp.match_file(Keys.API_KEY, path, metadata={ 'artist':artist,
-                                                         'album':album,
-                                                         'track':title })
+        fpid = fingerprint(path, artist, album, title)
     except lastfp.ExtractionError:
         print 'Fingerprinting failed! (Is the song too short?)'
         sys.exit(1)
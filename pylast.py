@@ -66,6 +66,9 @@ STATUS_SUBSCRIBERS_ONLY = 12
 STATUS_INVALID_SIGNATURE = 13
 STATUS_TOKEN_UNAUTHORIZED = 14
 STATUS_TOKEN_EXPIRED = 15
+STATUS_TEMPORARILY_UNAVAILABLE = 16
+STATUS_SUSPENDED_API_KEY = 26
+STATUS_RATE_LIMIT_EXCEEDED = 29
 
 EVENT_ATTENDING = '0'
 EVENT_MAYBE_ATTENDING = '1'
@@ -512,13 +515,18 @@ class _Network(object):
         """
             Used to scrobble a batch of tracks at once. The parameter tracks is a sequence of dicts per
             track containing the keyword arguments as if passed to the scrobble() method.
+            The tracks are sent in chunks of 50 (the most Last.fm accepts per request). Returns a list
+            with the response document of each chunk, so the caller can check which scrobbles were ignored.
         """
         
-        tracks_to_scrobble = tracks[:50]
-        if len(tracks) > 50:
-            remaining_tracks = tracks[50:]
-        else:
-            remaining_tracks = None
+        docs = []
+        
+        for start in range(0, len(tracks), 50):
+            docs.append(self._scrobble_chunk(tracks[start:start + 50]))
+        
+        return docs
+    
+    def _scrobble_chunk(self, tracks_to_scrobble):
         
         params = {}
         for i in range(len(tracks_to_scrobble)):
@@ -540,10 +548,7 @@ class _Network(object):
                     params["%s[%d]" %(maps_to, i)] = tracks_to_scrobble[i][arg]
         
         
-        _Request(self, "track.scrobble", params).execute()
-        
-        if remaining_tracks:
-            self.scrobble_many(remaining_tracks)
+        return _Request(self, "track.scrobble", params).execute()
     
 class LastFMNetwork(_Network):
     
@@ -1146,6 +1151,9 @@ class WSError(Exception):
             STATUS_SUBSCRIBERS_ONLY = 12
             STATUS_TOKEN_UNAUTHORIZED = 14
             STATUS_TOKEN_EXPIRED = 15
+            STATUS_TEMPORARILY_UNAVAILABLE = 16
+            STATUS_SUSPENDED_API_KEY = 26
+            STATUS_RATE_LIMIT_EXCEEDED = 29
         """
         
         return self.status
@@ -2472,6 +2480,18 @@ class Track(_BaseObject, _Taggable):
         node = doc.getElementsByTagName("album")[0]
         return Album(_extract(node, "artist"), _extract(node, "title"), self.network)
     
+    def get_correction(self):
+        """Returns the track with the artist and title corrected by the
+        network, or None if there is no correction for them."""
+        
+        doc = self._request("track.getCorrection", True)
+        
+        for node in doc.getElementsByTagName("correction"):
+            track = node.getElementsByTagName("track")[0]
+            artist = track.getElementsByTagName("artist")[0]
+            
+            return Track(_extract(artist, "name"), _extract(track, "name"), self.network)
+    
     def get_wiki_published_date(self):
         """Returns the date of publishing this version of the wiki."""
         
@@ -3565,7 +3585,7 @@ def _collect_nodes(limit, sender, method_name, cacheable, params=None):
             raise Exception("No total pages attribute")
         
         for node in main.childNodes:
-            if not node.nodeType == xml.dom.Node.TEXT_NODE and len(nodes) < limit:
+            if not node.nodeType == xml.dom.Node.TEXT_NODE and (not limit or len(nodes) < limit):
                 nodes.append(node)
         
         if page >= total_pages: